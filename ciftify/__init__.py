@@ -10,6 +10,8 @@ from . import html
 from . import qc_config
 from . import niio
 from . import filenames
+from . import spec
+from . import surface
 from . import meants
 from . import report
 #from commands import *
@@ -4,6 +4,7 @@ Converts a freesurfer recon-all output to a working directory
 
 Usage:
   ciftify_recon_all [options] <Subject>
+  ciftify_recon_all [options] --subjects FILE
 
 Arguments:
     <Subject>               The Subject ID in the HCP data folder
@@ -13,18 +14,30 @@ Options:
                               CIFTIFY_WORKDIR/ HCP_DATA enivironment variables)
    --fs-subjects-dir PATH     Path to the freesurfer SUBJECTS_DIR directory
                               (overides the SUBJECTS_DIR environment variable)
+  --subjects FILE             A text file with one Subject ID per line. Each
+                              subject is run in turn within this process
   --resample-to-T1w32k        Resample the Meshes to 32k Native (T1w) Space
   --surf-reg REGNAME          Registration sphere prefix [default: MSMSulc]
 
   --no-symlinks               Will not create symbolic links to the zz_templates folder
 
   --fs-license FILE           Path to the freesurfer license file
+  --legacy-resample           Use mri_convert (instead of nibabel/nilearn) to
+                              resample the freesurfer segmentations to the T1w
+  --in-process-resample       EXPERT OPTION. Do the BARYCENTRIC resampling of
+                              the surfaces, labels and medial wall ROIs in
+                              python instead of with wb_command
   --read-non-lin-xfm PATH     EXPERT OPTION, read this FSL format warp to MNI space
                               instead of generating it from the inputs.
                               Must be an FSL transform (warp) file.
   --read-lin-premat PATH      EXPERT OPTION, read this FSL format warp linear (premat)
                               transform to MNI space instead of generating it.
                               Must be an an FSL transform (warp) file.
+  --linear-only               EXPERT OPTION. Only register linearly (flirt) to MNI
+                              space, skipping fnirt and invwarp. With
+                              --read-lin-premat, only the premat is needed. The
+                              outputs have no non-linear warp, so they cannot be
+                              used by ciftify_subject_fmri.
   --MSM-config PATH           EXPERT OPTION. The path to the configuration file to use for
                               MSMSulc mode. By default, the configuration file
                               is ciftify/data/hcp_config/MSMSulcStrainFinalconf
@@ -35,6 +48,12 @@ Options:
   --hcp-data-dir PATH         DEPRECATED, use --ciftify-work-dir instead
   --n_cpus INT                Number of cpu's available. Defaults to the value
                               of the OMP_NUM_THREADS environment variable
+  --omp-nthreads INT          Number of threads given to each multithreaded
+                              subprocess (wb_command, FSL). Independent steps
+                              are run n_cpus / omp-nthreads at a time, so lower
+                              values run more steps in parallel while higher
+                              values speed up each step. Defaults to half of
+                              n_cpus
   -v,--verbose                Verbose logging
   --debug                     Debug logging in Erin's very verbose style
   -n,--dry-run                Dry run
@@ -76,18 +95,29 @@ Written by Erin W Dickie
 """
 import os
 import sys
+import re
 import math
 import datetime
+import functools
+import hashlib
 import tempfile
 import shutil
 import subprocess
 import logging
+import threading
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
 
 from docopt import docopt
 
 import ciftify
-from ciftify.utils import WorkFlowSettings, get_stdout, cd, section_header, has_ciftify_recon_all_run
+import ciftify.spec
+import ciftify.niio
+from ciftify.utils import WorkFlowSettings, get_stdout, section_header, has_ciftify_recon_all_run
 from ciftify.filenames import *
 
 logger = logging.getLogger('ciftify')
@@ -95,9 +125,28 @@ logger.setLevel(logging.DEBUG)
 
 DRYRUN = False
 N_CPUS = 1
+OMP_NTHREADS = 1
 FS_LICENSE = None
+## the environment variables given to every subprocess, set once per subject
+## with set_run_env(). Steps run side by side by run_many() get RUN_ENV
+## (OMP_NTHREADS threads each), steps run on their own get SERIAL_RUN_ENV
+## (all N_CPUS threads).
+RUN_ENV = {"OMP_NUM_THREADS": str(OMP_NTHREADS)}
+SERIAL_RUN_ENV = RUN_ENV
+## marks the run_many() worker threads
+POOL_THREAD = threading.local()
+LEGACY_RESAMPLE = False
+IN_PROCESS_RESAMPLE = False
+## the files to add to each spec file, written all at once at the end of the
+## run (see add_to_spec_file)
+SPEC_FILES = ciftify.spec.SpecFileBatcher()
+BUILD_ENV = None
+## intermediate volumes that are only read once are written to memory
+## backed storage when the system has it
+RAM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
 
 def run_ciftify_recon_all(temp_dir, settings):
+    global SPEC_FILES
     subject = settings.subject
 
     log_inputs(settings.fs_root_dir, settings.work_dir, subject.id,
@@ -116,18 +165,30 @@ def run_ciftify_recon_all(temp_dir, settings):
 
     expected_labels = define_expected_labels(fs_version)
 
-    # that this would have died when setting up log in the situation of an incomplete output
-    if settings.skip_main_wf:
-        logger.info("Found completed ciftify output, only resampling to T1w/fsaverage_LR32k")
-    else:
-        run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version)
+    ## the spec files are written when leaving this block, even if a step
+    ## fails, so that they list everything made up to that point
+    SPEC_FILES = ciftify.spec.SpecFileBatcher(dry_run=DRYRUN)
+    with SPEC_FILES:
+        # that this would have died when setting up log in the situation of an incomplete output
+        if settings.skip_main_wf:
+            logger.info("Found completed ciftify output, only resampling to T1w/fsaverage_LR32k")
+        else:
+            run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version)
 
-    if settings.resample:
-        resampling_to_t1w_32k(temp_dir, settings, meshes, expected_labels)
+        if settings.resample:
+            resampling_to_t1w_32k(temp_dir, settings, meshes, expected_labels)
     # exit successfully
-    logger.info(section_header('Done'))
+    log_section('Done')
+    write_done_file(subject)
     return 0
 
+def write_done_file(subject):
+    '''mark the subject as complete so reruns can check one file'''
+    if DRYRUN:
+        return
+    with open(subject.done_file, 'w') as done_file:
+        done_file.write(datetime.datetime.now().isoformat())
+
 def run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version):
     '''most of the workflow with default settings'''
 
@@ -164,8 +225,8 @@ def run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version
 
     reg_sphere = create_reg_sphere(settings, subject.id, meshes)
 
-    logger.info(section_header("Importing HighRes Template Sphere and Medial "
-            "Wall ROI"))
+    log_section("Importing HighRes Template Sphere and Medial "
+            "Wall ROI")
 
     ## incorporate the atlasroi boundries into the native space roi
     merge_subject_medial_wall_with_atlas_template(subject.id, settings.high_res,
@@ -175,15 +236,15 @@ def run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version
     dilate_and_mask_metric(subject.id, meshes['AtlasSpaceNative'],
             settings.dscalars)
 
-    logger.info(section_header("Creating Native Space Dense Maps"))
+    log_section("Creating Native Space Dense Maps")
     make_dense_map(subject.id, meshes['AtlasSpaceNative'],
             settings.dscalars, expected_labels)
     add_dense_maps_to_spec_file(subject.id, meshes['T1wNative'],
             settings.dscalars.keys(), expected_labels)
 
     #Populate Highres fs_LR spec file.
-    logger.info(section_header('Resampling data from Native to {}'
-            ''.format(meshes['HighResMesh']['meshname'])))
+    log_section('Resampling data from Native to {}'
+            ''.format(meshes['HighResMesh']['meshname']))
 
     copy_colin_flat_and_add_to_spec(subject.id, settings, meshes['HighResMesh'])
 
@@ -193,8 +254,8 @@ def run_default_workflow(temp_dir, settings, meshes, expected_labels, fs_version
     # Populate LowRes fs_LR spec file.
     for res in settings.low_res:
         low_res_name = '{}k_fs_LR'.format(res)
-        logger.info(section_header('Resampling data from Native to '
-                '{}'.format(low_res_name)))
+        log_section('Resampling data from Native to '
+                '{}'.format(low_res_name))
         populate_low_res_spec_file(meshes['AtlasSpaceNative'],
                 meshes[low_res_name], subject, settings, reg_sphere, expected_labels)
 
@@ -222,9 +283,9 @@ def resampling_to_t1w_32k(temp_dir, settings, meshes, expected_labels):
     # make the folder if it does not exist
     for res in settings.low_res:
         low_res_name = '{}k_fs_LR'.format(res)
-        logger.info(section_header('Resampling data from Native to T1w -'
-                '{}'.format(low_res_name)))
-        dest_mesh_name = 'Native{}k_fs_LR'.format(res)
+        log_section('Resampling data from Native to T1w -'
+                '{}'.format(low_res_name))
+        dest_mesh_name = 'Native{}'.format(low_res_name)
 
         # make the folder if it does not exist
         if not os.path.exists(meshes[dest_mesh_name]['Folder']):
@@ -238,37 +299,147 @@ def resampling_to_t1w_32k(temp_dir, settings, meshes, expected_labels):
                 reg_sphere_mesh = meshes['AtlasSpaceNative'])
 
 def run(cmd, dryrun = False, suppress_stdout = False, suppress_stderr = False):
-    ''' calls the run function with specific settings'''
+    '''
+    calls the run function with specific settings. Commands run from a
+    run_many() job share the cpus with the other jobs, any other command gets
+    all of them.
+    '''
     global DRYRUN
     dryrun = DRYRUN or dryrun
-    if FS_LICENSE:
-        run_env = {"OMP_NUM_THREADS": str(N_CPUS),
-        "FS_LICENSE": FS_LICENSE}
-    else:
-        run_env = {"OMP_NUM_THREADS": str(N_CPUS)}
+    if type(cmd) is list:
+        cmd = with_wb_logging(cmd)
+    env = RUN_ENV if getattr(POOL_THREAD, 'active', False) else SERIAL_RUN_ENV
     returncode = ciftify.utils.run(cmd,
                                        dryrun = dryrun,
                                        suppress_stdout = suppress_stdout,
                                        suppress_stderr = suppress_stderr,
-                                       env= run_env)
+                                       env= env)
     if returncode :
         sys.exit(1)
     return(returncode)
 
+def with_wb_logging(cmd):
+    '''
+    only log wb_command's SEVERE messages, unless the command sets its own
+    -logging level
+    '''
+    if cmd and cmd[0] == 'wb_command' and '-logging' not in cmd:
+        return ['wb_command', '-logging', 'SEVERE'] + cmd[1:]
+    return cmd
+
+def run_chain(cmds, dryrun = False):
+    '''
+    run a list of commands (each a list) one after the other in a single
+    shell, stopping at the first one that fails. Saves starting a shell for
+    each of a series of short commands.
+    '''
+    chained = ' && '.join(' '.join(with_wb_logging(cmd)) for cmd in cmds)
+    return run(chained, dryrun = dryrun)
+
+def set_run_env(omp_nthreads, fs_license, n_cpus = None):
+    '''
+    builds the environments for run() once, instead of on every call. A new
+    dict is made rather than the old one edited, so it is safe to read from
+    the run_many() threads. Commands run outside of run_many() get n_cpus
+    threads (omp_nthreads if n_cpus is not given).
+    '''
+    global RUN_ENV, SERIAL_RUN_ENV
+    run_env = {"OMP_NUM_THREADS": str(omp_nthreads)}
+    if fs_license:
+        run_env["FS_LICENSE"] = fs_license
+    serial_env = dict(run_env)
+    if n_cpus:
+        serial_env["OMP_NUM_THREADS"] = str(n_cpus)
+    RUN_ENV = run_env
+    SERIAL_RUN_ENV = serial_env
+
+def add_to_spec_file(spec, structure, filename):
+    '''
+    Queue a file to be added to a spec file. Each spec file is then written
+    once by SPEC_FILES, instead of running wb_command -add-to-spec-file for
+    every file.
+    '''
+    SPEC_FILES.add(spec, structure, filename)
+
+def run_many(jobs):
+    '''
+    Runs independent jobs at the same time. Each job is a tuple of a function
+    followed by its arguments (i.e. (convert_freesurfer_mgz, 'wmparc', ...)).
+    The work is done by the subprocesses started by run(), so a thread pool
+    is enough. Each subprocess gets OMP_NTHREADS threads, so at most
+    N_CPUS // OMP_NTHREADS jobs are run at once. Like run(), exits if any of
+    the jobs fails (the error of a job that raised is logged first). Returns
+    the result of each job, in the order given.
+    '''
+    if not jobs:
+        return []
+    pool_size = max(1, min(len(jobs), int(N_CPUS) // OMP_NTHREADS))
+    failed = False
+    with ThreadPoolExecutor(max_workers=pool_size,
+            initializer=_mark_pool_thread) as executor:
+        futures = [executor.submit(job[0], *job[1:]) for job in jobs]
+    results = []
+    for job, future in zip(jobs, futures):
+        try:
+            results.append(future.result())
+        except SystemExit:
+            failed = True
+            results.append(None)
+        except Exception:
+            logger.exception("{} failed".format(getattr(job[0], '__name__',
+                    job[0])))
+            failed = True
+            results.append(None)
+    if failed:
+        sys.exit(1)
+    return results
+
+def _mark_pool_thread():
+    ''' lets run() know that it is called from a run_many() job '''
+    POOL_THREAD.active = True
+
+HEMISPHERES = [('L', 'CORTEX_LEFT'), ('R', 'CORTEX_RIGHT')]
+
+def run_per_hemisphere(func, *args):
+    '''
+    Runs func(hemisphere, structure, *args) for both hemispheres at the same
+    time with run_many(). Returns the two results in L, R order.
+
+    The hemispheres share a spec file, so func should not add to the spec
+    file itself. Instead it returns what to add and the caller adds it after
+    both have finished, which keeps the spec entries in L, R order.
+    '''
+    return run_many([(func, hemisphere, structure) + args
+            for hemisphere, structure in HEMISPHERES])
+
+def run_per_mesh_and_hemisphere(func, subject_id, meshes_settings, *args):
+    '''
+    Like run_per_hemisphere() but for several meshes, all at the same time.
+    Runs func(hemisphere, structure, subject_id, mesh_settings, *args) and
+    returns the L, R results for each mesh, in the order given.
+    '''
+    results = run_many([(func, hemisphere, structure, subject_id,
+            mesh_settings) + args for mesh_settings in meshes_settings
+            for hemisphere, structure in HEMISPHERES])
+    return [results[i:i + len(HEMISPHERES)]
+            for i in range(0, len(results), len(HEMISPHERES))]
+
 class Settings(WorkFlowSettings):
     def __init__(self, arguments):
         WorkFlowSettings.__init__(self, arguments)
+        self.ciftify_data_dir = ciftify.config.find_ciftify_global()
         self.reg_name = self.__set_registration_mode(arguments)
         self.resample = arguments['--resample-to-T1w32k']
         self.no_symlinks = arguments['--no-symlinks']
         self.fs_root_dir = self.__set_fs_subjects_dir(arguments)
         self.subject = self.__get_subject(arguments)
-        self.ciftify_data_dir = ciftify.config.find_ciftify_global()
         self.fs_license = self.__get_freesurfer_license(arguments['--fs-license'])
+        self.omp_nthreads = self.__get_omp_nthreads(arguments['--omp-nthreads'])
         self.use_T2 = self.__get_T2(arguments, self.subject) # T2 runs only using freesurfer not recommended
         self.dscalars = self.__define_dscalars()
         self.registration = self.__define_registration_settings(
-                arguments['--read-non-lin-xfm'], arguments['--read-lin-premat'])
+                arguments['--read-non-lin-xfm'], arguments['--read-lin-premat'],
+                arguments['--linear-only'])
         self.skip_main_wf = self.__has_been_run_before()
 
     def __set_registration_mode(self, arguments):
@@ -281,7 +452,7 @@ class Settings(WorkFlowSettings):
             ciftify.config.verify_msm_available()
             user_config = arguments['--MSM-config']
             if not user_config:
-                self.msm_config = os.path.join(ciftify.config.find_ciftify_global(),
+                self.msm_config = os.path.join(self.ciftify_data_dir,
                         'hcp_config', 'MSMSulcStrainFinalconf')
             elif user_config and not os.path.exists(user_config):
                 logger.error("MSM config file {} does not exist".format(user_config))
@@ -299,19 +470,12 @@ class Settings(WorkFlowSettings):
 
 
     def check_msm_config(self):
-        arg_list = list()
-        msm_fp = open(self.msm_config)
-        while True:
-            arg = msm_fp.readline()
-            if (len(arg) == 0):
-                break
-            arg = arg[0:arg.rfind('=')]
-            arg_list.append(arg)
-
-        msm_options = subprocess.Popen(['msm', '--printoptions'], stderr=subprocess.PIPE)
-        out, err = msm_options.communicate()
-        err = err.decode('utf-8') # for python 3 compatible
-        return all((arg in err or arg == '--dopt') for arg in arg_list)
+        '''check that every option in the msm config is known to msm'''
+        with open(self.msm_config) as msm_fp:
+            config_args = {line.rsplit('=', 1)[0].strip()
+                    for line in msm_fp.read().splitlines() if line.strip()}
+
+        return config_args <= (msm_printoptions() | {'--dopt'})
 
     def __get_freesurfer_license(self, fs_license_arg):
         '''check that freesurfer license is readable'''
@@ -323,6 +487,22 @@ class Settings(WorkFlowSettings):
             fs_license_file = os.environ.get('FS_LICENSE')
         return fs_license_file
 
+    def __get_omp_nthreads(self, user_omp_nthreads):
+        '''
+        reads the number of threads for each multithreaded subprocess, by
+        default half of the cpus so that two steps can run side by side
+        '''
+        if user_omp_nthreads:
+            try:
+                omp_nthreads = int(user_omp_nthreads)
+            except ValueError:
+                logger.critical('Could not read --omp-nthreads entry {} as '
+                        'integer'.format(user_omp_nthreads))
+                sys.exit(1)
+        else:
+            omp_nthreads = int(self.n_cpus) // 2
+        return max(1, omp_nthreads)
+
     def __set_fs_subjects_dir(self, arguments):
         fs_root_dir = arguments['--fs-subjects-dir']
         if fs_root_dir:
@@ -346,7 +526,8 @@ class Settings(WorkFlowSettings):
         '''
         if os.path.exists(self.subject.path):
             if self.resample:
-                if has_ciftify_recon_all_run(self.work_dir, self.subject.id):
+                if (os.path.exists(self.subject.done_file) or
+                        has_ciftify_recon_all_run(self.work_dir, self.subject.id)):
                         logger.info("Found completed ciftify output, only resampling to T1w/fsaverage_LR32k")
                         return True
                 else:
@@ -377,8 +558,8 @@ class Settings(WorkFlowSettings):
                 pass
         return dscalars_config
 
-    def __define_registration_settings(self, read_nonlin_xfm, read_lin_xfm, method='FSL_fnirt',
-            standard_res='2mm'):
+    def __define_registration_settings(self, read_nonlin_xfm, read_lin_xfm,
+            linear_only=False, method='FSL_fnirt', standard_res='2mm'):
         registration_config = self.get_config_entry('registration')
         for key in ['src_dir', 'dest_dir', 'xfms_dir']:
             try:
@@ -390,7 +571,16 @@ class Settings(WorkFlowSettings):
             registration_config[key] = os.path.join(self.subject.path, subfolders)
         resolution_config = WorkFlowSettings.get_resolution_config(self, method, standard_res)
         registration_config.update(resolution_config)
-        if any([read_nonlin_xfm, read_lin_xfm]):
+        registration_config['skip_nonlinear'] = bool(linear_only)
+        if linear_only:
+            if read_nonlin_xfm:
+                logger.critical("--read-non-lin-xfm cannot be used with --linear-only")
+                sys.exit(1)
+            if read_lin_xfm:
+                ciftify.utils.check_input_readable(read_lin_xfm)
+            registration_config['User_AtlasTransform_NonLinear'] = False
+            registration_config['User_AtlasTransform_Linear'] = read_lin_xfm or False
+        elif any([read_nonlin_xfm, read_lin_xfm]):
             if all([read_nonlin_xfm, read_lin_xfm]):
                 ciftify.utils.check_input_readable(read_nonlin_xfm)
                 registration_config['User_AtlasTransform_NonLinear'] = read_nonlin_xfm
@@ -414,6 +604,17 @@ class Settings(WorkFlowSettings):
         #     return None
         # return raw_T2
 
+@functools.lru_cache(maxsize=1)
+def msm_printoptions():
+    '''
+    the options known to the msm binary (printed to stderr by
+    msm --printoptions), only read once per process
+    '''
+    msm_options = subprocess.run(['msm', '--printoptions'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+    return frozenset(re.findall(r'--\w[\w-]*', msm_options.stderr))
+
 class Subject:
     def __init__(self, work_dir, fs_root_dir, subject_id, resample_to_T1w32k):
         self.id = subject_id
@@ -422,6 +623,7 @@ class Subject:
         self.T1w_dir = os.path.join(self.path, 'T1w')
         self.atlas_space_dir = os.path.join(self.path, 'MNINonLinear')
         self.log = os.path.join(self.path, 'cifti_recon_all.log')
+        self.done_file = os.path.join(self.path, '.ciftify_recon_all.done')
 
     def __set_fs_folder(self, fs_root_dir):
         fs_path = os.path.join(fs_root_dir, self.id)
@@ -456,22 +658,31 @@ def log_inputs(fs_dir, work_dir, subject_id, registration_config, msm_config=Non
     logger.info('    Subject: {}'.format(subject_id))
     if msm_config:
         logger.info('    MSM config file: {}'.format(msm_config))
-    if registration_config['User_AtlasTransform_NonLinear']:
+    if registration_config.get('skip_nonlinear'):
+        logger.info('    Linear only registration to MNI space')
+    if registration_config['User_AtlasTransform_Linear']:
         logger.info('User given transforms (to be copied to MNINonLinear/xfm):')
         logger.info('     User given linear tranform: {}'.format(registration_config['User_AtlasTransform_Linear']))
-        logger.info('     User given non-linear tranform: {}'.format(registration_config['User_AtlasTransform_NonLinear']))
+        if registration_config['User_AtlasTransform_NonLinear']:
+            logger.info('     User given non-linear tranform: {}'.format(registration_config['User_AtlasTransform_NonLinear']))
 
 def log_build_environment(settings):
     '''print the running environment info to the logs (info)'''
+    global BUILD_ENV
+    if BUILD_ENV is None:
+        ## the software found will not change between subjects, so the
+        ## subprocesses needed to describe it are only run once
+        BUILD_ENV = ["Username: {}".format(get_stdout(['whoami'],
+                    echo=False).replace(os.linesep,'')),
+                ciftify.config.system_info(),
+                ciftify.config.ciftify_version(os.path.basename(__file__)),
+                ciftify.config.wb_command_version(),
+                ciftify.config.freesurfer_version(),
+                ciftify.config.fsl_version()]
+        # if settings.msm_config: BUILD_ENV.append(ciftify.config.msm_version())
     logger.info("{}---### Environment Settings ###---".format(os.linesep))
-    logger.info("Username: {}".format(get_stdout(['whoami'],
-            echo=False).replace(os.linesep,'')))
-    logger.info(ciftify.config.system_info())
-    logger.info(ciftify.config.ciftify_version(os.path.basename(__file__)))
-    logger.info(ciftify.config.wb_command_version())
-    logger.info(ciftify.config.freesurfer_version())
-    logger.info(ciftify.config.fsl_version())
-    # if settings.msm_config: logger.info(ciftify.config.msm_version())
+    for info in BUILD_ENV:
+        logger.info(info)
     logger.info("---### End of Environment Settings ###---{}".format(os.linesep))
 
 
@@ -488,24 +699,33 @@ def pars_recon_all_logs(fs_folder):
         logger.warning(fslog.status)
     return fslog.version
 
+## the labels made by each freesurfer version (as parsed by FSLog), when the
+## version is unknown all of them are looked for
+EXPECTED_LABELS = {
+    'v6.0.0': ('aparc', 'aparc.a2009s', 'aparc.DKTatlas', 'BA_exvivo'),
+    'v5.3.0': ('aparc', 'aparc.a2009s', 'BA'),
+    'v5.1.0': ('aparc', 'aparc.a2009s', 'BA')}
+ALL_EXPECTED_LABELS = ('aparc', 'aparc.a2009s', 'BA', 'aparc.DKTatlas',
+        'BA_exvivo')
+
 def define_expected_labels(fs_version):
     ''' figures out labels according to freesurfer version run '''
-    expected_labels = ['aparc', 'aparc.a2009s', 'BA', 'aparc.DKTatlas',
-            'BA_exvivo']
-    if fs_version == 'v6.0.0':
-        expected_labels.remove('BA')
-    if 'v5.' in fs_version:
-        expected_labels.remove('aparc.DKTatlas')
-        expected_labels.remove('BA_exvivo')
-    return expected_labels
+    return list(EXPECTED_LABELS.get(fs_version, ALL_EXPECTED_LABELS))
 
 def create_output_directories(meshes, xfms_dir, rois_dir, results_dir):
+    '''make every output folder once, several meshes share the same folders'''
+    output_dirs = {xfms_dir, rois_dir, results_dir}
     for mesh in meshes.values():
-        ciftify.utils.make_dir(mesh['Folder'], DRYRUN, suppress_exists_error = True)
-        ciftify.utils.make_dir(mesh['tmpdir'], DRYRUN, suppress_exists_error = True)
-    ciftify.utils.make_dir(xfms_dir, DRYRUN)
-    ciftify.utils.make_dir(rois_dir, DRYRUN)
-    ciftify.utils.make_dir(results_dir, DRYRUN)
+        output_dirs.update([mesh['Folder'], mesh['tmpdir']])
+    if DRYRUN:
+        return
+    for output_dir in sorted(output_dirs):
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+        except OSError:
+            logger.error("Could not create directory {}, exiting".format(
+                    output_dir))
+            sys.exit(1)
 
 def link_to_template_file(settings, subject_file, global_file, via_file):
     '''
@@ -518,35 +738,136 @@ def link_to_template_file(settings, subject_file, global_file, via_file):
     directory to this file
     '''
     if settings.no_symlinks:
-        run(['cp', global_file, subject_file], dryrun=DRYRUN)
+        copy_file(global_file, subject_file)
     else:
         ## copy from ciftify template to the HCP_DATA if via_file does not exist
         via_folder = os.path.join(settings.work_dir, 'zz_templates')
         via_path = os.path.join(via_folder, via_file)
         if not os.path.isfile(via_path):
-            if not os.path.exists(via_folder):
-                    run(['mkdir','-p',via_folder], dryrun=DRYRUN)
-            run(['cp', global_file, via_path], dryrun=DRYRUN)
+            if not DRYRUN:
+                os.makedirs(via_folder, exist_ok=True)
+            copy_file(global_file, via_path)
         ## link the subject_file to via_file
         if not DRYRUN:
             os.symlink(os.path.relpath(via_path, os.path.dirname(subject_file)),
                        subject_file)
 
+def log_section(title):
+    '''
+    log a section header, which is only formatted when INFO messages are
+    being logged
+    '''
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(section_header(title))
+
+def copy_file(src, dest):
+    '''
+    copy a file without starting a cp subprocess. An existing dest is removed
+    first, so that a dest left by an earlier run as a hard link to another
+    file is replaced rather than written through.
+    '''
+    logger.info("Copying {} to {}".format(src, dest))
+    if DRYRUN:
+        return
+    if os.path.abspath(src) == os.path.abspath(dest):
+        return
+    try:
+        os.unlink(dest)
+    except FileNotFoundError:
+        pass
+    shutil.copyfile(src, dest)
+
+def file_sha1(path):
+    '''the sha1 hex digest of a file's contents'''
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def freesurfer_to_gifti(converter, fs_file, gifti_file):
+    '''
+    convert a freesurfer surface, morph or annot file to gifti with one of the
+    ciftify.niio converters, without starting a mris_convert subprocess
+    '''
+    logger.info("Converting {} to {}".format(fs_file, gifti_file))
+    if DRYRUN:
+        return
+    converter(fs_file, gifti_file)
+
+def resample_barycentric(func, data_in, current_sphere, new_sphere, data_out):
+    '''
+    BARYCENTRIC resampling of a surface (func is
+    ciftify.niio.resample_surface_barycentric) or of a label or ROI file
+    taking the largest weight (ciftify.niio.resample_largest_barycentric).
+    Runs wb_command, unless --in-process-resample was given, then func is run
+    in process and the resampling weights for each pair of spheres are only
+    found once.
+    '''
+    if not IN_PROCESS_RESAMPLE:
+        run(wb_resample_barycentric_cmd(func, data_in, current_sphere,
+                new_sphere, data_out), dryrun=DRYRUN)
+        return
+    logger.info("Resampling {} to {} with {}".format(data_in, data_out,
+            func.__name__))
+    if DRYRUN:
+        return
+    func(data_in, current_sphere, new_sphere, data_out)
+
+def wb_resample_barycentric_cmd(func, data_in, current_sphere, new_sphere,
+        data_out):
+    '''the wb_command equivalent of a resample_barycentric() call'''
+    if func == ciftify.niio.resample_surface_barycentric:
+        return ['wb_command', '-surface-resample', data_in, current_sphere,
+                new_sphere, 'BARYCENTRIC', data_out]
+    resample = ('-label-resample' if data_out.endswith('.label.gii')
+            else '-metric-resample')
+    return ['wb_command', resample, data_in, current_sphere, new_sphere,
+            'BARYCENTRIC', data_out, '-largest']
+
+def set_structure(gii_file, structure):
+    '''
+    set the structure of a gifti file in process, in place of a
+    wb_command -set-structure subprocess (without the surface types)
+    '''
+    logger.info("Setting the structure of {} to {}".format(gii_file, structure))
+    if DRYRUN:
+        return
+    ciftify.niio.set_gifti_structure(gii_file, structure)
+
+def metric_math(func, *args):
+    '''
+    run one of the ciftify.niio metric_math functions in place of a
+    wb_command -metric-math subprocess, the first two arguments are the inputs
+    and the third the output
+    '''
+    logger.info("Calculating {} from {} with {}".format(args[2],
+            ', '.join(args[:2]), func.__name__))
+    if DRYRUN:
+        return
+    func(*args)
+
 ## Step 1: Conversion from Freesurfer Format ######################
 ## Step 1.0: Conversion of Freesurfer Volumes #####################
 def convert_T1_and_freesurfer_inputs(T1w_nii, subject, hcp_templates,
         T2_raw=None):
-    logger.info(section_header("Converting T1wImage and Segmentations from "
-            "freesurfer"))
+    log_section("Converting T1wImage and Segmentations from "
+            "freesurfer")
     ###### convert the mgz T1w and put in T1w folder
     convert_freesurfer_T1(subject.fs_folder, T1w_nii)
+    ## the T1w header is read once and used as the reference grid for
+    ## all the images resampled from freesurfer
+    T1w_img = None if DRYRUN or LEGACY_RESAMPLE else nib.load(T1w_nii)
     #Convert FreeSurfer Volumes and import the label metadata
-    for image in ['wmparc', 'aparc.a2009s+aseg', 'aparc+aseg']:
-      convert_freesurfer_mgz(image, T1w_nii, hcp_templates, subject.fs_folder,
-            subject.T1w_dir)
+    fs_labels = fs_lut_path(hcp_templates)
+    run_many([(convert_freesurfer_mgz, image, T1w_nii, fs_labels,
+                    subject.fs_folder, subject.T1w_dir, T1w_img)
+            for image in ['wmparc', 'aparc.a2009s+aseg', 'aparc+aseg']])
     if T2_raw:
         T2w_nii = os.path.join(subject.T1w_dir, 'T2w.nii.gz')
-        resample_freesurfer_mgz(T1w_nii, T2_raw, T2w_nii)
+        resample_freesurfer_mgz(T1w_nii, T2_raw, T2w_nii, T1w_img)
+
+@functools.lru_cache()
+def fs_lut_path(hcp_templates):
+    '''the FreeSurferAllLut.txt label table in the ciftify templates'''
+    return os.path.join(hcp_templates, 'hcp_config', 'FreeSurferAllLut.txt')
 
 def convert_freesurfer_T1(fs_folder, T1w_nii):
     '''
@@ -560,20 +881,35 @@ def convert_freesurfer_T1(fs_folder, T1w_nii):
         logger.error("Cannot find freesurfer T1 {}, exiting".format(fs_T1))
         sys.exit(1)
     run(['mri_convert', fs_T1, T1w_nii], dryrun=DRYRUN)
+    if not DRYRUN and is_fsl_standard_orientation(T1w_nii):
+        logger.debug("{} is already in standard orientation, skipping "
+                "fslreorient2std".format(T1w_nii))
+        return
     run(['fslreorient2std', T1w_nii, T1w_nii], dryrun=DRYRUN)
 
-def convert_freesurfer_mgz(image_name,  T1w_nii, hcp_templates,
-                           freesurfer_folder, out_dir):
+def is_fsl_standard_orientation(nifti):
+    '''
+    True if the axes of nifti are already in the order and direction that
+    fslreorient2std would give them. fslreorient2std only rotates the axes,
+    so radiological images end up LAS (like MNI152) and neurological ones RAS.
+    '''
+    axcodes = nib.aff2axcodes(nib.load(nifti).affine)
+    return axcodes in [('L', 'A', 'S'), ('R', 'A', 'S')]
+
+def convert_freesurfer_mgz(image_name,  T1w_nii, fs_labels,
+                           freesurfer_folder, out_dir, T1w_img=None):
     ''' convert image from freesurfer(mgz) to nifti format, and
         realigned to the specified T1wImage, and imports labels
         Arguments:
             image_name          Name of Image to Convert
             T1w_nii             Path to T1wImage to with desired output
                                 orientation
-            hcp_templates       The path to the hcp templates, as defined by
-                                the shell variable CIFTIFY_TEMPLATES
+            fs_labels           Path to the FreeSurferAllLut.txt label table
+                                in the hcp templates
             freesurfer_folder   Path the to subjects freesurfer output
             out_dir             Output Directory for converted Image
+            T1w_img             The T1wImage already loaded with nibabel
+                                (optional)
     '''
     freesurfer_mgz = os.path.join(freesurfer_folder, 'mri',
             '{}.mgz'.format(image_name))
@@ -585,14 +921,37 @@ def convert_freesurfer_mgz(image_name,  T1w_nii, hcp_templates,
             logger.warning("{} not found".format(freesurfer_mgz))
     else:
         image_nii = os.path.join(out_dir, '{}.nii.gz'.format(image_name))
-        resample_freesurfer_mgz(T1w_nii, freesurfer_mgz, image_nii)
+        resample_freesurfer_mgz(T1w_nii, freesurfer_mgz, image_nii, T1w_img)
         run(['wb_command', '-logging', 'SEVERE','-volume-label-import', image_nii,
-                os.path.join(hcp_templates, 'hcp_config', 'FreeSurferAllLut.txt'),
-                image_nii, '-drop-unused-labels'], dryrun=DRYRUN)
+                fs_labels, image_nii, '-drop-unused-labels'], dryrun=DRYRUN)
 
-def resample_freesurfer_mgz(T1w_nii, freesurfer_mgz, image_nii):
-    run(['mri_convert', '-rt', 'nearest', '-rl', T1w_nii, freesurfer_mgz,
-            image_nii], dryrun=DRYRUN)
+def resample_freesurfer_mgz(T1w_nii, freesurfer_mgz, image_nii, T1w_img=None):
+    '''
+    nearest neighbour resample a freesurfer image onto the T1wImage grid and
+    save it as nifti. This is done in process with nilearn, unless
+    --legacy-resample was given. T1w_img can be the T1wImage already loaded
+    with nibabel, so that it is not read again for every image.
+    '''
+    if LEGACY_RESAMPLE:
+        run(['mri_convert', '-rt', 'nearest', '-rl', T1w_nii, freesurfer_mgz,
+                image_nii], dryrun=DRYRUN)
+        return
+    logger.info("Resampling {} to {}".format(freesurfer_mgz, image_nii))
+    if DRYRUN:
+        return
+    ## nilearn is slow to import, so only imported when it is used
+    from nilearn.image import resample_to_img
+    if T1w_img is None:
+        T1w_img = nib.load(T1w_nii)
+    resampled = resample_to_img(freesurfer_mgz, T1w_img,
+            interpolation='nearest')
+    data = np.asanyarray(resampled.dataobj)
+    data = data.astype(data.dtype.newbyteorder('='))
+    ## keep the T1wImage header (sform/qform codes, units and pixdim) like
+    ## mri_convert -rl does, only the data type is the freesurfer image's
+    header = T1w_img.header.copy()
+    header.set_data_dtype(data.dtype)
+    nib.Nifti1Image(data, T1w_img.affine, header).to_filename(image_nii)
 
 ## Step 1.1: Creating Brainmask from wmparc #######################
 def prepare_T1_image(wmparc, T1w_nii, reg_settings):
@@ -601,49 +960,96 @@ def prepare_T1_image(wmparc, T1w_nii, reg_settings):
     T1w_brain_nii = os.path.join(reg_settings['src_dir'],
             reg_settings['T1wBrain'])
 
-    logger.info(section_header('Creating brainmask from freesurfer wmparc '
-            'segmentation'))
-    make_brain_mask_from_wmparc(wmparc, T1w_brain_mask)
-    ## apply brain mask to the T1wImage
-    mask_T1w_image(T1w_nii, T1w_brain_mask, T1w_brain_nii)
+    log_section('Creating brainmask from freesurfer wmparc '
+            'segmentation')
+    ## make the brain mask and apply it to the T1wImage in one pass
+    make_brain_mask_and_T1w_brain(wmparc, T1w_nii, T1w_brain_mask,
+            T1w_brain_nii)
 
-def make_brain_mask_from_wmparc(wmparc_nii, brain_mask):
+def make_brain_mask_and_T1w_brain(wmparc_nii, T1w_image, brain_mask, T1w_brain):
     '''
     Will create a brainmask_nii image out of the wmparc ROIs nifti converted
-    from freesurfer
+    from freesurfer, then mask the T1w Image with it to create the T1w_brain
+    image. Each input is read once and each output written once.
+
+    Does in memory what used to be done with
+        fslmaths wmparc -bin -dilD -dilD -dilD -ero -ero brain_mask
+        wb_command -volume-fill-holes brain_mask brain_mask
+        fslmaths brain_mask -bin brain_mask
+        fslmaths T1w_image -mul brain_mask T1w_brain
     '''
+    logger.info("Making brain mask {} from {}".format(brain_mask, wmparc_nii))
+    logger.info("Masking {} to make {}".format(T1w_image, T1w_brain))
+    if DRYRUN:
+        return
     ## Create FreeSurfer Brain Mask skipping 1mm version...
-    run(['fslmaths', wmparc_nii,
-        '-bin', '-dilD', '-dilD', '-dilD', '-ero', '-ero',
-        brain_mask], dryrun=DRYRUN)
-    run(['wb_command', '-volume-fill-holes', brain_mask, brain_mask])
-    run(['fslmaths', brain_mask, '-bin', brain_mask])
-
-def mask_T1w_image(T1w_image, brain_mask, T1w_brain):
-    '''mask the T1w Image with the brain_mask to create the T1w_brain image'''
-    run(['fslmaths', T1w_image, '-mul', brain_mask, T1w_brain])
+    wmparc = nib.load(wmparc_nii)
+    mask = brain_mask_from_wmparc(np.asanyarray(wmparc.dataobj))
+    mask_header = wmparc.header.copy()
+    mask_header.set_data_dtype(np.uint8)
+    nib.Nifti1Image(mask.astype(np.uint8), wmparc.affine,
+            mask_header).to_filename(brain_mask)
+
+    ## apply brain mask to the T1wImage, keeping the T1w data type
+    T1w = nib.load(T1w_image)
+    T1w_data = np.asanyarray(T1w.dataobj)
+    if not T1w_data.flags.writeable:
+        T1w_data = T1w_data.copy()
+    np.multiply(T1w_data, mask, out=T1w_data, casting='unsafe')
+    nib.Nifti1Image(T1w_data, T1w.affine, T1w.header).to_filename(T1w_brain)
+
+def brain_mask_from_wmparc(wmparc_data):
+    '''
+    binarize, dilate by 3, erode by 2 and fill the holes in the wmparc data
+    (an array), using the 3x3x3 box kernel that fslmaths uses by default
+    '''
+    kernel = np.ones((3, 3, 3), dtype=bool)
+    mask = wmparc_data > 0
+    mask = ndimage.binary_dilation(mask, structure=kernel, iterations=3)
+    mask = ndimage.binary_erosion(mask, structure=kernel, iterations=2,
+            border_value=1)
+    return ndimage.binary_fill_holes(mask)
 
 ## Step 1.2: running FSL registration #############################
 
 def convert_inputs_to_MNI_space(reg_settings, hcp_templates, temp_dir,
         use_T2=None):
-    logger.info(section_header("Registering T1wImage to MNI template using FSL "
-            "FNIRT"))
+    log_section("Registering T1wImage to MNI template using FSL "
+            "FNIRT")
     run_T1_FNIRT_registration(reg_settings, temp_dir)
 
+    warp_jobs = nonlinear_warp_jobs(reg_settings, hcp_templates, use_T2)
+    if not reg_settings.get('skip_nonlinear'):
+        ## the inverse warp is only needed later (for the surfaces), so it is
+        ## made while the volumes are warped to MNI space
+        warp_jobs.insert(0, (invert_nonlinear_warp, reg_settings))
+    log_section("Applying MNI transform to the T1wImage and label files")
+    ## one pool for everything, so no more than N_CPUS // OMP_NTHREADS
+    ## subprocesses run at once
+    run_many(warp_jobs)
+
+def nonlinear_warp_jobs(reg_settings, hcp_templates, use_T2=None):
+    '''
+    The run_many() jobs that warp the T1wImage to MNI space, with the label
+    files, brainmask and T2 (if used). They all use the MNI template grid as
+    their reference image, so none waits for another.
+    '''
+    warp_jobs = [(apply_nonlinear_warp_to_T1w, reg_settings)]
+
     # convert FreeSurfer Segmentations and brainmask to MNI space
-    logger.info(section_header("Applying MNI transform to label files"))
-    for image in ['wmparc', 'aparc.a2009s+aseg', 'aparc+aseg']:
-        apply_nonlinear_warp_to_nifti_rois(image, reg_settings, hcp_templates)
+    warp_jobs.extend((apply_nonlinear_warp_to_nifti_rois, image, reg_settings,
+                    hcp_templates)
+            for image in ['wmparc', 'aparc.a2009s+aseg', 'aparc+aseg'])
 
     # also transform the brain mask to MNI space
-    apply_nonlinear_warp_to_nifti_rois('brainmask_fs', reg_settings,
-            hcp_templates, import_labels=False)
+    warp_jobs.append((apply_nonlinear_warp_to_nifti_rois, 'brainmask_fs',
+            reg_settings, hcp_templates, False))
 
     if use_T2:
         # Transform T2 to MNI space too
-        apply_nonlinear_warp_to_nifti_rois('T2w', reg_settings, hcp_templates,
-                import_labels=False)
+        warp_jobs.append((apply_nonlinear_warp_to_nifti_rois, 'T2w',
+                reg_settings, hcp_templates, False))
+    return warp_jobs
 
 def run_T1_FNIRT_registration(reg_settings, temp_dir):
     '''
@@ -658,10 +1064,7 @@ def run_T1_FNIRT_registration(reg_settings, temp_dir):
     standard_BrainMask = reg_settings['standard_BrainMask']
     AtlasTransform_NonLinear = reg_settings['AtlasTransform_NonLinear']
     FNIRTConfig = reg_settings['FNIRTConfig']
-    InverseAtlasTransform_NonLinear = reg_settings['InverseAtlasTransform_NonLinear']
     standard_T1wImage = reg_settings['standard_T1wImage']
-    T1wImage = reg_settings['T1wImage']
-    dest_dir = reg_settings['dest_dir']
     User_AtlasTransform_Linear = reg_settings['User_AtlasTransform_Linear']
     User_AtlasTransform_NonLinear = reg_settings['User_AtlasTransform_NonLinear']
 
@@ -669,13 +1072,16 @@ def run_T1_FNIRT_registration(reg_settings, temp_dir):
     T1w2_standard_linear = os.path.join(temp_dir,
             'T1w2StandardLinearImage.nii.gz')
     if User_AtlasTransform_Linear:
-        run(['cp', User_AtlasTransform_Linear, os.path.join(xfms_dir,AtlasTransform_Linear)])
-        run(['cp', User_AtlasTransform_NonLinear, os.path.join(xfms_dir,AtlasTransform_NonLinear)])
+        copy_file(User_AtlasTransform_Linear, os.path.join(xfms_dir,AtlasTransform_Linear))
+        if User_AtlasTransform_NonLinear:
+            copy_file(User_AtlasTransform_NonLinear, os.path.join(xfms_dir,AtlasTransform_NonLinear))
     else:
         run(['flirt', '-interp', 'spline', '-dof', '12',
             '-in', os.path.join(src_dir, T1wBrain), '-ref', standard_T1wBrain,
             '-omat', os.path.join(xfms_dir, AtlasTransform_Linear),
             '-o', T1w2_standard_linear], dryrun=DRYRUN)
+        if reg_settings.get('skip_nonlinear'):
+            return
 
         ## calculate the just the warp for the surface transform - need it because
         ## sometimes the brain is outside the bounding box of warfield
@@ -685,17 +1091,40 @@ def run_T1_FNIRT_registration(reg_settings, temp_dir):
              '--fout={}'.format(os.path.join(xfms_dir, AtlasTransform_NonLinear)),
              '--logout={}'.format(os.path.join(xfms_dir, 'NonlinearReg_fromlinear.log')),
              '--config={}'.format(FNIRTConfig)], dryrun=DRYRUN)
-    ## also inverse the non-prelinear warp - we will need it for the surface
-    ## transforms
-    run(['invwarp', '-w', os.path.join(xfms_dir, AtlasTransform_NonLinear),
-         '-o', os.path.join(xfms_dir,InverseAtlasTransform_NonLinear),
-         '-r', standard_T1wImage], dryrun=DRYRUN)
-    ##T1w set of warped outputs (brain/whole-head + restored/orig)
+
+def nonlinear_warp_args(reg_settings):
+    '''
+    the applywarp arguments for the non-linear warp to MNI space, none when
+    only registering linearly (then applywarp only applies the --premat)
+    '''
+    if reg_settings.get('skip_nonlinear'):
+        return []
+    return ['-w', os.path.join(reg_settings['xfms_dir'],
+            reg_settings['AtlasTransform_NonLinear'])]
+
+def invert_nonlinear_warp(reg_settings):
+    '''
+    inverse the non-prelinear warp - we will need it for the surface
+    transforms
+    '''
+    xfms_dir = reg_settings['xfms_dir']
+    run(['invwarp', '-w', os.path.join(xfms_dir,
+                reg_settings['AtlasTransform_NonLinear']),
+         '-o', os.path.join(xfms_dir,
+                reg_settings['InverseAtlasTransform_NonLinear']),
+         '-r', reg_settings['standard_T1wImage']], dryrun=DRYRUN)
+
+def apply_nonlinear_warp_to_T1w(reg_settings):
+    '''T1w set of warped outputs (brain/whole-head + restored/orig)'''
+    xfms_dir = reg_settings['xfms_dir']
+    T1wImage = reg_settings['T1wImage']
     run(['applywarp', '--rel', '--interp=trilinear',
-         '-i', os.path.join(src_dir, T1wImage),
-         '-r', standard_T1wImage, '-w', os.path.join(xfms_dir, AtlasTransform_NonLinear),
-         '--premat={}'.format(os.path.join(xfms_dir,AtlasTransform_Linear)),
-         '-o', os.path.join(dest_dir, T1wImage)], dryrun=DRYRUN)
+         '-i', os.path.join(reg_settings['src_dir'], T1wImage),
+         '-r', reg_settings['standard_T1wImage']] +
+         nonlinear_warp_args(reg_settings) +
+         ['--premat={}'.format(os.path.join(xfms_dir,
+                reg_settings['AtlasTransform_Linear'])),
+         '-o', os.path.join(reg_settings['dest_dir'], T1wImage)], dryrun=DRYRUN)
 
 def apply_nonlinear_warp_to_nifti_rois(image, reg_settings, hcp_templates,
                                        import_labels=True):
@@ -704,31 +1133,40 @@ def apply_nonlinear_warp_to_nifti_rois(image, reg_settings, hcp_templates,
     settings from reg_settings
     '''
     image_src = os.path.join(reg_settings['src_dir'], '{}.nii.gz'.format(image))
-    fs_labels = os.path.join(hcp_templates, 'hcp_config',
-            'FreeSurferAllLut.txt')
+    fs_labels = fs_lut_path(hcp_templates)
     if os.path.isfile(image_src):
         image_dest = os.path.join(reg_settings['dest_dir'],
                 '{}.nii.gz'.format(image))
-        run(['applywarp', '--rel', '--interp=nn',
+        applywarp_cmd = ['applywarp', '--rel', '--interp=nn',
              '-i', image_src,
-             '-r', os.path.join(reg_settings['dest_dir'],
-                    reg_settings['T1wImage']),
-             '-w', os.path.join(reg_settings['xfms_dir'],
-                    reg_settings['AtlasTransform_NonLinear']),
-             '--premat={}'.format(os.path.join(reg_settings['xfms_dir'],
-                    reg_settings['AtlasTransform_Linear'])),
-             '-o', image_dest], dryrun=DRYRUN)
+             '-r', reg_settings['standard_T1wImage']] + \
+             nonlinear_warp_args(reg_settings) + \
+             ['--premat={}'.format(os.path.join(reg_settings['xfms_dir'],
+                    reg_settings['AtlasTransform_Linear']))]
         if import_labels:
-            run(['wb_command', '-volume-label-import', '-logging', 'SEVERE',
-                    image_dest, fs_labels, image_dest, '-drop-unused-labels'],
-                    dryrun=DRYRUN)
+            applywarp_and_import_labels(applywarp_cmd, fs_labels, image_dest)
+        else:
+            run(applywarp_cmd + ['-o', image_dest], dryrun=DRYRUN)
+
+def applywarp_and_import_labels(applywarp_cmd, labels, image_dest):
+    '''
+    Runs the applywarp_cmd (without its -o option) and imports the label
+    table to the result with wb_command -volume-label-import, writing
+    image_dest. The applywarp output is only read by the label import, so it
+    goes to RAM_DIR when there is one.
+    '''
+    with ciftify.utils.TempDir(dir=RAM_DIR) as warp_dir:
+        warped = os.path.join(warp_dir, os.path.basename(image_dest))
+        run(applywarp_cmd + ['-o', warped], dryrun=DRYRUN)
+        run(['wb_command', '-logging', 'SEVERE', '-volume-label-import',
+                warped, labels, image_dest, '-drop-unused-labels'],
+                dryrun=DRYRUN)
 
 def add_anat_images_to_spec_files(meshes, subject_id, img_type='T1wImage'):
     '''add all the T1wImages to their associated spec_files'''
     for mesh in meshes.values():
-         run(['wb_command', '-add-to-spec-file',
-              os.path.realpath(spec_file(subject_id, mesh)),
-              'INVALID', os.path.realpath(mesh[img_type])], dryrun=DRYRUN)
+         add_to_spec_file(os.path.realpath(spec_file(subject_id, mesh)),
+                 'INVALID', os.path.realpath(mesh[img_type]))
 
 ## Step 1.5 Create Subcortical ROIs  ###########################
 
@@ -737,56 +1175,66 @@ def create_cifti_subcortical_ROIs(atlas_space_folder, settings, temp_dir):
     defines the subcortical ROI labels for cifti files combines a template ROI
     masks with the participants freesurfer wmparc output to do so
     '''
-    # The template files required for this section
-    freesurfer_labels = os.path.join(settings.ciftify_data_dir, 'hcp_config',
-            'FreeSurferAllLut.txt')
-    grayord_space_dir = os.path.join(settings.ciftify_data_dir, '91282_Greyordinates')
-    subcortical_gray_labels = os.path.join(settings.ciftify_data_dir, 'hcp_config',
-            'FreeSurferSubcorticalLabelTableLut.txt')
-    avg_wmparc = os.path.join(settings.ciftify_data_dir, 'standard_mesh_atlases',
-            'Avgwmparc.nii.gz')
-
     ## right now we only have a template for the 2mm greyordinate space..
-    for grayord_res in settings.grayord_res:
-        ## The outputs of this sections
-        atlas_ROIs = os.path.join(atlas_space_folder, 'ROIs',
-                'Atlas_ROIs.{}.nii.gz'.format(grayord_res))
-        wmparc_ROIs = os.path.join(temp_dir,
-                'wmparc.{}.nii.gz'.format(grayord_res))
-        wmparc_atlas_ROIs = os.path.join(temp_dir,
-                'Atlas_wmparc.{}.nii.gz'.format(grayord_res))
-        ROIs_nii = os.path.join(atlas_space_folder, 'ROIs',
-                'ROIs.{}.nii.gz'.format(grayord_res))
-
-        ## linking this file into the subjects folder because func2hcp needs it
-        link_to_template_file(settings, atlas_ROIs,
-                os.path.join(grayord_space_dir,
-                        'Atlas_ROIs.{}.nii.gz'.format(grayord_res)),
-                via_file='Atlas_ROIs.{}.nii.gz'.format(grayord_res))
-
-        ## the analysis steps - resample the participants wmparc output the
-        ## greyordinate resolution
-        run(['applywarp', '--interp=nn', '-i', os.path.join(atlas_space_folder,
-            'wmparc.nii.gz'), '-r', atlas_ROIs, '-o', wmparc_ROIs], dryrun=DRYRUN)
-        ## import the label metadata
-        run(['wb_command', '-logging', 'SEVERE', '-volume-label-import', wmparc_ROIs,
-            freesurfer_labels, wmparc_ROIs, '-drop-unused-labels'], dryrun=DRYRUN)
-        ## These commands were used in the original fs2hcp script, Erin
-        ## discovered they are probably not being used. Leaving these commands
-        ## here, though, just in case
-        #   run(['applywarp', '--interp=nn', '-i', Avgwmparc, '-r', Atlas_ROIs,
-        #       '-o', wmparcAtlas_ROIs])
-        #   run(['wb_command', '-volume-label-import',
-        #     wmparcAtlas_ROIs, FreeSurferLabels,  wmparcAtlas_ROIs,
-        #     '-drop-unused-labels'])
-        run(['wb_command', '-logging', 'SEVERE', '-volume-label-import', wmparc_ROIs,
-            subcortical_gray_labels, ROIs_nii,'-discard-others'], dryrun=DRYRUN)
+    templates = subcortical_template_files(settings.ciftify_data_dir)
+    ## each resolution is independent, so they are made at the same time
+    run_many([(create_cifti_subcortical_ROIs_for_res, grayord_res,
+            atlas_space_folder, templates, temp_dir, settings)
+            for grayord_res in settings.grayord_res])
+
+@functools.lru_cache()
+def subcortical_template_files(ciftify_data_dir):
+    '''The template files required to make the subcortical ROIs'''
+    return {
+        'grayord_space_dir': os.path.join(ciftify_data_dir,
+                '91282_Greyordinates'),
+        'subcortical_gray_labels': os.path.join(ciftify_data_dir,
+                'hcp_config', 'FreeSurferSubcorticalLabelTableLut.txt'),
+        'avg_wmparc': os.path.join(ciftify_data_dir, 'standard_mesh_atlases',
+                'Avgwmparc.nii.gz')}
+
+def create_cifti_subcortical_ROIs_for_res(grayord_res, atlas_space_folder,
+        templates, temp_dir, settings):
+    '''make the subcortical ROIs for one greyordinate resolution'''
+    ## The outputs of this sections
+    atlas_ROIs = os.path.join(atlas_space_folder, 'ROIs',
+            'Atlas_ROIs.{}.nii.gz'.format(grayord_res))
+    wmparc_ROIs = os.path.join(temp_dir,
+            'wmparc.{}.nii.gz'.format(grayord_res))
+    wmparc_atlas_ROIs = os.path.join(temp_dir,
+            'Atlas_wmparc.{}.nii.gz'.format(grayord_res))
+    ROIs_nii = os.path.join(atlas_space_folder, 'ROIs',
+            'ROIs.{}.nii.gz'.format(grayord_res))
+
+    ## linking this file into the subjects folder because func2hcp needs it
+    link_to_template_file(settings, atlas_ROIs,
+            os.path.join(templates['grayord_space_dir'],
+                    'Atlas_ROIs.{}.nii.gz'.format(grayord_res)),
+            via_file='Atlas_ROIs.{}.nii.gz'.format(grayord_res))
+
+    ## the analysis steps - resample the participants wmparc output the
+    ## greyordinate resolution. The subcortical label table is imported
+    ## straight onto the resampled values below, importing the full
+    ## freesurfer table first would only be discarded again
+    run(['applywarp', '--interp=nn', '-i',
+        os.path.join(atlas_space_folder, 'wmparc.nii.gz'), '-r', atlas_ROIs,
+        '-o', wmparc_ROIs], dryrun=DRYRUN)
+    ## These commands were used in the original fs2hcp script, Erin
+    ## discovered they are probably not being used. Leaving these commands
+    ## here, though, just in case
+    #   run(['applywarp', '--interp=nn', '-i', Avgwmparc, '-r', Atlas_ROIs,
+    #       '-o', wmparcAtlas_ROIs])
+    #   run(['wb_command', '-volume-label-import',
+    #     wmparcAtlas_ROIs, FreeSurferLabels,  wmparcAtlas_ROIs,
+    #     '-drop-unused-labels'])
+    run(['wb_command', '-logging', 'SEVERE', '-volume-label-import', wmparc_ROIs,
+        templates['subcortical_gray_labels'], ROIs_nii,'-discard-others'], dryrun=DRYRUN)
 
 ## Step 1.4 Conversion of other formats ###########################
 
 def convert_FS_surfaces_to_gifti(subject_id, freesurfer_subject_dir, meshes,
                                  reg_settings, temp_dir):
-    logger.info(section_header("Converting freesurfer surfaces to gifti"))
+    log_section("Converting freesurfer surfaces to gifti")
 
     # Find c_ras offset between FreeSurfer surface and volume and generate
     # matrix to transform surfaces
@@ -814,46 +1262,55 @@ def convert_FS_surfaces_to_gifti(subject_id, freesurfer_subject_dir, meshes,
 def write_cras_file(freesurfer_folder, cras_mat):
     '''read info about the surface affine matrix from freesurfer output and
     write it to a tmpfile'''
-    mri_info = get_stdout(['mri_info', os.path.join(freesurfer_folder, 'mri',
-            'brain.finalsurfs.mgz')])
-
-    for line in mri_info.split(os.linesep):
-        if 'c_r' in line:
-            bitscr = line.split('=')[4]
-            matrix_x = bitscr.replace(' ','')
-        elif 'c_a' in line:
-            bitsca = line.split('=')[4]
-            matrix_y = bitsca.replace(' ','')
-        elif 'c_s' in line:
-            bitscs = line.split('=')[4]
-            matrix_z = bitscs.replace(' ','')
-
-    with open(cras_mat, 'w') as cfile:
-        cfile.write('1 0 0 {}\n'.format(matrix_x))
-        cfile.write('0 1 0 {}\n'.format(matrix_y))
-        cfile.write('0 0 1 {}\n'.format(matrix_z))
-        cfile.write('0 0 0 1{}\n')
+    finalsurfs_mgz = os.path.join(freesurfer_folder, 'mri',
+            'brain.finalsurfs.mgz')
+    ## the c_ras that mri_info reports, read straight from the mgh header
+    try:
+        c_ras = nib.load(finalsurfs_mgz).header['Pxyz_c']
+    except Exception as err:
+        logger.error("Could not read c_ras from {}: {}".format(finalsurfs_mgz,
+                err))
+        sys.exit(1)
+
+    cras_affine = np.eye(4)
+    cras_affine[:3, 3] = c_ras
+    np.savetxt(cras_mat, cras_affine, fmt=['%g', '%g', '%g', '%.6f'])
+
+@functools.lru_cache()
+def files_in_dir(directory):
+    '''
+    The names of the files in a directory that is not written to during the
+    run (i.e. the templates or the freesurfer label folder). Reading it once
+    replaces an os.path.exists call for each file looked for.
+    '''
+    try:
+        return frozenset(os.listdir(directory))
+    except OSError:
+        return frozenset()
 
 def convert_freesurfer_annot(subject_id, label_name, fs_folder,
                              dest_mesh_settings):
     ''' convert a freesurfer annot to a gifti label and set metadata'''
-    for hemisphere, structure in [('L', 'CORTEX_LEFT'), ('R', 'CORTEX_RIGHT')]:
-        fs_annot = os.path.join(fs_folder, 'label',
-                '{}h.{}.annot'.format(hemisphere.lower(), label_name))
-        if os.path.exists(fs_annot):
-            label_gii = label_file(subject_id, label_name, hemisphere,
-                    dest_mesh_settings)
-            run(['mris_convert', '--annot', fs_annot,
-                os.path.join(fs_folder, 'surf',
-                        '{}h.white'.format(hemisphere.lower())),
-                label_gii], suppress_stderr = True, dryrun=DRYRUN)
-            run(['wb_command', '-set-structure', label_gii, structure],
-                    dryrun=DRYRUN)
-            run(['wb_command', '-set-map-names', label_gii,
-                '-map', '1', '{}_{}_{}'.format(subject_id, hemisphere,
-                label_name)], dryrun=DRYRUN)
-            run(['wb_command', '-gifti-label-add-prefix',
-                label_gii, '{}_'.format(hemisphere), label_gii], dryrun=DRYRUN)
+    run_per_hemisphere(convert_freesurfer_annot_hemisphere, subject_id,
+            label_name, fs_folder, dest_mesh_settings)
+
+def convert_freesurfer_annot_hemisphere(hemisphere, structure, subject_id,
+        label_name, fs_folder, dest_mesh_settings):
+    fs_label_dir = os.path.join(fs_folder, 'label')
+    fs_annot_name = '{}h.{}.annot'.format(hemisphere.lower(), label_name)
+    if fs_annot_name not in files_in_dir(fs_label_dir):
+        return
+    fs_annot = os.path.join(fs_label_dir, fs_annot_name)
+    label_gii = label_file(subject_id, label_name, hemisphere,
+            dest_mesh_settings)
+    freesurfer_to_gifti(ciftify.niio.freesurfer_annot_to_gifti, fs_annot,
+            label_gii)
+    set_structure(label_gii, structure)
+    run(['wb_command', '-set-map-names', label_gii,
+        '-map', '1', '{}_{}_{}'.format(subject_id, hemisphere,
+        label_name)], dryrun=DRYRUN)
+    run(['wb_command', '-gifti-label-add-prefix',
+        label_gii, '{}_'.format(hemisphere), label_gii], dryrun=DRYRUN)
 
 def apply_nonlinear_warp_to_surface(subject_id, surface, reg_settings, meshes):
     '''
@@ -868,27 +1325,36 @@ def apply_nonlinear_warp_to_surface(subject_id, surface, reg_settings, meshes):
         meshes              A dictionary of settings (i.e. naming conventions)
                             related to surfaces
     '''
+    dest_mesh_settings = meshes[reg_settings['dest_mesh']]
+    surfs_dest = run_per_hemisphere(apply_nonlinear_warp_to_surface_hemisphere,
+            subject_id, surface, reg_settings, meshes)
+    for (hemisphere, structure), surf_dest in zip(HEMISPHERES, surfs_dest):
+        add_to_spec_file(spec_file(subject_id, dest_mesh_settings),
+                structure, surf_dest)
+
+def apply_nonlinear_warp_to_surface_hemisphere(hemisphere, structure,
+        subject_id, surface, reg_settings, meshes):
     src_mesh_settings = meshes[reg_settings['src_mesh']]
     dest_mesh_settings = meshes[reg_settings['dest_mesh']]
     xfms_dir = reg_settings['xfms_dir']
-    for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-        # Native mesh processing
-        # Convert and volumetrically register white and pial surfaces making
-        # linear and nonlinear copies, add each to the appropriate spec file
-        surf_src = surf_file(subject_id, surface, hemisphere, src_mesh_settings)
-        surf_dest = surf_file(subject_id, surface, hemisphere, dest_mesh_settings)
-
-        ## MNI transform the surfaces into the MNINonLinear/Native Folder
-        run(['wb_command', '-surface-apply-affine', surf_src,
-            os.path.join(xfms_dir, reg_settings['AtlasTransform_Linear']),
-            surf_dest, '-flirt', src_mesh_settings['T1wImage'],
-            reg_settings['standard_T1wImage']])
-        run(['wb_command', '-surface-apply-warpfield', surf_dest,
-            os.path.join(xfms_dir, reg_settings['InverseAtlasTransform_NonLinear']),
-            surf_dest, '-fnirt', os.path.join(xfms_dir,
-            reg_settings['AtlasTransform_NonLinear'])])
-        run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-            dest_mesh_settings), structure, surf_dest])
+    # Native mesh processing
+    # Convert and volumetrically register white and pial surfaces making
+    # linear and nonlinear copies
+    surf_src = surf_file(subject_id, surface, hemisphere, src_mesh_settings)
+    surf_dest = surf_file(subject_id, surface, hemisphere, dest_mesh_settings)
+
+    ## MNI transform the surfaces into the MNINonLinear/Native Folder
+    run(['wb_command', '-surface-apply-affine', surf_src,
+        os.path.join(xfms_dir, reg_settings['AtlasTransform_Linear']),
+        surf_dest, '-flirt', src_mesh_settings['T1wImage'],
+        reg_settings['standard_T1wImage']])
+    if reg_settings.get('skip_nonlinear'):
+        return surf_dest
+    run(['wb_command', '-surface-apply-warpfield', surf_dest,
+        os.path.join(xfms_dir, reg_settings['InverseAtlasTransform_NonLinear']),
+        surf_dest, '-fnirt', os.path.join(xfms_dir,
+        reg_settings['AtlasTransform_NonLinear'])])
+    return surf_dest
 
 def convert_freesurfer_surface(subject_id, surface, surface_type, fs_subject_dir,
         dest_mesh_settings, surface_secondary_type=None, cras_mat=None,
@@ -905,95 +1371,125 @@ def convert_freesurfer_surface(subject_id, surface, surface_type, fs_subject_dir
         cras_mat                    Path to the freesurfer affine matrix
         add_to_spec                 Whether to add the gifti file the spec file
     '''
-    for hemisphere, structure in [('L', 'CORTEX_LEFT'), ('R', 'CORTEX_RIGHT')]:
-        surf_fs = os.path.join(fs_subject_dir, 'surf',
-                '{}h.{}'.format(hemisphere.lower(), surface))
-        surf_native = surf_file(subject_id, surface, hemisphere,
-                dest_mesh_settings)
-        ## convert the surface into the T1w/Native Folder
-        run(['mris_convert',surf_fs, surf_native], dryrun=DRYRUN)
-
-        set_structure_command = ['wb_command', '-set-structure', surf_native,
-                structure, '-surface-type', surface_type]
-        if surface_secondary_type:
-            set_structure_command.extend(['-surface-secondary-type',
-                    surface_secondary_type])
-        run(set_structure_command, dryrun=DRYRUN)
-
-        if cras_mat:
-            run(['wb_command', '-surface-apply-affine', surf_native,
-                    cras_mat, surf_native], dryrun=DRYRUN)
-        if add_to_spec:
-            run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-                    dest_mesh_settings), structure, surf_native], dryrun=DRYRUN)
+    surfs_native = run_per_hemisphere(convert_freesurfer_surface_hemisphere,
+            subject_id, surface, surface_type, fs_subject_dir,
+            dest_mesh_settings, surface_secondary_type, cras_mat)
+    if not add_to_spec:
+        return
+    for (hemisphere, structure), surf_native in zip(HEMISPHERES, surfs_native):
+        add_to_spec_file(spec_file(subject_id, dest_mesh_settings),
+                structure, surf_native)
+
+def convert_freesurfer_surface_hemisphere(hemisphere, structure, subject_id,
+        surface, surface_type, fs_subject_dir, dest_mesh_settings,
+        surface_secondary_type, cras_mat):
+    surf_fs = os.path.join(fs_subject_dir, 'surf',
+            '{}h.{}'.format(hemisphere.lower(), surface))
+    surf_native = surf_file(subject_id, surface, hemisphere,
+            dest_mesh_settings)
+    ## convert the surface into the T1w/Native Folder
+    freesurfer_to_gifti(ciftify.niio.freesurfer_surface_to_gifti, surf_fs,
+            surf_native)
+
+    set_structure_command = ['wb_command', '-set-structure', surf_native,
+            structure, '-surface-type', surface_type]
+    if surface_secondary_type:
+        set_structure_command.extend(['-surface-secondary-type',
+                surface_secondary_type])
+    commands = [set_structure_command]
+
+    if cras_mat:
+        commands.append(['wb_command', '-surface-apply-affine', surf_native,
+                cras_mat, surf_native])
+    run_chain(commands, dryrun=DRYRUN)
+    return surf_native
 
 def convert_freesurfer_maps(subject_id, map_dict, fs_folder,
                             dest_mesh_settings):
     ''' Convert a freesurfer data (thickness, curv, sulc) to a gifti metric
     and set metadata'''
-    for hemisphere, structure in [('L', 'CORTEX_LEFT'), ('R', 'CORTEX_RIGHT')]:
-        map_gii = metric_file(subject_id, map_dict['mapname'], hemisphere,
-                dest_mesh_settings)
-        ## convert the freesurfer files to gifti
-        run(['mris_convert', '-c',
-            os.path.join(fs_folder, 'surf', '{}h.{}'.format(hemisphere.lower(),
-                    map_dict['fsname'])),
-            os.path.join(fs_folder, 'surf',
-                    '{}h.white'.format(hemisphere.lower())),
-            map_gii], dryrun=DRYRUN)
-        ## set a bunch of meta-data and multiply by -1
-        run(['wb_command', '-set-structure', map_gii, structure], dryrun=DRYRUN)
-        run(['wb_command', '-metric-math', '"(var * -1)"',
-            map_gii, '-var', 'var', map_gii], dryrun=DRYRUN)
-        run(['wb_command', '-set-map-names', map_gii,
-            '-map', '1', '{}_{}{}'.format(subject_id, hemisphere,
-            map_dict['map_postfix'])], dryrun=DRYRUN)
-        if map_dict['mapname'] == 'thickness':
-            ## I don't know why but there are thickness specific extra steps
-            # Thickness set thickness at absolute value than set palette metadata
-            run(['wb_command', '-metric-math', '"(abs(thickness))"',
-                map_gii, '-var', 'thickness', map_gii], dryrun=DRYRUN)
-        run(['wb_command', '-metric-palette', map_gii, map_dict['palette_mode'],
-            map_dict['palette_options']], dryrun=DRYRUN)
+    run_per_hemisphere(convert_freesurfer_maps_hemisphere, subject_id,
+            map_dict, fs_folder, dest_mesh_settings)
+
+def convert_freesurfer_maps_hemisphere(hemisphere, structure, subject_id,
+        map_dict, fs_folder, dest_mesh_settings):
+    map_gii = metric_file(subject_id, map_dict['mapname'], hemisphere,
+            dest_mesh_settings)
+    ## convert the freesurfer files to gifti
+    freesurfer_to_gifti(ciftify.niio.freesurfer_morph_to_gifti,
+        os.path.join(fs_folder, 'surf', '{}h.{}'.format(hemisphere.lower(),
+                map_dict['fsname'])), map_gii)
+    ## set a bunch of meta-data and multiply by -1
+    set_structure(map_gii, structure)
+    if map_dict['mapname'] == 'thickness':
+        ## I don't know why but there are thickness specific extra steps
+        # Thickness is set to its absolute value (which makes multiplying by
+        # -1 unnecessary) than set palette metadata
+        expression = '"(abs(var))"'
+    else:
+        expression = '"(var * -1)"'
+    run(['wb_command', '-metric-math', expression,
+        map_gii, '-var', 'var', map_gii], dryrun=DRYRUN)
+    run(['wb_command', '-set-map-names', map_gii,
+        '-map', '1', '{}_{}{}'.format(subject_id, hemisphere,
+        map_dict['map_postfix'])], dryrun=DRYRUN)
+    run(['wb_command', '-metric-palette', map_gii, map_dict['palette_mode'],
+        map_dict['palette_options']], dryrun=DRYRUN)
 
 ## Step 2.0 Fucntions Called Multiple times ##############################
 
-def make_midthickness_surfaces(subject_id, mesh_settings):
+def make_midthickness_surfaces(subject_id, *meshes_settings):
      '''
      Use the white and pial surfaces from the same mesh to create a midthickness
-     file. Set the midthickness surface metadata and add it to the spec_file
+     file. Set the midthickness surface metadata and add it to the spec_file.
+     When given several meshes, all their surfaces are made at once.
      '''
-     for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-        #Create midthickness by averaging white and pial surfaces
-        mid_surf = surf_file(subject_id, 'midthickness', hemisphere,
-                mesh_settings)
-        run(['wb_command', '-surface-average', mid_surf,
-            '-surf', surf_file(subject_id, 'white', hemisphere, mesh_settings),
-            '-surf', surf_file(subject_id, 'pial', hemisphere, mesh_settings)],
-            dryrun=DRYRUN)
-        run(['wb_command', '-set-structure', mid_surf, structure,
-            '-surface-type', 'ANATOMICAL', '-surface-secondary-type',
-            'MIDTHICKNESS'], dryrun=DRYRUN)
-        run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-            mesh_settings), structure, mid_surf], dryrun=DRYRUN)
+     mid_surfs = run_per_mesh_and_hemisphere(
+             make_midthickness_surface_hemisphere, subject_id, meshes_settings)
+     for mesh_settings, mesh_surfs in zip(meshes_settings, mid_surfs):
+        for (hemisphere, structure), mid_surf in zip(HEMISPHERES, mesh_surfs):
+            add_to_spec_file(spec_file(subject_id, mesh_settings), structure,
+                    mid_surf)
+
+def make_midthickness_surface_hemisphere(hemisphere, structure, subject_id,
+        mesh_settings):
+    #Create midthickness by averaging white and pial surfaces
+    mid_surf = surf_file(subject_id, 'midthickness', hemisphere,
+            mesh_settings)
+    run(['wb_command', '-surface-average', mid_surf,
+        '-surf', surf_file(subject_id, 'white', hemisphere, mesh_settings),
+        '-surf', surf_file(subject_id, 'pial', hemisphere, mesh_settings)],
+        dryrun=DRYRUN)
+    run(['wb_command', '-set-structure', mid_surf, structure,
+        '-surface-type', 'ANATOMICAL', '-surface-secondary-type',
+        'MIDTHICKNESS'], dryrun=DRYRUN)
+    return mid_surf
 
-def make_inflated_surfaces(subject_id, mesh_settings, iterations_scale=2.5):
+def make_inflated_surfaces(subject_id, *meshes_settings, iterations_scale=2.5):
     '''
     Make inflated and very_inflated surfaces from the mid surface of the
-    specified mesh. Adds the surfaces to the spec_file
+    specified mesh. Adds the surfaces to the spec_file. When given several
+    meshes, all their surfaces are made at once.
     '''
-    for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-        infl_surf = surf_file(subject_id, 'inflated', hemisphere, mesh_settings)
-        vinfl_surf = surf_file(subject_id, 'very_inflated', hemisphere,
-                mesh_settings)
-        run(['wb_command', '-surface-generate-inflated',
-            surf_file(subject_id, 'midthickness', hemisphere, mesh_settings),
-            infl_surf, vinfl_surf, '-iterations-scale', str(iterations_scale)],
-            dryrun=DRYRUN)
-        run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-            mesh_settings), structure, infl_surf], dryrun=DRYRUN)
-        run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-            mesh_settings), structure, vinfl_surf], dryrun=DRYRUN)
+    inflated_surfs = run_per_mesh_and_hemisphere(
+            make_inflated_surfaces_hemisphere, subject_id, meshes_settings,
+            iterations_scale)
+    for mesh_settings, mesh_surfs in zip(meshes_settings, inflated_surfs):
+        for (hemisphere, structure), surfs in zip(HEMISPHERES, mesh_surfs):
+            for surf in surfs:
+                add_to_spec_file(spec_file(subject_id, mesh_settings),
+                        structure, surf)
+
+def make_inflated_surfaces_hemisphere(hemisphere, structure, subject_id,
+        mesh_settings, iterations_scale):
+    infl_surf = surf_file(subject_id, 'inflated', hemisphere, mesh_settings)
+    vinfl_surf = surf_file(subject_id, 'very_inflated', hemisphere,
+            mesh_settings)
+    run(['wb_command', '-surface-generate-inflated',
+        surf_file(subject_id, 'midthickness', hemisphere, mesh_settings),
+        infl_surf, vinfl_surf, '-iterations-scale', str(iterations_scale)],
+        dryrun=DRYRUN)
+    return infl_surf, vinfl_surf
 
 def create_dscalar(subject_id, mesh_settings, dscalar_entry):
     '''
@@ -1013,25 +1509,32 @@ def create_dscalar(subject_id, mesh_settings, dscalar_entry):
     right_metric = metric_file(subject_id, dscalar_entry['mapname'], 'R',
             mesh_settings)
 
+    ## the map name is given at creation time with -name-file, rather than
+    ## with a separate -set-map-names call
+    name_file = os.path.join(mesh_settings['tmpdir'],
+            '{}.{}.{}.names.txt'.format(subject_id, dscalar_entry['mapname'],
+            mesh_settings['meshname']))
+    if not DRYRUN:
+        with open(name_file, 'w') as names:
+            names.write("{}{}\n".format(subject_id, dscalar_entry['map_postfix']))
+
     ## combine left and right metrics into a dscalar file
+    create_cmd = ['wb_command', '-cifti-create-dense-scalar', dscalar_file,
+            '-left-metric', left_metric]
     if dscalar_entry['mask_medialwall']:
-        run(['wb_command', '-cifti-create-dense-scalar', dscalar_file,
-            '-left-metric', left_metric,'-roi-left',
-            medial_wall_roi_file(subject_id, 'L', mesh_settings),
-            '-right-metric', right_metric,'-roi-right',
-            medial_wall_roi_file(subject_id, 'R', mesh_settings)], dryrun=DRYRUN)
-    else :
-        run(['wb_command', '-cifti-create-dense-scalar', dscalar_file,
-                '-left-metric', left_metric, '-right-metric', right_metric],
-                dryrun=DRYRUN)
+        create_cmd.extend(['-roi-left',
+                medial_wall_roi_file(subject_id, 'L', mesh_settings)])
+    create_cmd.extend(['-right-metric', right_metric])
+    if dscalar_entry['mask_medialwall']:
+        create_cmd.extend(['-roi-right',
+                medial_wall_roi_file(subject_id, 'R', mesh_settings)])
+    create_cmd.extend(['-name-file', name_file])
 
-    ## set the dscalar file metadata
-    run(['wb_command', '-set-map-names', dscalar_file,
-        '-map', '1', "{}{}".format(subject_id, dscalar_entry['map_postfix'])],
-        dryrun=DRYRUN)
-    run(['wb_command', '-cifti-palette', dscalar_file,
-        dscalar_entry['palette_mode'], dscalar_file,
-        dscalar_entry['palette_options']], dryrun=DRYRUN)
+    ## set the dscalar file palette
+    run_chain([create_cmd,
+            ['wb_command', '-cifti-palette', dscalar_file,
+            dscalar_entry['palette_mode'], dscalar_file,
+            dscalar_entry['palette_options']]], dryrun=DRYRUN)
 
 def create_dlabel(subject_id, mesh_settings, label_name):
     '''
@@ -1050,15 +1553,15 @@ def create_dlabel(subject_id, mesh_settings, label_name):
         logger.warning("label file {} does not exist. Skipping dlabel creation."
                 "".format(left_label))
         return
-    ## combine left and right metrics into a dscalar file
-    run(['wb_command', '-cifti-create-label', dlabel_file,
+    ## combine left and right metrics into a dscalar file and set the
+    ## metadata, -cifti-create-label has no option for the map name
+    run_chain([['wb_command', '-cifti-create-label', dlabel_file,
         '-left-label', left_label,'-roi-left',
         medial_wall_roi_file(subject_id, 'L', mesh_settings),
         '-right-label', right_label,'-roi-right',
-        medial_wall_roi_file(subject_id, 'R', mesh_settings)], dryrun=DRYRUN)
-    ## set the dscalar file metadata
-    run(['wb_command', '-set-map-names', dlabel_file, '-map', '1',
-        "{}_{}".format(subject_id, label_name)], dryrun=DRYRUN)
+        medial_wall_roi_file(subject_id, 'R', mesh_settings)],
+        ['wb_command', '-set-map-names', dlabel_file, '-map', '1',
+        "{}_{}".format(subject_id, label_name)]], dryrun=DRYRUN)
 
 def add_dense_maps_to_spec_file(subject_id, mesh_settings,
                                 dscalar_types, expected_labels):
@@ -1067,39 +1570,46 @@ def add_dense_maps_to_spec_file(subject_id, mesh_settings,
         maps_folder = mesh_settings['DenseMapsFolder']
     else:
         maps_folder = mesh_settings['Folder']
+    ## the maps are not links themselves, so only the folders need resolving
+    maps_folder = os.path.realpath(maps_folder)
+    spec = os.path.realpath(spec_file(subject_id, mesh_settings))
 
     for dscalar in dscalar_types:
-        run(['wb_command', '-add-to-spec-file',
-            os.path.realpath(spec_file(subject_id, mesh_settings)), 'INVALID',
-            os.path.realpath(os.path.join(maps_folder,
-                    '{}.{}.{}.dscalar.nii'.format(subject_id, dscalar,
-                    mesh_settings['meshname'])))], dryrun=DRYRUN)
-
+        add_to_spec_file(spec, 'INVALID', os.path.join(maps_folder,
+                '{}.{}.{}.dscalar.nii'.format(subject_id, dscalar,
+                mesh_settings['meshname'])))
+
+    ## the dlabels were just written, so the folder is listed here (once)
+    ## rather than with the cached files_in_dir()
+    try:
+        with os.scandir(maps_folder) as entries:
+            present = {entry.name: entry.path for entry in entries}
+    except OSError:
+        present = {}
     for label_name in expected_labels:
         file_name = "{}.{}.{}.dlabel.nii".format(subject_id, label_name,
                 mesh_settings['meshname'])
-        dlabel_file = os.path.realpath(os.path.join(maps_folder, file_name))
-        if not os.path.exists(dlabel_file):
+        dlabel_file = present.get(file_name)
+        if not dlabel_file:
             logger.debug("dlabel file {} does not exist, skipping".format(
-                    dlabel_file))
+                    os.path.join(maps_folder, file_name)))
             continue
-        run(['wb_command', '-add-to-spec-file', os.path.realpath(spec_file(
-                subject_id, mesh_settings)), 'INVALID', dlabel_file],
-                dryrun=DRYRUN)
+        add_to_spec_file(spec, 'INVALID', dlabel_file)
 
 def copy_colin_flat_and_add_to_spec(subject_id, settings, mesh_settings):
     ''' Copy the colin flat atlas out of the templates folder and add it to
     the spec file. '''
+    atlas_dir = os.path.join(settings.ciftify_data_dir, 'standard_mesh_atlases')
     for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-        colin_src = os.path.join(settings.ciftify_data_dir, 'standard_mesh_atlases',
-            'colin.cerebral.{}.flat.{}.surf.gii'.format(hemisphere,
-            mesh_settings['meshname']))
-        if not os.path.exists(colin_src):
+        colin_basename = 'colin.cerebral.{}.flat.{}.surf.gii'.format(hemisphere,
+                mesh_settings['meshname'])
+        if colin_basename not in files_in_dir(atlas_dir):
             continue
+        colin_src = os.path.join(atlas_dir, colin_basename)
         colin_dest = surf_file(subject_id, 'flat', hemisphere, mesh_settings)
         link_to_template_file(settings, colin_dest, colin_src, os.path.basename(colin_src))
-        run(['wb_command', '-add-to-spec-file', spec_file(subject_id,
-            mesh_settings), structure, colin_dest], dryrun=DRYRUN)
+        add_to_spec_file(spec_file(subject_id, mesh_settings), structure,
+                colin_dest)
 
 def make_dense_map(subject_id, mesh, dscalars, expected_labels):
     ## combine L and R metrics into dscalar files
@@ -1131,34 +1641,36 @@ def copy_sphere_mesh_from_template(settings, mesh_settings):
                 sphere_basename)
         sphere_dest = surf_file(settings.subject.id, 'sphere', hemisphere, mesh_settings)
         link_to_template_file(settings, sphere_dest, sphere_src, sphere_basename)
-        run(['wb_command', '-add-to-spec-file', spec_file(settings.subject.id,
-            mesh_settings), structure, sphere_dest], dryrun=DRYRUN)
+        add_to_spec_file(spec_file(settings.subject.id, mesh_settings),
+                structure, sphere_dest)
 
 def copy_atlas_roi_from_template(settings, mesh_settings):
     '''Copy the atlas roi (roi of medial wall) for a specific mesh out of
     templates'''
+    atlas_dir = os.path.join(settings.ciftify_data_dir, 'standard_mesh_atlases')
     for hemisphere in ['L', 'R']:
         roi_basename = '{}.atlasroi.{}.shape.gii'.format(hemisphere,
                 mesh_settings['meshname'])
-        roi_src = os.path.join(settings.ciftify_data_dir, 'standard_mesh_atlases',
-                roi_basename)
-        if os.path.exists(roi_src):
+        roi_src = os.path.join(atlas_dir, roi_basename)
+        if roi_basename in files_in_dir(atlas_dir):
             ## Copying sphere surface from templates file to subject folder
             roi_dest = medial_wall_roi_file(settings.subject.id, hemisphere,
                     mesh_settings)
             link_to_template_file(settings, roi_dest, roi_src, roi_basename)
 
 def process_native_meshes(subject, meshes, dscalars, expected_labels):
-    logger.info(section_header("Creating midthickness, inflated and "
-            "very_inflated surfaces"))
-    for mesh_name in ['T1wNative', 'AtlasSpaceNative']:
-        ## build midthickness out the white and pial
-        make_midthickness_surfaces(subject.id, meshes[mesh_name])
-        # make inflated surfaces from midthickness
-        make_inflated_surfaces(subject.id, meshes[mesh_name])
+    log_section("Creating midthickness, inflated and "
+            "very_inflated surfaces")
+    ## the two native meshes are independent, so the surfaces for both
+    ## meshes and both hemispheres are made at the same time
+    native_meshes = [meshes['T1wNative'], meshes['AtlasSpaceNative']]
+    ## build midthickness out the white and pial
+    make_midthickness_surfaces(subject.id, *native_meshes)
+    # make inflated surfaces from midthickness
+    make_inflated_surfaces(subject.id, *native_meshes)
 
     # Convert freesurfer annotation to gifti labels and set meta-data
-    logger.info(section_header("Converting Freesurfer measures to gifti"))
+    log_section("Converting Freesurfer measures to gifti")
     for label_name in expected_labels:
         convert_freesurfer_annot(subject.id, label_name, subject.fs_folder,
                 meshes['AtlasSpaceNative'])
@@ -1174,21 +1686,25 @@ def process_native_meshes(subject, meshes, dscalars, expected_labels):
 
 def medial_wall_rois_from_thickness_maps(subject_id, mesh_settings):
     '''create an roi file by thresholding the thickness surfaces'''
-    for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-        ## create the native ROI file using the thickness file
-        native_roi =  medial_wall_roi_file(subject_id, hemisphere,
-                mesh_settings)
-        midthickness_gii = surf_file(subject_id, 'midthickness', hemisphere,
-                mesh_settings)
-        run(['wb_command', '-metric-math', '"(thickness > 0)"', native_roi,
-            '-var', 'thickness', metric_file(subject_id, 'thickness', hemisphere,
-            mesh_settings)], dryrun=DRYRUN)
-        run(['wb_command', '-metric-fill-holes', midthickness_gii, native_roi,
-            native_roi], dryrun=DRYRUN)
-        run(['wb_command', '-metric-remove-islands', midthickness_gii,
-            native_roi, native_roi], dryrun=DRYRUN)
-        run(['wb_command', '-set-map-names', native_roi, '-map', '1',
-            '{}_{}_ROI'.format(subject_id, hemisphere)], dryrun=DRYRUN)
+    run_per_hemisphere(medial_wall_roi_from_thickness_map_hemisphere,
+            subject_id, mesh_settings)
+
+def medial_wall_roi_from_thickness_map_hemisphere(hemisphere, structure,
+        subject_id, mesh_settings):
+    ## create the native ROI file using the thickness file
+    native_roi =  medial_wall_roi_file(subject_id, hemisphere,
+            mesh_settings)
+    midthickness_gii = surf_file(subject_id, 'midthickness', hemisphere,
+            mesh_settings)
+    run_chain([['wb_command', '-metric-math', '"(thickness > 0)"', native_roi,
+        '-var', 'thickness', metric_file(subject_id, 'thickness', hemisphere,
+        mesh_settings)],
+        ['wb_command', '-metric-fill-holes', midthickness_gii, native_roi,
+        native_roi],
+        ['wb_command', '-metric-remove-islands', midthickness_gii,
+        native_roi, native_roi],
+        ['wb_command', '-set-map-names', native_roi, '-map', '1',
+        '{}_{}_ROI'.format(subject_id, hemisphere)]], dryrun=DRYRUN)
 
 ## Step 3.0 Surface Registration ##################################
 
@@ -1218,8 +1734,8 @@ def run_fs_reg_LR(subject_id, ciftify_data_dir, high_res_mesh, reg_sphere,
                   native_mesh_settings):
     ''' Copy all the template files and do the FS left to right registration'''
 
-    logger.info(section_header("Concatenating Freesurfer Reg with template to "
-            "get fs_LR reg"))
+    log_section("Concatenating Freesurfer Reg with template to "
+            "get fs_LR reg")
 
     surface_atlas_dir = os.path.join(ciftify_data_dir, 'standard_mesh_atlases')
     for hemisphere in ['L', 'R']:
@@ -1250,7 +1766,7 @@ def run_fs_reg_LR(subject_id, ciftify_data_dir, high_res_mesh, reg_sphere,
 def run_MSMSulc_registration(subject, ciftify_data_dir, mesh_settings,
         reg_sphere_name, FS_reg_sphere, msm_config):
 
-    logger.info(section_header("Running MSMSulc surface registration"))
+    log_section("Running MSMSulc surface registration")
     native_settings = mesh_settings['AtlasSpaceNative']
     highres_settings = mesh_settings['HighResMesh']
 
@@ -1258,59 +1774,96 @@ def run_MSMSulc_registration(subject, ciftify_data_dir, mesh_settings,
     MSMSulc_dir = os.path.join(native_settings['Folder'], 'MSMSulc')
     ciftify.utils.make_dir(MSMSulc_dir, DRYRUN)
 
-    for hemisphere, structure in [('L', 'CORTEX_LEFT'), ('R', 'CORTEX_RIGHT')]:
-        ## prepare data for MSMSulc registration
-        ## calculate and affine surface registration to FS mesh
-        native_sphere = surf_file(subject, 'sphere', hemisphere, native_settings)
-        fs_LR_sphere = surf_file(subject, FS_reg_sphere, hemisphere, native_settings)
-        affine_mat = os.path.join(MSMSulc_dir, '{}.mat'.format(hemisphere))
-        affine_rot_gii = os.path.join(MSMSulc_dir, '{}.sphere_rot.surf.gii'.format(hemisphere))
-        run(['wb_command', '-surface-affine-regression',
-                native_sphere, fs_LR_sphere, affine_mat], dryrun=DRYRUN)
-        run(['wb_command', '-surface-apply-affine',
-                native_sphere, affine_mat, affine_rot_gii], dryrun=DRYRUN)
-        run(['wb_command', '-surface-modify-sphere', '-logging', 'SEVERE',
-                affine_rot_gii, "100", affine_rot_gii], dryrun=DRYRUN)
-
-        ## run MSM with affine rotated surf at start point
-        native_rot_sphere = surf_file(subject, 'sphere.rot', hemisphere, native_settings)
-        refsulc_metric = os.path.join(ciftify_data_dir,
-                                      'standard_mesh_atlases',
-                                      '{}.refsulc.{}.shape.gii'.format(hemisphere,
-                                            highres_settings['meshname']))
-
-        run(['cp', affine_rot_gii, native_rot_sphere], dryrun=DRYRUN)
-
-        if not DRYRUN:
-            with cd(MSMSulc_dir):
-                run(['msm', '--conf={}'.format(msm_config),
-                        '--inmesh={}'.format(native_rot_sphere),
-                        '--refmesh={}'.format(surf_file(subject, 'sphere', hemisphere,
-                                highres_settings)),
-                        '--indata={}'.format(metric_file(subject, 'sulc', hemisphere,
-                                native_settings)),
-                        '--refdata={}'.format(refsulc_metric),
-                        '--out={}'.format(os.path.join(MSMSulc_dir,
-                                '{}.'.format(hemisphere)))], dryrun=DRYRUN)
-
-        conf_log = os.path.join(MSMSulc_dir, '{}.logdir'.format(hemisphere),'conf')
-        run(['cp', msm_config, conf_log], dryrun=DRYRUN)
-
-        #copy the MSMSulc outputs into Native folder and calculate Distortion
-        MSMsulc_sphere = surf_file(subject, reg_sphere_name, hemisphere, native_settings)
-        run(['cp', os.path.join(MSMSulc_dir, '{}.sphere.reg.surf.gii'.format(hemisphere)),
-                MSMsulc_sphere], dryrun=DRYRUN)
-        run(['wb_command', '-set-structure', MSMsulc_sphere, structure], dryrun=DRYRUN)
-
-        #Make MSMSulc Registration Areal Distortion Maps
-        calc_areal_distortion_gii(native_sphere, MSMsulc_sphere,
-                metric_file(subject, 'ArealDistortion_MSMSulc', hemisphere, native_settings),
-                '{}_{}_'.format(subject, hemisphere), '_MSMSulc')
-
-        run(['wb_command', '-surface-distortion',
-                native_sphere, MSMsulc_sphere,
-                metric_file(subject, 'EdgeDistortion_MSMSulc',hemisphere, native_settings),
-                '-edge-method'], dryrun=DRYRUN)
+    ## the config is read once here, the hemispheres only archive it again if
+    ## their log does not already hold the same config
+    msm_conf_sha = None if DRYRUN else file_sha1(msm_config)
+
+    ## the hemispheres are registered independently, so both run at once
+    run_per_hemisphere(run_MSMSulc_registration_hemisphere, subject,
+            ciftify_data_dir, native_settings, highres_settings,
+            msmsulc_paths(MSMSulc_dir), reg_sphere_name, FS_reg_sphere,
+            msm_config, msm_conf_sha)
+
+def msmsulc_paths(MSMSulc_dir):
+    '''The files in the MSMSulc folder for each hemisphere, built up front'''
+    return {hemisphere: {
+                'affine_mat': os.path.join(MSMSulc_dir,
+                        '{}.mat'.format(hemisphere)),
+                'affine_rot_gii': os.path.join(MSMSulc_dir,
+                        '{}.sphere_rot.surf.gii'.format(hemisphere)),
+                'out': os.path.join(MSMSulc_dir, '{}.'.format(hemisphere)),
+                'conf_log': os.path.join(MSMSulc_dir,
+                        '{}.logdir'.format(hemisphere), 'conf'),
+                'sphere_reg': os.path.join(MSMSulc_dir,
+                        '{}.sphere.reg.surf.gii'.format(hemisphere))}
+            for hemisphere, _ in HEMISPHERES}
+
+def run_MSMSulc_registration_hemisphere(hemisphere, structure, subject,
+        ciftify_data_dir, native_settings, highres_settings, msm_paths,
+        reg_sphere_name, FS_reg_sphere, msm_config, msm_conf_sha):
+    paths = msm_paths[hemisphere]
+    ## prepare data for MSMSulc registration
+    ## calculate and affine surface registration to FS mesh
+    native_sphere = surf_file(subject, 'sphere', hemisphere, native_settings)
+    fs_LR_sphere = surf_file(subject, FS_reg_sphere, hemisphere, native_settings)
+    affine_mat = paths['affine_mat']
+    affine_rot_gii = paths['affine_rot_gii']
+    ## wb_command has no batch mode, the three steps share one shell instead
+    run_chain([['wb_command', '-surface-affine-regression',
+            native_sphere, fs_LR_sphere, affine_mat],
+        ['wb_command', '-surface-apply-affine',
+            native_sphere, affine_mat, affine_rot_gii],
+        ['wb_command', '-surface-modify-sphere', affine_rot_gii, "100",
+            affine_rot_gii]], dryrun=DRYRUN)
+
+    ## run MSM with affine rotated surf at start point
+    native_rot_sphere = surf_file(subject, 'sphere.rot', hemisphere, native_settings)
+    refsulc_metric = os.path.join(ciftify_data_dir,
+                                  'standard_mesh_atlases',
+                                  '{}.refsulc.{}.shape.gii'.format(hemisphere,
+                                        highres_settings['meshname']))
+
+    copy_file(affine_rot_gii, native_rot_sphere)
+
+    ## all the msm outputs (including the logdir) go to the absolute --out
+    ## path, so there is no need to change directory (which would affect the
+    ## other hemisphere's thread)
+    if not DRYRUN:
+        run(['msm', '--conf={}'.format(msm_config),
+                '--inmesh={}'.format(native_rot_sphere),
+                '--refmesh={}'.format(surf_file(subject, 'sphere', hemisphere,
+                        highres_settings)),
+                '--indata={}'.format(metric_file(subject, 'sulc', hemisphere,
+                        native_settings)),
+                '--refdata={}'.format(refsulc_metric),
+                '--out={}'.format(paths['out'])], dryrun=DRYRUN)
+
+    archive_msm_config(msm_config, paths['conf_log'], msm_conf_sha)
+
+    #copy the MSMSulc outputs into Native folder and calculate Distortion
+    MSMsulc_sphere = surf_file(subject, reg_sphere_name, hemisphere, native_settings)
+    copy_file(paths['sphere_reg'], MSMsulc_sphere)
+    set_structure(MSMsulc_sphere, structure)
+
+    #Make MSMSulc Registration Areal Distortion Maps
+    calc_areal_distortion_gii(native_sphere, MSMsulc_sphere,
+            metric_file(subject, 'ArealDistortion_MSMSulc', hemisphere, native_settings),
+            '{}_{}_'.format(subject, hemisphere), '_MSMSulc')
+
+    run(['wb_command', '-surface-distortion',
+            native_sphere, MSMsulc_sphere,
+            metric_file(subject, 'EdgeDistortion_MSMSulc',hemisphere, native_settings),
+            '-edge-method'], dryrun=DRYRUN)
+
+def archive_msm_config(msm_config, conf_log, msm_conf_sha):
+    '''
+    copy the MSM config into the registration log, unless the log already
+    holds the same config (msm_conf_sha is the sha1 of msm_config)
+    '''
+    if os.path.exists(conf_log) and file_sha1(conf_log) == msm_conf_sha:
+        logger.debug("{} already holds the MSM config".format(conf_log))
+        return
+    copy_file(msm_config, conf_log)
 
 def calc_areal_distortion_gii(sphere_pre, sphere_reg, AD_gii_out, map_prefix,
                               map_postfix):
@@ -1322,26 +1875,16 @@ def calc_areal_distortion_gii(sphere_pre, sphere_reg, AD_gii_out, map_prefix,
             map_prefix    Prefix added to the map-name meta-data
             map_postfix   Posfix added to the map-name meta-data
     '''
-    with ciftify.utils.TempDir() as va_tmpdir:
-        pre_va = os.path.join(va_tmpdir, 'sphere_pre_va.shape.gii')
-        reg_va = os.path.join(va_tmpdir, 'sphere_reg_va.shape.gii')
-        ## calculate surface vertex areas from pre and post files
-        run(['wb_command', '-surface-vertex-areas', sphere_pre, pre_va],
-                dryrun=DRYRUN)
-        run(['wb_command', '-surface-vertex-areas', sphere_reg, reg_va],
-                dryrun=DRYRUN)
-        ## caluculate Areal Distortion using the vertex areas
-        run(['wb_command', '-metric-math', '"(ln(spherereg / sphere) / ln(2))"',
-            AD_gii_out, '-var', 'sphere', pre_va, '-var', 'spherereg', reg_va],
-                dryrun=DRYRUN)
-        ## set meta-data for the ArealDistotion files
-        run(['wb_command', '-set-map-names', AD_gii_out,
-            '-map', '1', '{}_Areal_Distortion_{}'.format(map_prefix,
-            map_postfix)], dryrun=DRYRUN)
-        run(['wb_command', '-metric-palette', AD_gii_out, 'MODE_AUTO_SCALE',
-            '-palette-name', 'ROY-BIG-BL', '-thresholding',
-            'THRESHOLD_TYPE_NORMAL', 'THRESHOLD_TEST_SHOW_OUTSIDE', '-1', '1'],
-            dryrun=DRYRUN)
+    ## caluculate Areal Distortion from the vertex areas, in process, the
+    ## map name meta-data is set as it is written
+    metric_math(ciftify.niio.areal_distortion_metric, sphere_pre, sphere_reg,
+            AD_gii_out, '{}_Areal_Distortion_{}'.format(map_prefix,
+            map_postfix))
+    ## set the palette meta-data for the ArealDistotion files
+    run(['wb_command', '-metric-palette', AD_gii_out, 'MODE_AUTO_SCALE',
+        '-palette-name', 'ROY-BIG-BL', '-thresholding',
+        'THRESHOLD_TYPE_NORMAL', 'THRESHOLD_TEST_SHOW_OUTSIDE', '-1', '1'],
+        dryrun=DRYRUN)
 
 ## Step 4.0 Post Registration Native Mesh #######################
 
@@ -1350,46 +1893,51 @@ def merge_subject_medial_wall_with_atlas_template(subject_id, high_res_mesh,
     '''resample the atlas medial wall roi into subjects native space then
     merge with native roi'''
 
-    native_settings = meshes['AtlasSpaceNative']
-    high_res_settings = meshes['HighResMesh']
-
-    for hemisphere in ['L', 'R']:
-        ## note this roi is a temp file so I'm not using the roi_file function
-        atlas_roi_native_gii = metric_file(subject_id, 'atlasroi', hemisphere,
-                native_settings)
-
-        native_roi = medial_wall_roi_file(subject_id, hemisphere,
-                native_settings)
-        #Ensures no zeros in atlas medial wall ROI
-        run(['wb_command', '-metric-resample',
-            medial_wall_roi_file(subject_id, hemisphere, high_res_settings),
-            surf_file(subject_id, 'sphere', hemisphere, high_res_settings),
-            surf_file(subject_id, reg_sphere, hemisphere, native_settings),
-            'BARYCENTRIC', atlas_roi_native_gii,'-largest'])
-        run(['wb_command', '-metric-math', '"(atlas + individual) > 0"',
-            native_roi, '-var', 'atlas', atlas_roi_native_gii, '-var',
-            'individual', native_roi])
+    run_per_hemisphere(merge_subject_medial_wall_with_atlas_template_hemisphere,
+            subject_id, meshes['AtlasSpaceNative'], meshes['HighResMesh'],
+            reg_sphere)
+
+def merge_subject_medial_wall_with_atlas_template_hemisphere(hemisphere,
+        structure, subject_id, native_settings, high_res_settings, reg_sphere):
+    ## note this roi is a temp file so I'm not using the roi_file function
+    atlas_roi_native_gii = metric_file(subject_id, 'atlasroi', hemisphere,
+            native_settings)
+
+    native_roi = medial_wall_roi_file(subject_id, hemisphere,
+            native_settings)
+    #Ensures no zeros in atlas medial wall ROI
+    resample_barycentric(ciftify.niio.resample_largest_barycentric,
+        medial_wall_roi_file(subject_id, hemisphere, high_res_settings),
+        surf_file(subject_id, 'sphere', hemisphere, high_res_settings),
+        surf_file(subject_id, reg_sphere, hemisphere, native_settings),
+        atlas_roi_native_gii)
+    metric_math(ciftify.niio.metric_math_positive_sum, atlas_roi_native_gii,
+            native_roi, native_roi)
 
 def dilate_and_mask_metric(subject_id, native_mesh_settings, dscalars):
     ''' Dilate and mask gifti metric data... done after refinining the medial
     roi mask'''
     ## remask the thickness and curvature data with the redefined medial wall roi
-    for map_name in dscalars.keys():
-        if not dscalars[map_name]['mask_medialwall']:
-            continue
-        for hemisphere  in ['L', 'R']:
-            ## dilate the thickness and curvature file by 10mm
-            metric_map = metric_file(subject_id, map_name, hemisphere,
-                    native_mesh_settings)
-            run(['wb_command', '-metric-dilate', metric_map,
-                surf_file(subject_id, 'midthickness',hemisphere,
-                        native_mesh_settings),
-                '10', metric_map,'-nearest'])
-            ## apply the medial wall roi to the thickness and curvature files
-            run(['wb_command', '-metric-mask', metric_map,
-                medial_wall_roi_file(subject_id, hemisphere,
-                        native_mesh_settings),
-                metric_map], dryrun=DRYRUN)
+    ## every map and hemisphere is independent, so they are all run at once
+    run_many([(dilate_and_mask_metric_hemisphere, hemisphere, structure,
+            subject_id, native_mesh_settings, map_name)
+            for map_name in dscalars.keys()
+            if dscalars[map_name]['mask_medialwall']
+            for hemisphere, structure in HEMISPHERES])
+
+def dilate_and_mask_metric_hemisphere(hemisphere, structure, subject_id,
+        native_mesh_settings, map_name):
+    ## dilate the thickness and curvature file by 10mm
+    metric_map = metric_file(subject_id, map_name, hemisphere,
+            native_mesh_settings)
+    run(['wb_command', '-metric-dilate', metric_map,
+        surf_file(subject_id, 'midthickness',hemisphere,
+                native_mesh_settings),
+        '10', metric_map,'-nearest'])
+    ## apply the medial wall roi to the thickness and curvature files
+    metric_math(ciftify.niio.metric_math_mask, metric_map,
+        medial_wall_roi_file(subject_id, hemisphere, native_mesh_settings),
+        metric_map)
 
 ## Step 4.1 Resampling Mesh to other Spaces #######################
 
@@ -1415,28 +1963,40 @@ def resample_surfs_and_add_to_spec(subject_id, source_mesh, dest_mesh,
         current_sphere='sphere', dest_sphere='sphere', current_sphere_mesh=None):
     '''
     Resample surface files and add them to the resampled spaces spec file
-    uses wb_command -surface-resample with BARYCENTRIC method
+    uses BARYCENTRIC resampling (see resample_barycentric)
     Arguments:
         source_mesh      Dictionary of Settings for current mesh
         dest_mesh        Dictionary of Settings for destination (output) mesh
     '''
     if not current_sphere_mesh:
         current_sphere_mesh = source_mesh
-    for surface in ['white', 'midthickness', 'pial']:
-        for hemisphere, structure in [('L','CORTEX_LEFT'), ('R','CORTEX_RIGHT')]:
-            surf_in = surf_file(subject_id, surface, hemisphere, source_mesh)
-            surf_out = surf_file(subject_id, surface, hemisphere, dest_mesh)
-            current_sphere_surf = surf_file(subject_id, current_sphere,
-                    hemisphere, current_sphere_mesh)
-            dest_sphere_surf = surf_file(subject_id, dest_sphere, hemisphere,
-                    dest_mesh)
-            run(['wb_command', '-surface-resample', surf_in,
-                current_sphere_surf, dest_sphere_surf, 'BARYCENTRIC', surf_out])
-            run(['wb_command', '-add-to-spec-file',
-                spec_file(subject_id, dest_mesh), structure, surf_out])
+    ## all the surfaces are resampled at once, then added to the spec file
+    ## in order
+    surfaces = [(surface, hemisphere, structure)
+            for surface in ['white', 'midthickness', 'pial']
+            for hemisphere, structure in HEMISPHERES]
+    surfs_out = run_many([(resample_surface_hemisphere, hemisphere, structure,
+            subject_id, surface, source_mesh, dest_mesh, current_sphere,
+            dest_sphere, current_sphere_mesh)
+            for surface, hemisphere, structure in surfaces])
+    for (surface, hemisphere, structure), surf_out in zip(surfaces, surfs_out):
+        add_to_spec_file(spec_file(subject_id, dest_mesh), structure, surf_out)
+
+def resample_surface_hemisphere(hemisphere, structure, subject_id, surface,
+        source_mesh, dest_mesh, current_sphere, dest_sphere,
+        current_sphere_mesh):
+    surf_in = surf_file(subject_id, surface, hemisphere, source_mesh)
+    surf_out = surf_file(subject_id, surface, hemisphere, dest_mesh)
+    current_sphere_surf = surf_file(subject_id, current_sphere,
+            hemisphere, current_sphere_mesh)
+    dest_sphere_surf = surf_file(subject_id, dest_sphere, hemisphere,
+            dest_mesh)
+    resample_barycentric(ciftify.niio.resample_surface_barycentric, surf_in,
+        current_sphere_surf, dest_sphere_surf, surf_out)
+    return surf_out
 
 def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
-        dest_mesh, current_sphere='sphere', dest_sphere='sphere'):
+        dest_mesh, current_sphere='sphere', dest_sphere='sphere', rois=None):
     '''
     Resample the metric files to a different mesh and then mask out the medial
     wall. Uses wb_command -metric-resample with 'ADAP_BARY_AREA' method.
@@ -1447,7 +2007,13 @@ def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
                                 'thickness', etc.)
         current_mesh            Settings for current mesh
         dest_mesh               Settings for destination (output) mesh
+        rois                    The (source, dest) medial wall ROI files, if
+                                already known
     '''
+    if rois is None:
+        rois = (medial_wall_roi_file(subject_id, hemisphere, source_mesh),
+                medial_wall_roi_file(subject_id, hemisphere, dest_mesh))
+    source_roi, dest_roi = rois
     map_name = dscalar['mapname']
     metric_in = metric_file(subject_id, map_name, hemisphere, source_mesh)
     metric_out = metric_file(subject_id, map_name, hemisphere, dest_mesh)
@@ -1466,10 +2032,8 @@ def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
         run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
             dest_sphere_surf, 'ADAP_BARY_AREA', metric_out,
             '-area-surfs', current_midthickness, new_midthickness,
-            '-current-roi', medial_wall_roi_file(subject_id, hemisphere,
-            source_mesh)])
-        run(['wb_command', '-metric-mask', metric_out,
-            medial_wall_roi_file(subject_id, hemisphere, dest_mesh), metric_out],
+            '-current-roi', source_roi])
+        run(['wb_command', '-metric-mask', metric_out, dest_roi, metric_out],
             dryrun=DRYRUN)
     else:
         run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
@@ -1479,8 +2043,8 @@ def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
 def resample_label(subject_id, label_name, hemisphere, source_mesh, dest_mesh,
         current_sphere='sphere', dest_sphere='sphere'):
     '''
-    Resample label files if they exist. Uses wb_command -label-resample with
-    BARYCENTRIC method
+    Resample label files if they exist. Uses BARYCENTRIC resampling with the
+    largest weight (see resample_barycentric)
 
     Arguments:
         label_name            Name of label to resample (i.e 'aparc')
@@ -1494,12 +2058,11 @@ def resample_label(subject_id, label_name, hemisphere, source_mesh, dest_mesh,
     '''
     label_in = label_file(subject_id, label_name, hemisphere, source_mesh)
     if os.path.exists(label_in):
-        run(['wb_command', '-label-resample', label_in,
+        resample_barycentric(ciftify.niio.resample_largest_barycentric,
+            label_in,
             surf_file(subject_id, current_sphere, hemisphere, source_mesh),
             surf_file(subject_id, dest_sphere, hemisphere, dest_mesh),
-            'BARYCENTRIC',
-            label_file(subject_id, label_name, hemisphere, dest_mesh),
-            '-largest'])
+            label_file(subject_id, label_name, hemisphere, dest_mesh))
 
 def resample_to_native(native_mesh, dest_mesh, settings, subject_id,
         sphere, expected_labels, reg_sphere_mesh):
@@ -1512,28 +2075,39 @@ def resample_to_native(native_mesh, dest_mesh, settings, subject_id,
 
 def resample_metric_and_label(subject_id, dscalars, expected_labels,
         source_mesh, dest_mesh, current_sphere):
-    for hemisphere in ['L', 'R']:
-        ## resample the metric data to the new mesh
+    '''
+    Resample the metric and label data to the new mesh. Every map and
+    hemisphere is independent, so they are all run at once (each metric is
+    still masked after it is resampled)
+    '''
+    ## the medial wall ROI paths are only built once per hemisphere
+    metric_jobs = []
+    for hemisphere, structure in HEMISPHERES:
+        rois = (medial_wall_roi_file(subject_id, hemisphere, source_mesh),
+                medial_wall_roi_file(subject_id, hemisphere, dest_mesh))
         for map_name in dscalars.keys():
-            resample_and_mask_metric(subject_id, dscalars[map_name], hemisphere,
-                    source_mesh, dest_mesh, current_sphere=current_sphere)
-        ## resample all the label data to the new mesh
-        for map_name in expected_labels:
-            resample_label(subject_id, map_name, hemisphere, source_mesh,
-                    dest_mesh, current_sphere=current_sphere)
+            metric_jobs.append((resample_and_mask_metric, subject_id,
+                    dscalars[map_name], hemisphere, source_mesh, dest_mesh,
+                    current_sphere, 'sphere', rois))
+    run_many(metric_jobs +
+            [(resample_label, subject_id, map_name, hemisphere, source_mesh,
+                    dest_mesh, current_sphere)
+            for hemisphere, structure in HEMISPHERES
+            for map_name in expected_labels])
 
 ## The main function ################################################
 
 
 def main():
     global DRYRUN
+    global LEGACY_RESAMPLE
+    global IN_PROCESS_RESAMPLE
     arguments  = docopt(__doc__)
     verbose      = arguments['--verbose']
     debug        = arguments['--debug']
     DRYRUN       = arguments['--dry-run']
-
-    global N_CPUS
-    global FS_LICENSE
+    LEGACY_RESAMPLE = arguments['--legacy-resample']
+    IN_PROCESS_RESAMPLE = arguments['--in-process-resample']
 
     ch = logging.StreamHandler()
     ch.setLevel(logging.WARNING)
@@ -1546,6 +2120,40 @@ def main():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+    if not arguments['--subjects']:
+        run_subject(arguments, formatter)
+        return
+
+    failed = []
+    for subject_id in read_subjects_list(arguments['--subjects']):
+        subject_arguments = dict(arguments, **{'<Subject>': subject_id})
+        try:
+            run_subject(subject_arguments, formatter)
+        except SystemExit as err:
+            if err.code:
+                logger.error("ciftify_recon_all failed for subject {}".format(
+                        subject_id))
+                failed.append(subject_id)
+        except Exception:
+            logger.exception("ciftify_recon_all failed for subject {}".format(
+                    subject_id))
+            failed.append(subject_id)
+    if failed:
+        logger.error("ciftify_recon_all failed for {} subject(s): {}".format(
+                len(failed), ', '.join(failed)))
+        sys.exit(1)
+
+def read_subjects_list(subjects_file):
+    '''read one subject id per line, skipping blank lines'''
+    ciftify.utils.check_input_readable(subjects_file)
+    with open(subjects_file) as subjects_fp:
+        return [line.strip() for line in subjects_fp if line.strip()]
+
+def run_subject(arguments, formatter):
+    global N_CPUS
+    global OMP_NTHREADS
+    global FS_LICENSE
+
     # Get settings, and add an extra handler for the subject log
     settings = Settings(arguments)
     fh = settings.subject.get_subject_log_handler(formatter)
@@ -1556,15 +2164,23 @@ def main():
     #     logger.error("Cannot locate T2 for {} in freesurfer "
     #             "outputs".format(settings.subject.id))
 
-    N_CPUS = settings.n_cpus
+    N_CPUS = int(settings.n_cpus)
+    OMP_NTHREADS = settings.omp_nthreads
     FS_LICENSE = settings.fs_license
-
-    logger.info(ciftify.utils.ciftify_logo())
-    logger.info(section_header("Starting cifti_recon_all"))
-    with ciftify.utils.TempDir() as tmpdir:
-        logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
-                    os.uname()[1]))
-        run_ciftify_recon_all(tmpdir, settings)
+    set_run_env(OMP_NTHREADS, FS_LICENSE, N_CPUS)
+
+    try:
+        logger.info(ciftify.utils.ciftify_logo())
+        log_section("Starting cifti_recon_all")
+        with ciftify.utils.TempDir() as tmpdir:
+            logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
+                        os.uname()[1]))
+            run_ciftify_recon_all(tmpdir, settings)
+    finally:
+        ## the resampling weights are for this subject's spheres only
+        ciftify.niio.clear_sphere_resampling()
+        logger.removeHandler(fh)
+        fh.close()
 
 if __name__ == '__main__':
     main()
@@ -311,6 +311,10 @@ def system_info():
 class FSLog:
     _MAYBE_HALTED = "FS may not have finished running."
     _ERROR = "Exited with error."
+    # the only recon-all.done fields that are used, parsing stops once all
+    # of them have been found
+    _RECON_DONE_FIELDS = frozenset(['SUBJECT', 'START_TIME', 'END_TIME',
+            'UNAME', 'CMDARGS'])
 
     def __init__(self, freesurfer_folder):
         logger = logging.getLogger(__name__)
@@ -364,10 +368,12 @@ class FSLog:
         return status
 
     def _get_build(self, build_stamp):
-        contents = self.read_log(build_stamp)
-        if not contents:
+        try:
+            with open(build_stamp) as log:
+                first_line = log.readline()
+        except OSError:
             return ''
-        return contents[0].strip('\n')
+        return first_line.strip('\n')
 
     def get_version(self, build):
         if 'v6.0.0' in build:
@@ -380,19 +386,20 @@ class FSLog:
             return 'unknown'
 
     def parse_recon_done(self, recon_done):
-        recon_contents = self.read_log(recon_done)
-
-        if len(recon_contents) < 2:
-            # If length is less than two, log is malformed and will cause a
-            # crash when the for loop is reached below
+        try:
+            log = open(recon_done)
+        except OSError:
             return {}
 
         parsed_contents = {}
-        # Skip first line, which is just a bunch of dashes
-        for line in recon_contents[1:]:
-            # line = line.decode('utf-8')
-            fields = line.strip('\n').split(None, 1)
-            parsed_contents[fields[0]] = fields[1]
+        with log:
+            # Skip first line, which is just a bunch of dashes
+            log.readline()
+            for line in log:
+                fields = line.strip('\n').split(None, 1)
+                parsed_contents[fields[0]] = fields[1]
+                if self._RECON_DONE_FIELDS.issubset(parsed_contents):
+                    break
         return parsed_contents
 
     def get_subject(self, subject_field):
@@ -6,19 +6,28 @@ within the ciftify/HCP pipelines naming convention
 
 import os
 import logging
+import functools
+
+@functools.lru_cache(maxsize=4096)
+def _dotted_path(folder, *parts):
+    '''
+    folder/part1.part2...; the file name functions below are called with the
+    same few arguments many times per subject, so their paths are cached (on
+    the mesh_settings values used, as the dicts themselves can't be hashed)
+    '''
+    return os.path.join(folder, '.'.join(str(part) for part in parts))
 
 def spec_file(subject_id, mesh_settings):
     '''return the formated spec_filename for this mesh'''
-    specfile = os.path.join(mesh_settings['Folder'],
-        "{}.{}.wb.spec".format(subject_id, mesh_settings['meshname']))
+    specfile = _dotted_path(mesh_settings['Folder'], subject_id,
+        mesh_settings['meshname'], 'wb', 'spec')
     return specfile
 
 def metric_file(subject_id, map_name, hemisphere, mesh_settings):
     '''return the formatted file path for a metric (surface data) file for this
     mesh'''
-    metric_gii = os.path.join(mesh_settings['tmpdir'],
-        "{}.{}.{}.{}.shape.gii".format(subject_id, hemisphere, map_name,
-        mesh_settings['meshname']))
+    metric_gii = _dotted_path(mesh_settings['tmpdir'], subject_id, hemisphere,
+        map_name, mesh_settings['meshname'], 'shape', 'gii')
     return metric_gii
 
 def func_gii_file(subject_id, map_name, hemisphere, mesh_settings):
@@ -34,72 +43,66 @@ def medial_wall_roi_file(subject_id, hemisphere, mesh_settings):
     Medial wall ROIs are the only shape.gii files that aren't temp files,
     and their name is given in the mesh_settings, so they get their own function
     '''
-    roi_gii = os.path.join(mesh_settings['Folder'],
-        "{}.{}.{}.{}.shape.gii".format(subject_id, hemisphere,
-        mesh_settings['ROI'], mesh_settings['meshname']))
+    roi_gii = _dotted_path(mesh_settings['Folder'], subject_id, hemisphere,
+        mesh_settings['ROI'], mesh_settings['meshname'], 'shape', 'gii')
     return roi_gii
 
 def surf_file(subject_id, surface, hemisphere, mesh_settings):
     '''return the formatted file path to a surface file '''
-    surface_gii = os.path.join(mesh_settings['Folder'],
-            '{}.{}.{}.{}.surf.gii'.format(subject_id, hemisphere, surface,
-            mesh_settings['meshname']))
+    surface_gii = _dotted_path(mesh_settings['Folder'], subject_id,
+            hemisphere, surface, mesh_settings['meshname'], 'surf', 'gii')
     return surface_gii
 
 def label_file(subject_id, label_name, hemisphere, mesh_settings):
     '''return the formated file path to a label (surface data) file for this mesh'''
-    label_gii = os.path.join(mesh_settings['tmpdir'],
-        '{}.{}.{}.{}.label.gii'.format(subject_id, hemisphere, label_name,
-        mesh_settings['meshname']))
+    label_gii = _dotted_path(mesh_settings['tmpdir'], subject_id, hemisphere,
+        label_name, mesh_settings['meshname'], 'label', 'gii')
     return label_gii
 
 def define_meshes(subject_workdir, temp_dir, high_res_mesh = "164",
         low_res_meshes = ["32"], make_low_res = False):
     '''sets up a dictionary of expected paths for each mesh'''
+    # the folders and images shared by several meshes are only built once
+    T1w_dir = os.path.join(subject_workdir, 'T1w')
+    MNI_dir = os.path.join(subject_workdir, 'MNINonLinear')
+    T1w_images = {'T1wImage': os.path.join(T1w_dir, 'T1w.nii.gz'),
+                  'T2wImage': os.path.join(T1w_dir, 'T2w.nii.gz')}
+    MNI_images = {'T1wImage': os.path.join(MNI_dir, 'T1w.nii.gz'),
+                  'T2wImage': os.path.join(MNI_dir, 'T2w.nii.gz')}
+    high_res_name = '{}k_fs_LR'.format(high_res_mesh)
 
     meshes = {
-        'T1wNative':{
-            'Folder' : os.path.join(subject_workdir, 'T1w', 'Native'),
+        'T1wNative':dict(T1w_images, **{
+            'Folder' : os.path.join(T1w_dir, 'Native'),
             'ROI': 'roi',
             'meshname': 'native',
             'tmpdir': os.path.join(temp_dir, 'T1w', 'native'),
-            'T1wImage': os.path.join(subject_workdir, 'T1w', 'T1w.nii.gz'),
-            'T2wImage': os.path.join(subject_workdir, 'T1w', 'T2w.nii.gz'),
-            'DenseMapsFolder': os.path.join(subject_workdir, 'MNINonLinear', 'Native')},
-        'AtlasSpaceNative':{
-            'Folder' : os.path.join(subject_workdir, 'MNINonLinear', 'Native'),
+            'DenseMapsFolder': os.path.join(MNI_dir, 'Native')}),
+        'AtlasSpaceNative':dict(MNI_images, **{
+            'Folder' : os.path.join(MNI_dir, 'Native'),
             'ROI': 'roi',
             'meshname': 'native',
-            'tmpdir': os.path.join(temp_dir, 'MNINonLinear', 'native'),
-            'T1wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T1w.nii.gz'),
-            'T2wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T2w.nii.gz')},
-        'HighResMesh':{
-            'Folder' : os.path.join(subject_workdir, 'MNINonLinear'),
+            'tmpdir': os.path.join(temp_dir, 'MNINonLinear', 'native')}),
+        'HighResMesh':dict(MNI_images, **{
+            'Folder' : MNI_dir,
             'ROI': 'atlasroi',
-            'meshname': '{}k_fs_LR'.format(high_res_mesh),
-            'tmpdir': os.path.join(temp_dir, '{}k_fs_LR'.format(high_res_mesh)),
-            'T1wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T1w.nii.gz'),
-            'T2wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T2w.nii.gz')}
+            'meshname': high_res_name,
+            'tmpdir': os.path.join(temp_dir, high_res_name)})
     }
     for low_res_mesh in low_res_meshes:
-        meshes['{}k_fs_LR'.format(low_res_mesh)] = {
-            'Folder': os.path.join(subject_workdir, 'MNINonLinear',
-                    'fsaverage_LR{}k'.format(low_res_mesh)),
+        low_res_name = '{}k_fs_LR'.format(low_res_mesh)
+        low_res_folder = 'fsaverage_LR{}k'.format(low_res_mesh)
+        low_res_tmpdir = os.path.join(temp_dir, low_res_name)
+        meshes[low_res_name] = dict(MNI_images, **{
+            'Folder': os.path.join(MNI_dir, low_res_folder),
             'ROI' : 'atlasroi',
-            'meshname': '{}k_fs_LR'.format(low_res_mesh),
-            'tmpdir': os.path.join(temp_dir, '{}k_fs_LR'.format(low_res_mesh)),
-            'T1wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T1w.nii.gz'),
-            'T2wImage': os.path.join(subject_workdir, 'MNINonLinear', 'T2w.nii.gz')}
+            'meshname': low_res_name,
+            'tmpdir': low_res_tmpdir})
         if make_low_res:
-             meshes['Native{}k_fs_LR'.format(low_res_mesh)] = {
-                 'Folder': os.path.join(subject_workdir, 'T1w',
-                        'fsaverage_LR{}k'.format(low_res_mesh)),
+             meshes['Native{}'.format(low_res_name)] = dict(T1w_images, **{
+                 'Folder': os.path.join(T1w_dir, low_res_folder),
                  'ROI' : 'atlasroi',
-                 'meshname': '{}k_fs_LR'.format(low_res_mesh),
-                 'tmpdir': os.path.join(temp_dir,
-                        '{}k_fs_LR'.format(low_res_mesh)),
-                 'T1wImage': os.path.join(subject_workdir, 'T1w', 'T1w.nii.gz'),
-                 'T2wImage': os.path.join(subject_workdir, 'T1w', 'T2w.nii.gz'),
-                 'DenseMapsFolder': os.path.join(subject_workdir, 'MNINonLinear',
-                        'fsaverage_LR{}k'.format(low_res_mesh))}
+                 'meshname': low_res_name,
+                 'tmpdir': low_res_tmpdir,
+                 'DenseMapsFolder': meshes[low_res_name]['Folder']})
     return meshes
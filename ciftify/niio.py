@@ -7,12 +7,23 @@ loading data into numpy arrays
 import os
 import sys
 import logging
+import threading
+import collections.abc
+from concurrent.futures import Future
 import numpy as np
 import pandas as pd
 import nibabel as nib
 import nibabel.gifti.giftiio
 
 from ciftify.utils import run, get_stdout, TempDir
+from ciftify.surface import (vertex_areas, log2_ratio, barycentric_weights,
+        apply_barycentric, apply_barycentric_largest)
+
+## the barycentric weights found for each (current sphere, new sphere) pair,
+## as Futures keyed by their paths and modification times (see
+## sphere_resampling and clear_sphere_resampling)
+_BARYCENTRIC_WEIGHTS = {}
+_BARYCENTRIC_LOCK = threading.Lock()
 
 def cifti_info(filename):
     '''runs wb_command -file-information" to try to figure out what the file is made off'''
@@ -333,3 +344,225 @@ def determine_filetype(path):
         sys.exit(1)
 
     return(MR_type, MRbase)
+
+def freesurfer_surface_to_gifti(fs_surf, surf_gii):
+    '''
+    Write a freesurfer surface (i.e. lh.white) as a gifti surface, in place
+    of mris_convert. The coordinates are kept in freesurfer's surface RAS, as
+    mris_convert does.
+    '''
+    coords, faces = nib.freesurfer.read_geometry(fs_surf)
+    surf = nib.gifti.GiftiImage(darrays = [
+        nib.gifti.GiftiDataArray(coords.astype(np.float32),
+                intent='NIFTI_INTENT_POINTSET', datatype='NIFTI_TYPE_FLOAT32'),
+        nib.gifti.GiftiDataArray(faces.astype(np.int32),
+                intent='NIFTI_INTENT_TRIANGLE', datatype='NIFTI_TYPE_INT32')])
+    nib.save(surf, surf_gii)
+
+def freesurfer_morph_to_gifti(fs_morph, metric_gii):
+    '''
+    Write freesurfer per vertex data (i.e. lh.thickness) as a gifti metric, in
+    place of mris_convert -c
+    '''
+    data = nib.freesurfer.read_morph_data(fs_morph)
+    metric = nib.gifti.GiftiImage(darrays = [
+        nib.gifti.GiftiDataArray(data.astype(np.float32),
+                intent='NIFTI_INTENT_SHAPE', datatype='NIFTI_TYPE_FLOAT32')])
+    nib.save(metric, metric_gii)
+
+def freesurfer_annot_to_gifti(fs_annot, label_gii):
+    '''
+    Write a freesurfer annotation (i.e. lh.aparc.annot) as a gifti label file,
+    in place of mris_convert --annot. The label keys are the colortable
+    indices, vertices without a label are given a '???' label.
+    '''
+    labels, ctab, names = nib.freesurfer.read_annot(fs_annot)
+    labels = labels.astype(np.int32)
+    names = [name.decode() if isinstance(name, bytes) else name
+            for name in names]
+    label_table = nib.gifti.GiftiLabelTable()
+    # ctab columns are red, green, blue, transparency (0-255) and annot value
+    for key, (name, row) in enumerate(zip(names, ctab)):
+        label_table.labels.append(nib.gifti.GiftiLabel(key, row[0] / 255.0,
+                row[1] / 255.0, row[2] / 255.0, 1 - row[3] / 255.0))
+        label_table.labels[-1].label = name
+    if (labels < 0).any():
+        unknown_key = len(names)
+        label_table.labels.append(nib.gifti.GiftiLabel(unknown_key, 0, 0, 0, 0))
+        label_table.labels[-1].label = '???'
+        labels[labels < 0] = unknown_key
+    label_img = nib.gifti.GiftiImage(labeltable = label_table, darrays = [
+        nib.gifti.GiftiDataArray(labels, intent='NIFTI_INTENT_LABEL',
+                datatype='NIFTI_TYPE_INT32')])
+    nib.save(label_img, label_gii)
+
+def _gifti_meta(mapping):
+    '''
+    gifti metadata from a dict. From nibabel 4 GiftiMetaData is a mapping
+    itself (and from_dict is deprecated), older versions need from_dict.
+    '''
+    if issubclass(nib.gifti.GiftiMetaData, collections.abc.Mapping):
+        return nib.gifti.GiftiMetaData(mapping)
+    return nib.gifti.GiftiMetaData.from_dict(mapping)
+
+def _meta_dict(meta):
+    '''gifti metadata as a dict (.metadata is deprecated from nibabel 4)'''
+    if isinstance(meta, collections.abc.Mapping):
+        return dict(meta)
+    return meta.metadata
+
+def _save_metric(data, metric_out, file_meta, map_meta):
+    '''Save data as a one map gifti metric with the given metadata dicts'''
+    metric = nib.gifti.GiftiImage(
+            meta = _gifti_meta(file_meta), darrays = [
+        nib.gifti.GiftiDataArray(data.astype(np.float32),
+                intent='NIFTI_INTENT_NONE', datatype='NIFTI_TYPE_FLOAT32',
+                meta=_gifti_meta(map_meta))])
+    nib.save(metric, metric_out)
+
+def _save_metric_like(template, data, metric_out, map_name=None):
+    '''
+    Save data as a one map gifti metric, keeping the file metadata (i.e. the
+    structure) and the map metadata of the template gifti image
+    '''
+    map_meta = _meta_dict(template.darrays[0].meta)
+    if map_name:
+        map_meta['Name'] = map_name
+    _save_metric(data, metric_out, _meta_dict(template.meta), map_meta)
+
+def set_gifti_structure(gii_file, structure):
+    '''
+    Set the structure (i.e. CORTEX_LEFT) of a gifti file in place of
+    wb_command -set-structure. Like wb_command, surfaces hold it in the
+    metadata of their coordinates and other files in the file metadata.
+    '''
+    img = nib.load(gii_file)
+    name = ''.join(part.capitalize() for part in structure.split('_'))
+    pointsets = img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')
+    holder = pointsets[0] if pointsets else img
+    meta = _meta_dict(holder.meta)
+    meta['AnatomicalStructurePrimary'] = name
+    holder.meta = _gifti_meta(meta)
+    nib.save(img, gii_file)
+
+def _load_surface(surf_gii):
+    '''
+    load the coordinates, triangles and structure (for the metric made from
+    it) of a gifti surface
+    '''
+    surf = nib.load(surf_gii)
+    coords = surf.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0]
+    faces = surf.get_arrays_from_intent('NIFTI_INTENT_TRIANGLE')[0]
+    structure = {key: value for key, value in
+            list(_meta_dict(surf.meta).items()) +
+            list(_meta_dict(coords.meta).items())
+            if key == 'AnatomicalStructurePrimary'}
+    return coords.data, faces.data, structure
+
+def areal_distortion_metric(sphere_pre, sphere_reg, metric_out, map_name=None):
+    '''
+    Writes the areal distortion of a registration, log2 of the ratio of each
+    vertex's area after (sphere_reg) and before (sphere_pre) registration, in
+    place of wb_command -surface-vertex-areas and -metric-math
+    '''
+    pre_coords, pre_faces, structure = _load_surface(sphere_pre)
+    reg_coords, reg_faces, _ = _load_surface(sphere_reg)
+    distortion = log2_ratio(vertex_areas(reg_coords, reg_faces),
+            vertex_areas(pre_coords, pre_faces))
+    _save_metric(distortion, metric_out, structure,
+            {'Name': map_name} if map_name else {})
+
+def metric_math_positive_sum(metric_a, metric_b, metric_out):
+    '''
+    Writes 1 where the sum of the two metrics is positive and 0 elsewhere, in
+    place of wb_command -metric-math "(a + b) > 0" (i.e. to merge two ROIs)
+    '''
+    a_img = nib.load(metric_a)
+    b_img = nib.load(metric_b)
+    positive = (a_img.darrays[0].data.astype(np.float64) +
+            b_img.darrays[0].data) > 0
+    _save_metric_like(b_img, positive, metric_out)
+
+def metric_math_mask(metric_gii, roi_gii, metric_out):
+    '''
+    Sets every map of the metric to 0 outside of the roi (where the roi is
+    not positive), in place of wb_command -metric-mask
+    '''
+    metric = nib.load(metric_gii)
+    inside = nib.load(roi_gii).darrays[0].data > 0
+    for darray in metric.darrays:
+        darray.data = np.where(inside, darray.data, 0).astype(darray.data.dtype)
+    nib.save(metric, metric_out)
+
+def sphere_resampling(current_sphere, new_sphere):
+    '''
+    The BARYCENTRIC resampling weights from current_sphere to new_sphere
+    (see ciftify.surface.barycentric_weights), found once and reused for
+    every file resampled between the same spheres until either is modified.
+    When several threads ask for the same spheres at once, only the first
+    finds the weights and the others wait for them.
+    '''
+    key = tuple((sphere, os.path.getmtime(sphere))
+            for sphere in (current_sphere, new_sphere))
+    with _BARYCENTRIC_LOCK:
+        resampling = _BARYCENTRIC_WEIGHTS.get(key)
+        first = resampling is None
+        if first:
+            resampling = Future()
+            _BARYCENTRIC_WEIGHTS[key] = resampling
+    if first:
+        try:
+            current_coords, current_faces, _ = _load_surface(current_sphere)
+            new_coords, _, _ = _load_surface(new_sphere)
+            resampling.set_result(barycentric_weights(current_coords,
+                    current_faces, new_coords))
+        except BaseException as err:
+            with _BARYCENTRIC_LOCK:
+                del _BARYCENTRIC_WEIGHTS[key]
+            resampling.set_exception(err)
+            raise
+    return resampling.result()
+
+def clear_sphere_resampling():
+    '''forget the weights kept by sphere_resampling (i.e. between subjects)'''
+    with _BARYCENTRIC_LOCK:
+        _BARYCENTRIC_WEIGHTS.clear()
+
+def resample_surface_barycentric(surf_in, current_sphere, new_sphere,
+        surf_out):
+    '''
+    in place of wb_command -surface-resample with the BARYCENTRIC method, the
+    output has the coordinates resampled from surf_in and the triangles of
+    new_sphere
+    '''
+    vertices, weights = sphere_resampling(current_sphere, new_sphere)
+    surf = nib.load(surf_in)
+    coords = surf.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0]
+    faces = nib.load(new_sphere).get_arrays_from_intent(
+            'NIFTI_INTENT_TRIANGLE')[0]
+    resampled = nib.gifti.GiftiImage(meta = surf.meta, darrays = [
+        nib.gifti.GiftiDataArray(
+                apply_barycentric(coords.data, vertices, weights).astype(np.float32),
+                intent='NIFTI_INTENT_POINTSET', datatype='NIFTI_TYPE_FLOAT32',
+                meta=coords.meta, coordsys=coords.coordsys),
+        nib.gifti.GiftiDataArray(faces.data.astype(np.int32),
+                intent='NIFTI_INTENT_TRIANGLE', datatype='NIFTI_TYPE_INT32',
+                meta=faces.meta)])
+    nib.save(resampled, surf_out)
+
+def resample_largest_barycentric(gii_in, current_sphere, new_sphere, gii_out):
+    '''
+    in place of wb_command -label-resample or -metric-resample with the
+    BARYCENTRIC method and -largest, every map takes the value of the
+    vertex with the largest weight. The label table and metadata are kept.
+    '''
+    vertices, weights = sphere_resampling(current_sphere, new_sphere)
+    img = nib.load(gii_in)
+    resampled = nib.gifti.GiftiImage(meta = img.meta,
+            labeltable = img.labeltable, darrays = [
+        nib.gifti.GiftiDataArray(
+                apply_barycentric_largest(darray.data, vertices, weights),
+                intent=darray.intent, datatype=darray.datatype,
+                meta=darray.meta)
+        for darray in img.darrays])
+    nib.save(resampled, gii_out)
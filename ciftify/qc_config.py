@@ -12,7 +12,7 @@ from PIL import Image
 import yaml
 
 import ciftify.config as config
-from ciftify.utils import run, TempDir, add_metaclass
+from ciftify.utils import run, TempDir, add_metaclass, YAML_LOADER
 
 class Config:
     def __init__(self, mode):
@@ -58,7 +58,7 @@ class Config:
         qc_settings = os.path.join(ciftify_data, 'qc_modes.yaml')
         try:
             with open(qc_settings) as qc_stream:
-                qc_modes = yaml.load(qc_stream, Loader=yaml.SafeLoader)
+                qc_modes = yaml.load(qc_stream, Loader=YAML_LOADER)
         except:
             logger.error("Cannot read qc_modes file: {}".format(qc_settings))
             sys.exit(1)
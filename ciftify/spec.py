@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Writes connectome workbench spec files (the xml lists of the files to load
+together in wb_view) in process, instead of one wb_command -add-to-spec-file
+call per file
+"""
+
+import os
+import logging
+import threading
+import xml.etree.ElementTree as ET
+
+## the workbench DataFileType for each file extension, the first match is used
+DATA_FILE_TYPES = [
+    ('.surf.gii', 'SURFACE'),
+    ('.label.gii', 'LABEL'),
+    ('.func.gii', 'METRIC'),
+    ('.shape.gii', 'METRIC'),
+    ('.dscalar.nii', 'CONNECTIVITY_DENSE_SCALAR'),
+    ('.dlabel.nii', 'CONNECTIVITY_DENSE_LABEL'),
+    ('.dtseries.nii', 'CONNECTIVITY_DENSE_TIME_SERIES'),
+    ('.border', 'BORDER'),
+    ('.scene', 'SCENE'),
+    ('.nii.gz', 'VOLUME'),
+    ('.nii', 'VOLUME')]
+
+def data_file_type(filename):
+    '''return the workbench DataFileType of a file, from its extension'''
+    for extension, file_type in DATA_FILE_TYPES:
+        if filename.endswith(extension):
+            return file_type
+    raise ValueError("Cannot add {} to a spec file, unknown file type"
+            "".format(filename))
+
+def structure_name(structure):
+    '''
+    convert a wb_command structure argument (i.e. CORTEX_LEFT) to the name
+    used in spec files (i.e. CortexLeft)
+    '''
+    return ''.join(word.capitalize() for word in structure.split('_'))
+
+def add_to_spec_file(spec, entries):
+    '''
+    Add (structure, filename) entries to the spec file, creating it if it
+    does not exist. Like wb_command -add-to-spec-file, filenames are written
+    relative to the spec file and entries already in the spec are skipped.
+    The spec is read once and replaced in one step, so it is never left half
+    written.
+    '''
+    spec_dir = os.path.dirname(os.path.abspath(spec))
+    if os.path.exists(spec):
+        tree = ET.parse(spec)
+        root = tree.getroot()
+    else:
+        root = ET.Element('CaretSpecFile', Version='1.0')
+        ET.SubElement(root, 'MetaData').text = '\n    '
+        tree = ET.ElementTree(root)
+
+    existing = {(item.get('Structure'), item.get('DataFileType'),
+            (item.text or '').strip()) for item in root.iter('DataFile')}
+    root.text = '\n    '
+    for element in root:
+        element.tail = '\n    '
+    for structure, filename in entries:
+        key = (structure_name(structure), data_file_type(filename),
+                os.path.relpath(os.path.abspath(filename), spec_dir))
+        if key in existing:
+            continue
+        existing.add(key)
+        data_file = ET.SubElement(root, 'DataFile', Structure=key[0],
+                DataFileType=key[1], Selected='true')
+        data_file.text = '\n        {}\n    '.format(key[2])
+        data_file.tail = '\n    '
+    if len(root):
+        root[-1].tail = '\n'
+    _write_atomically(tree, spec)
+
+def _write_atomically(tree, spec):
+    '''write the xml to a temporary file next to spec, then move it over spec'''
+    tmp_spec = '{}.{}.tmp'.format(spec, os.getpid())
+    try:
+        tree.write(tmp_spec, encoding='UTF-8', xml_declaration=True)
+        os.replace(tmp_spec, spec)
+    except BaseException:
+        if os.path.exists(tmp_spec):
+            os.remove(tmp_spec)
+        raise
+
+class SpecFileBatcher:
+    '''
+    Collects the files to add to each spec file, so that every spec file is
+    only read and written once (by write() or on leaving a with block).
+    add() can be called from several threads.
+    '''
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.write()
+
+    def add(self, spec, structure, filename):
+        with self.__lock:
+            self.__entries.setdefault(spec, []).append((structure, filename))
+
+    def write(self):
+        logger = logging.getLogger(__name__)
+        with self.__lock:
+            entries, self.__entries = self.__entries, {}
+        for spec in sorted(entries):
+            logger.info("Adding {} files to spec file {}".format(
+                    len(entries[spec]), spec))
+            if self.dry_run:
+                continue
+            add_to_spec_file(spec, entries[spec])
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Surface geometry calculated in process with numpy, in place of the
+wb_command subprocesses for small per vertex measures
+"""
+
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+## the number of candidate triangles tested at once, this bounds the memory
+## used by barycentric_weights
+BARYCENTRIC_CHUNK = 200000
+
+## the number of triangles measured at once by triangle_areas
+TRIANGLE_BLOCK = 16384
+
+def triangle_areas(coords, faces):
+    '''the area of each triangle of a surface (coords is V x 3, faces F x 3)'''
+    ## the x, y and z coordinates (and the three corners of the triangles) are
+    ## handled as separate contiguous arrays and the cross product written
+    ## out, which is faster than np.cross on (F, 3) arrays. The triangles are
+    ## done in blocks so the temporary arrays stay in cache.
+    ## float32 (what gifti surfaces hold) is plenty for mm scale coordinates
+    ## and moves half the bytes of float64
+    x, y, z = np.asarray(coords, dtype=np.float32).T.copy()
+    corners = np.asarray(faces).T.copy()
+    areas = np.empty(corners.shape[1], dtype=np.float32)
+    for start in range(0, len(areas), TRIANGLE_BLOCK):
+        v0, v1, v2 = corners[:, start:start + TRIANGLE_BLOCK]
+        x0, y0, z0 = x[v0], y[v0], z[v0]
+        e1x, e1y, e1z = x[v1] - x0, y[v1] - y0, z[v1] - z0
+        e2x, e2y, e2z = x[v2] - x0, y[v2] - y0, z[v2] - z0
+        cross_x = e1y * e2z - e1z * e2y
+        cross_y = e1z * e2x - e1x * e2z
+        cross_z = e1x * e2y - e1y * e2x
+        areas[start:start + TRIANGLE_BLOCK] = 0.5 * np.sqrt(
+                cross_x * cross_x + cross_y * cross_y + cross_z * cross_z)
+    return areas
+
+def vertex_areas(coords, faces):
+    '''
+    The area around each vertex, like wb_command -surface-vertex-areas: every
+    vertex gets a third of the area of each triangle it is part of
+    '''
+    faces = np.asarray(faces)
+    ## np.bincount does the scatter-add in one compiled loop, much faster
+    ## than np.add.at on surfaces with hundreds of thousands of triangles
+    return np.bincount(faces.ravel(),
+            weights=np.repeat(triangle_areas(coords, faces) / 3.0, 3),
+            minlength=len(coords))
+
+def log2_ratio(numerator, denominator):
+    '''
+    log2(numerator / denominator), set to 0 where either is not positive
+    (i.e. the areal distortion from the vertex areas before and after
+    registration)
+    '''
+    numerator = np.asarray(numerator, dtype=np.float32)
+    denominator = np.asarray(denominator, dtype=np.float32)
+    ratio = np.zeros(numerator.shape, dtype=np.float32)
+    valid = (numerator > 0) & (denominator > 0)
+    ratio[valid] = np.log2(numerator[valid] / denominator[valid])
+    return ratio
+
+def _triangle_planes(coords, faces):
+    '''
+    What _project_to_triangles needs to know about each triangle, found once
+    per surface: a corner, the normal, the normal's distance term and the
+    two vectors that give the barycentric weights of the other corners
+    '''
+    a, b, c = (coords[faces[:, i]] for i in range(3))
+    edge_b = b - a
+    edge_c = c - a
+    normal = np.cross(edge_b, edge_c)
+    normal_sq = np.einsum('ij,ij->i', normal, normal)
+    valid = normal_sq > 0
+    scale = np.zeros(len(faces))
+    scale[valid] = 1.0 / normal_sq[valid]
+    ## for a point q in the plane, the weight of b is (q - a) . to_b and the
+    ## weight of c is (q - a) . to_c
+    to_b = np.cross(edge_c, normal) * scale[:, np.newaxis]
+    to_c = np.cross(normal, edge_b) * scale[:, np.newaxis]
+    return {'corner': a.T.copy(), 'normal': normal.T.copy(),
+            'offset': np.einsum('ij,ij->i', normal, a), 'to_b': to_b.T.copy(),
+            'to_c': to_c.T.copy(), 'valid': valid}
+
+def _project_to_triangles(planes, candidates, points):
+    '''
+    Project each point from the centre of the sphere onto the plane of each
+    of its candidate triangles (points is N x 3, candidates N x K triangle
+    indices into _triangle_planes, -1 for none). Returns the barycentric
+    weights of the projections (N x K x 3) and whether each projection falls
+    inside its triangle (N x K).
+    '''
+    ## written out over x, y and z so only the per triangle values are
+    ## gathered for each candidate, with no (N, K, 3) cross products
+    px, py, pz = (points[:, i, np.newaxis] for i in range(3))
+    nx, ny, nz = planes['normal'][:, candidates]
+    toward = nx * px + ny * py + nz * pz
+    with np.errstate(divide='ignore', invalid='ignore'):
+        depth = planes['offset'][candidates] / toward
+    ax, ay, az = planes['corner'][:, candidates]
+    qx, qy, qz = depth * px - ax, depth * py - ay, depth * pz - az
+    bx, by, bz = planes['to_b'][:, candidates]
+    cx, cy, cz = planes['to_c'][:, candidates]
+    weight_b = qx * bx + qy * by + qz * bz
+    weight_c = qx * cx + qy * cy + qz * cz
+    weights = np.stack([1.0 - weight_b - weight_c, weight_b, weight_c],
+            axis=-1)
+    tolerance = 1e-6
+    inside = ((candidates >= 0) & planes['valid'][candidates] & (depth > 0) &
+            np.all(weights >= -tolerance, axis=-1))
+    weights = np.clip(np.nan_to_num(weights), 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+    return np.nan_to_num(weights), inside
+
+def vertex_faces(faces, n_vertices):
+    '''
+    The triangles around each vertex, as a compressed table: the faces of
+    vertex v are face_ids[indptr[v]:indptr[v + 1]]
+    '''
+    faces = np.asarray(faces)
+    order = np.argsort(faces.ravel(), kind='stable')
+    face_ids = order // 3
+    indptr = np.zeros(n_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(faces.ravel(), minlength=n_vertices),
+            out=indptr[1:])
+    return indptr, face_ids
+
+def _padded_vertex_faces(indptr, face_ids):
+    '''the vertex_faces table as a vertices x most faces array, padded with -1'''
+    degree = np.diff(indptr)
+    vertex = np.repeat(np.arange(len(degree)), degree)
+    adjacent = np.full((len(degree), max(degree.max(initial=0), 1)), -1,
+            dtype=np.int64)
+    adjacent[vertex, np.arange(len(face_ids)) - indptr[vertex]] = face_ids
+    return adjacent
+
+def barycentric_weights(current_coords, current_faces, new_coords, k=8):
+    '''
+    The BARYCENTRIC resampling from a current sphere to a new sphere (both
+    centred on the origin), like wb_command -surface-resample and friends
+    find it: for each vertex of the new sphere, the three current sphere
+    vertices of the triangle it falls in and their barycentric weights.
+
+    The triangles are searched for among those around the closest current
+    sphere vertex, then around the k closest, widening the search for any
+    vertex still not found.
+
+    Returns the vertex indices (int32) and weights (float32), each new
+    vertices x 3. The search itself is done in float64, as points close to
+    a triangle edge need the precision to be found in either triangle.
+    '''
+    current_coords = np.asarray(current_coords, dtype=np.float64)
+    current_faces = np.asarray(current_faces)
+    new_coords = np.asarray(new_coords, dtype=np.float64)
+    n_new = len(new_coords)
+    n_current = len(current_coords)
+    vertices = np.zeros((n_new, 3), dtype=np.int64)
+    weights = np.zeros((n_new, 3))
+
+    vertex_tree = cKDTree(current_coords)
+    adjacent = _padded_vertex_faces(*vertex_faces(current_faces, n_current))
+    planes = _triangle_planes(current_coords, current_faces)
+    ## bound the candidate triangles (not the vertices) searched at once
+    chunk = max(1, BARYCENTRIC_CHUNK // adjacent.shape[1])
+    todo = np.arange(n_new)
+    k = min(k, n_current)
+    ## nearly every vertex falls in a triangle around its closest vertex, so
+    ## that much smaller search is done first
+    search_k = 1
+    while todo.size:
+        missing = []
+        for start in range(0, todo.size, chunk):
+            rows = todo[start:start + chunk]
+            _, neighbours = vertex_tree.query(new_coords[rows], k=search_k)
+            candidates = adjacent[neighbours].reshape(len(rows), -1)
+            candidate_weights, inside = _project_to_triangles(planes,
+                    candidates, new_coords[rows])
+            found = inside.any(axis=1)
+            first = inside.argmax(axis=1)[found]
+            vertices[rows[found]] = current_faces[candidates[found, first]]
+            weights[rows[found]] = candidate_weights[found, first]
+            missing.append(rows[~found])
+        todo = np.concatenate(missing)
+        if search_k == n_current:
+            break
+        search_k = min(k if search_k < k else search_k * 4, n_current)
+
+    ## anything still not inside a triangle takes the closest vertex
+    if todo.size:
+        logger = logging.getLogger(__name__)
+        logger.warning("{} of {} vertices are not inside any triangle of the "
+                "current sphere, they take the value of the closest vertex"
+                "".format(todo.size, n_new))
+        _, closest = vertex_tree.query(new_coords[todo])
+        vertices[todo] = closest[:, np.newaxis]
+        weights[todo] = [1, 0, 0]
+    return vertices.astype(np.int32), weights.astype(np.float32)
+
+def apply_barycentric(values, vertices, weights):
+    '''
+    resample per vertex values (vertices first, i.e. coordinates or one
+    metric map) with barycentric_weights
+    '''
+    values = np.asarray(values)
+    return np.einsum('ij...,ij->i...', values[vertices], weights)
+
+def apply_barycentric_largest(values, vertices, weights):
+    '''
+    resample per vertex values taking the value of the vertex with the
+    largest weight (the -largest option of wb_command), used for labels and
+    ROIs
+    '''
+    values = np.asarray(values)
+    largest = vertices[np.arange(len(vertices)), weights.argmax(axis=1)]
+    return values[largest]
@@ -18,6 +18,10 @@ import yaml
 import ciftify
 logger = logging.getLogger(__name__)
 
+## the libyaml backed loader is much faster than the pure python one, but is
+## only available when pyyaml was built against libyaml
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 def get_subj(path, user_filter=None):
     """
     Gets all folder names (i.e., subjects) in a directory (of subjects).
@@ -54,7 +58,7 @@ def FWHM2Sigma(FWHM):
   return(sigma)
 
 
-def make_dir(dir_name, dry_run=False, suppress_exists_error = False):
+def make_dir(dir_name, dry_run=False):
     # Wait till logging is needed to get logger, so logging configuration
     # set in main module is respected
     logger = logging.getLogger(__name__)
@@ -68,8 +72,7 @@ def make_dir(dir_name, dry_run=False, suppress_exists_error = False):
     except PermissionError:
         logger.error("You do not have permission to write to {}".format(dir_name))
     except FileExistsError:
-        if not suppress_exists_error:
-            logger.warning("{} already exists".format(dir_name))
+        logger.warning("{} already exists".format(dir_name))
     except OSError:
         logger.error('Could not create directory {}'.format(dir_name))
 
@@ -155,12 +158,13 @@ def add_metaclass(metaclass):
     return wrapper
 
 class TempDir:
-    def __init__(self):
+    def __init__(self, dir=None):
         self.path = None
+        self.dir = dir
         return
 
     def __enter__(self):
-        self.path = tempfile.mkdtemp()
+        self.path = tempfile.mkdtemp(dir=self.dir)
         return self.path
 
     def __exit__(self, type, value, traceback):
@@ -237,6 +241,10 @@ class WorkFlowSettings(WorkDirSettings):
     A convenience class for parsing settings that are shared
     by ciftify_recon_all and ciftify_subject_fmri
     '''
+    # parsed yaml settings, by file path, shared between all the instances
+    # made in one process (i.e. one per subject with --subjects)
+    _config_cache = {}
+
     def __init__(self, arguments):
         WorkDirSettings.__init__(self, arguments)
         self.FSL_dir = self.__set_FSL_dir()
@@ -269,15 +277,19 @@ class WorkFlowSettings(WorkDirSettings):
                 "".format(yaml_file))
             sys.exit(1)
 
-        try:
-            with open(yaml_file) as yaml_stream:
-                config = yaml.load(yaml_stream, Loader=yaml.SafeLoader)
-        except:
-            logger.critical("Cannot read yaml config file {}, check formatting."
-                    "".format(yaml_file))
-            sys.exit(1)
+        if yaml_file not in self._config_cache:
+            try:
+                with open(yaml_file) as yaml_stream:
+                    config = yaml.load(yaml_stream, Loader=YAML_LOADER)
+            except:
+                logger.critical("Cannot read yaml config file {}, check "
+                        "formatting.".format(yaml_file))
+                sys.exit(1)
+            self._config_cache[yaml_file] = config
 
-        return config
+        # get_resolution_config edits entries in place, so each instance
+        # gets its own copy
+        return copy.deepcopy(self._config_cache[yaml_file])
 
     def get_config_entry(self, key):
         try:
@@ -395,7 +407,7 @@ def run(cmd, dryrun=False,
         logger.info('Doing a dryrun')
         return 0
 
-    merged_env = os.environ
+    merged_env = os.environ.copy()
     if env:
         merged_env.update(env)
 
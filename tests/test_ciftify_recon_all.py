@@ -4,10 +4,13 @@ import logging
 import importlib
 import copy
 import os
+import sys
 from docopt import docopt
 
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import pytest
+import numpy as np
+import nibabel as nib
 import ciftify.utils
 
 logging.disable(logging.CRITICAL)
@@ -18,6 +21,23 @@ class ConvertFreesurferSurface(unittest.TestCase):
     meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
             "164", ["32"], '/tmp/temp_dir', False)
 
+    def setUp(self):
+        patcher = patch('ciftify.bin.ciftify_recon_all.freesurfer_to_gifti')
+        self.mock_convert = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_surfaces_converted_without_mris_convert(self, mock_run):
+        ciftify_recon_all.convert_freesurfer_surface('subject_1', 'white', 'ANATOMICAL',
+                '/somewhere/freesurfer/subject_1', self.meshes['T1wNative'])
+
+        assert self.mock_convert.call_count == 2
+        converted = sorted(item[0][1] for item in self.mock_convert.call_args_list)
+        assert converted == ['/somewhere/freesurfer/subject_1/surf/lh.white',
+                '/somewhere/freesurfer/subject_1/surf/rh.white']
+        for item in mock_run.call_args_list:
+            assert 'mris_convert' not in item[0][0]
+
     @patch('ciftify.bin.ciftify_recon_all.run')
     def test_secondary_type_option_adds_to_set_structure_command(self, mock_run):
         secondary_type = 'GRAY_WHITE'
@@ -94,37 +114,456 @@ class ConvertFreesurferSurface(unittest.TestCase):
         assert surface_apply_calls == 0
 
     @patch('ciftify.bin.ciftify_recon_all.run')
-    def test_add_to_spec_option_adds_wbcommand_call(self, mock_run):
+    def test_each_hemisphere_converted_in_one_shell_chain(self, mock_run):
+        ciftify_recon_all.convert_freesurfer_surface('subject_1', 'white', 'ANATOMICAL',
+                '/somewhere/freesurfer/subject_1', self.meshes['T1wNative'],
+                cras_mat='/somewhere/cras.mat')
+
+        assert mock_run.call_count == 2
+        for item in mock_run.call_args_list:
+            assert item[0][0].count(' && ') == 1
+
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_add_to_spec_option_adds_to_spec_file(self, mock_run, mock_add):
         ciftify_recon_all.convert_freesurfer_surface('subject_1', 'white', 'ANATOMICAL',
                 '/somewhere/freesurfer/subject_1', self.meshes['T1wNative'],
                 add_to_spec=True)
 
         assert mock_run.call_count >= 1
-        arg_list = mock_run.call_args_list
-
-        spec_added_calls = 0
-        for item in arg_list:
-            args = item[0][0]
-            if '-add-to-spec-file' in args:
-                spec_added_calls += 1
-        # Should add one call for each hemisphere
-        assert spec_added_calls == 2
+        # Should add one file for each hemisphere
+        assert mock_add.call_count == 2
 
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
     @patch('ciftify.bin.ciftify_recon_all.run')
-    def test_add_to_spec_option_not_present_when_option_not_set(self, mock_run):
+    def test_add_to_spec_option_not_present_when_option_not_set(self, mock_run,
+            mock_add):
         ciftify_recon_all.convert_freesurfer_surface('subject_1', 'white', 'ANATOMICAL',
                 '/somewhere/freesurfer/subject_1', self.meshes['T1wNative'],
                 add_to_spec=False)
 
         assert mock_run.call_count >= 1
-        arg_list = mock_run.call_args_list
+        assert mock_add.call_count == 0
+
+class AddDenseMapsToSpecFile(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
+    def test_maps_added_from_resolved_folder(self, mock_add):
+        with ciftify.utils.TempDir() as tmpdir:
+            real_folder = os.path.join(os.path.realpath(tmpdir), 'real')
+            os.makedirs(real_folder)
+            linked_folder = os.path.join(tmpdir, 'linked')
+            os.symlink(real_folder, linked_folder)
+            open(os.path.join(real_folder,
+                    'subject_1.aparc.native.dlabel.nii'), 'w').close()
+            mesh_settings = {'Folder': linked_folder, 'meshname': 'native'}
+            ciftify_recon_all.add_dense_maps_to_spec_file('subject_1',
+                    mesh_settings, ['sulc'], ['aparc', 'BA'])
+
+        added = [item[0] for item in mock_add.call_args_list]
+        spec = os.path.join(real_folder, 'subject_1.native.wb.spec')
+        assert added == [
+                (spec, 'INVALID', os.path.join(real_folder,
+                        'subject_1.sulc.native.dscalar.nii')),
+                (spec, 'INVALID', os.path.join(real_folder,
+                        'subject_1.aparc.native.dlabel.nii'))]
+
+class WriteCrasFile(unittest.TestCase):
+    def test_cras_offsets_written_to_matrix(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'mri'))
+            # the c_ras is the world position of the centre voxel (2, 2, 2)
+            affine = np.eye(4)
+            affine[:3, 3] = np.array([5.3997, 18.0, -0.25]) - 2
+            mgh = nib.MGHImage(np.zeros((4, 4, 4), dtype=np.uint8), affine)
+            mgh.to_filename(os.path.join(tmpdir, 'mri', 'brain.finalsurfs.mgz'))
+            cras_mat = os.path.join(tmpdir, 'cras.mat')
+            ciftify_recon_all.write_cras_file(tmpdir, cras_mat)
+            cras = np.loadtxt(cras_mat)
+
+        assert np.allclose(cras, [[1, 0, 0, 5.3997], [0, 1, 0, 18.0],
+                [0, 0, 1, -0.25], [0, 0, 0, 1]])
+
+    def test_exits_when_finalsurfs_cannot_be_read(self):
+        with pytest.raises(SystemExit):
+            ciftify_recon_all.write_cras_file('/somewhere/freesurfer/subject_1',
+                    '/somewhere/cras.mat')
 
-        spec_added_calls = 0
-        for item in arg_list:
-            args = item[0][0]
-            if '-add-to-spec-file' in args:
-                spec_added_calls += 1
-        assert spec_added_calls == 0
+class ConvertFreesurferMaps(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    def setUp(self):
+        patcher = patch('ciftify.bin.ciftify_recon_all.freesurfer_to_gifti')
+        self.mock_convert = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('ciftify.bin.ciftify_recon_all.set_structure')
+        self.mock_set_structure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def metric_math_calls(self, mock_run, mapname):
+        map_dict = {'mapname': mapname, 'fsname': mapname,
+                'map_postfix': '_{}'.format(mapname.capitalize()),
+                'palette_mode': 'MODE_AUTO_SCALE_PERCENTAGE',
+                'palette_options': '-disp-pos true'}
+        ciftify_recon_all.convert_freesurfer_maps('subject_1', map_dict,
+                '/somewhere/freesurfer/subject_1', self.meshes['AtlasSpaceNative'])
+        return [item[0][0] for item in mock_run.call_args_list
+                if '-metric-math' in item[0][0]]
+
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_thickness_made_absolute_in_one_call(self, mock_run):
+        calls = self.metric_math_calls(mock_run, 'thickness')
+        # one per hemisphere
+        assert len(calls) == 2
+        assert all(call[2] == '"(abs(var))"' for call in calls)
+
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_sulc_multiplied_by_minus_one(self, mock_run):
+        calls = self.metric_math_calls(mock_run, 'sulc')
+        assert len(calls) == 2
+        assert all(call[2] == '"(var * -1)"' for call in calls)
+
+class RunMany(unittest.TestCase):
+    def test_all_jobs_are_run(self):
+        done = []
+        ciftify_recon_all.run_many([(done.append, 'wmparc'),
+                (done.append, 'aparc+aseg')])
+        assert sorted(done) == ['aparc+aseg', 'wmparc']
+
+    def test_exits_when_any_job_fails(self):
+        def failing_job():
+            sys.exit(1)
+        done = []
+        with pytest.raises(SystemExit):
+            ciftify_recon_all.run_many([(failing_job,), (done.append, 'wmparc')])
+        # the other jobs are still allowed to finish
+        assert done == ['wmparc']
+
+    def test_exits_when_a_job_raises(self):
+        def failing_job():
+            raise FileNotFoundError('wmparc.mgz')
+        done = []
+        with pytest.raises(SystemExit):
+            ciftify_recon_all.run_many([(failing_job,), (done.append, 'wmparc')])
+        assert done == ['wmparc']
+
+    def test_results_returned_in_job_order(self):
+        results = ciftify_recon_all.run_many([(str.upper, 'l'),
+                (str.upper, 'r')])
+        assert results == ['L', 'R']
+
+class RunPerHemisphere(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    def test_func_called_for_both_hemispheres(self):
+        results = ciftify_recon_all.run_per_hemisphere(
+                lambda hemisphere, structure, name: (hemisphere, structure, name),
+                'white')
+        assert results == [('L', 'CORTEX_LEFT', 'white'),
+                ('R', 'CORTEX_RIGHT', 'white')]
+
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_spec_file_added_to_in_hemisphere_order(self, mock_run, mock_add):
+        ciftify_recon_all.make_inflated_surfaces('subject_1',
+                self.meshes['T1wNative'])
+
+        spec_adds = [item[0] for item in mock_add.call_args_list]
+        assert [spec_add[-1].split('.')[1:3] for spec_add in spec_adds] == [
+                ['L', 'inflated'], ['L', 'very_inflated'],
+                ['R', 'inflated'], ['R', 'very_inflated']]
+
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_surfaces_for_several_meshes_made_together(self, mock_run,
+            mock_add):
+        ciftify_recon_all.make_inflated_surfaces('subject_1',
+                self.meshes['T1wNative'], self.meshes['AtlasSpaceNative'])
+
+        assert mock_run.call_count == 4
+        specs = [item[0][0] for item in mock_add.call_args_list]
+        assert specs == [ciftify_recon_all.spec_file('subject_1',
+                self.meshes[mesh_name]) for mesh_name in
+                ['T1wNative'] * 4 + ['AtlasSpaceNative'] * 4]
+
+class ConvertInputsToMNISpace(unittest.TestCase):
+    reg_settings = {'src_dir': '/somewhere/hcp/subject_1/T1w',
+            'dest_dir': '/somewhere/hcp/subject_1/MNINonLinear',
+            'xfms_dir': '/somewhere/hcp/subject_1/MNINonLinear/xfms',
+            'T1wImage': 'T1w.nii.gz',
+            'T1wBrain': 'T1w_brain.nii.gz',
+            'BrainMask': 'brainmask_fs.nii.gz',
+            'AtlasTransform_Linear': 'T1w2StandardLinear.mat',
+            'AtlasTransform_NonLinear': 'T1w2Standard_warp_noaffine.nii.gz',
+            'InverseAtlasTransform_NonLinear': 'Standard2T1w_warp_noaffine.nii.gz',
+            'standard_T1wImage': '/somewhere/MNI152_T1_1mm.nii.gz',
+            'standard_T1wBrain': '/somewhere/MNI152_T1_1mm_brain.nii.gz',
+            'standard_BrainMask': '/somewhere/MNI152_T1_1mm_brain_mask_dil.nii.gz',
+            'FNIRTConfig': '/somewhere/T1_2_MNI152_2mm.cnf',
+            'User_AtlasTransform_Linear': False,
+            'User_AtlasTransform_NonLinear': False}
+
+    @patch('os.path.isfile')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_every_warp_in_one_pool_on_the_template_grid(self, mock_run,
+            mock_isfile):
+        mock_isfile.return_value = True
+        with patch('ciftify.bin.ciftify_recon_all.run_many',
+                wraps=ciftify_recon_all.run_many) as mock_run_many:
+            ciftify_recon_all.convert_inputs_to_MNI_space(self.reg_settings,
+                    '/somewhere/ciftify/data', '/tmp/temp_dir')
+
+        assert mock_run_many.call_count == 1
+        commands = [item[0][0] for item in mock_run.call_args_list]
+        programs = [cmd[0] for cmd in commands]
+        assert programs.count('invwarp') == 1
+        warps = [cmd for cmd in commands if cmd[0] == 'applywarp']
+        assert len(warps) == 5
+        assert all(cmd[cmd.index('-r') + 1] == '/somewhere/MNI152_T1_1mm.nii.gz'
+                for cmd in warps)
+
+    @patch('ciftify.bin.ciftify_recon_all.copy_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_user_transforms_copied_without_cp(self, mock_run, mock_copy):
+        reg_settings = dict(self.reg_settings,
+                User_AtlasTransform_Linear='/somewhere/user_premat.mat',
+                User_AtlasTransform_NonLinear='/somewhere/user_warp.nii.gz')
+        ciftify_recon_all.run_T1_FNIRT_registration(reg_settings, '/tmp/temp_dir')
+
+        programs = [item[0][0][0] for item in mock_run.call_args_list]
+        assert 'cp' not in programs
+        assert 'fnirt' not in programs
+        assert [item[0][0] for item in mock_copy.call_args_list] == [
+                '/somewhere/user_premat.mat', '/somewhere/user_warp.nii.gz']
+
+    @patch('os.path.isfile')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_fnirt_and_invwarp_skipped_when_linear_only(self, mock_run,
+            mock_isfile):
+        mock_isfile.return_value = True
+        reg_settings = dict(self.reg_settings, skip_nonlinear=True)
+        ciftify_recon_all.run_T1_FNIRT_registration(reg_settings, '/tmp/temp_dir')
+        ciftify_recon_all.convert_inputs_to_MNI_space(reg_settings,
+                '/somewhere/ciftify/data', '/tmp/temp_dir')
+
+        commands = [item[0][0] for item in mock_run.call_args_list]
+        programs = [cmd[0] for cmd in commands]
+        assert 'fnirt' not in programs
+        assert 'invwarp' not in programs
+        warps = [cmd for cmd in commands if cmd[0] == 'applywarp']
+        assert len(warps) == 5
+        assert not any('-w' in cmd for cmd in warps)
+
+class ApplywarpAndImportLabels(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_warped_image_only_written_to_temp_location(self, mock_run):
+        image_dest = '/somewhere/hcp/subject_1/MNINonLinear/wmparc.nii.gz'
+        ciftify_recon_all.applywarp_and_import_labels(['applywarp', '-i',
+                '/somewhere/hcp/subject_1/T1w/wmparc.nii.gz'],
+                '/somewhere/FreeSurferAllLut.txt', image_dest)
+
+        applywarp, label_import = [item[0][0] for item in mock_run.call_args_list]
+        warped = applywarp[-1]
+        assert warped != image_dest
+        assert os.path.basename(warped) == 'wmparc.nii.gz'
+        assert label_import[4:7] == [warped, '/somewhere/FreeSurferAllLut.txt',
+                image_dest]
+
+class CreateCiftiSubcorticalROIs(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.link_to_template_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_rois_made_for_each_resolution(self, mock_run, mock_link):
+        settings = MagicMock()
+        settings.ciftify_data_dir = '/somewhere/ciftify/data'
+        settings.grayord_res = [2, 1]
+        ciftify_recon_all.create_cifti_subcortical_ROIs(
+                '/somewhere/hcp/subject_1/MNINonLinear', settings, '/tmp/temp_dir')
+
+        rois = sorted(item[0][0][-2] for item in mock_run.call_args_list
+                if '-discard-others' in item[0][0])
+        assert rois == [
+                '/somewhere/hcp/subject_1/MNINonLinear/ROIs/ROIs.1.nii.gz',
+                '/somewhere/hcp/subject_1/MNINonLinear/ROIs/ROIs.2.nii.gz']
+
+    @patch('ciftify.bin.ciftify_recon_all.link_to_template_file')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_labels_imported_once_per_resolution(self, mock_run, mock_link):
+        settings = MagicMock()
+        settings.ciftify_data_dir = '/somewhere/ciftify/data'
+        settings.grayord_res = [2]
+        ciftify_recon_all.create_cifti_subcortical_ROIs(
+                '/somewhere/hcp/subject_1/MNINonLinear', settings, '/tmp/temp_dir')
+
+        label_imports = [item[0][0] for item in mock_run.call_args_list
+                if '-volume-label-import' in item[0][0]]
+        assert len(label_imports) == 1
+        assert label_imports[0][5].endswith(
+                'FreeSurferSubcorticalLabelTableLut.txt')
+
+class CreateOutputDirectories(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    @patch('os.makedirs')
+    def test_each_directory_made_once(self, mock_makedirs):
+        ciftify_recon_all.create_output_directories(self.meshes,
+                '/somewhere/hcp/subject_1/MNINonLinear/xfms',
+                '/somewhere/hcp/subject_1/MNINonLinear/ROIs',
+                '/somewhere/hcp/subject_1/MNINonLinear/Results')
+
+        made_dirs = [item[0][0] for item in mock_makedirs.call_args_list]
+        assert len(made_dirs) == len(set(made_dirs))
+        assert '/somewhere/hcp/subject_1/MNINonLinear' in made_dirs
+
+class IsFSLStandardOrientation(unittest.TestCase):
+    def orientation_of(self, affine):
+        with ciftify.utils.TempDir() as tmpdir:
+            nifti = os.path.join(tmpdir, 'T1w.nii.gz')
+            nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.uint8),
+                    affine).to_filename(nifti)
+            return ciftify_recon_all.is_fsl_standard_orientation(nifti)
+
+    def test_true_for_mni_like_image(self):
+        assert self.orientation_of(np.diag([-1, 1, 1, 1]))
+
+    def test_false_for_freesurfer_conformed_image(self):
+        # the LIA orientation that mri_convert gives T1.mgz
+        lia = np.array([[-1, 0, 0, 0], [0, 0, 1, 0], [0, -1, 0, 0],
+                [0, 0, 0, 1]])
+        assert not self.orientation_of(lia)
+
+class MakeBrainMaskAndT1wBrain(unittest.TestCase):
+    def setUp(self):
+        self.wmparc_data = np.zeros((20, 20, 20), dtype=np.int32)
+        self.wmparc_data[5:15, 5:15, 5:15] = 2
+        # a hole in the middle and a one voxel gap at the edge
+        self.wmparc_data[8:12, 8:12, 8:12] = 0
+        self.wmparc_data[10, 5, 10] = 0
+
+    def test_mask_is_closed_and_filled(self):
+        mask = ciftify_recon_all.brain_mask_from_wmparc(self.wmparc_data)
+
+        assert mask[10, 10, 10]
+        assert mask[10, 5, 10]
+        # dilating by 3 then eroding by 2 grows the mask by one voxel
+        assert mask[4, 10, 10]
+        assert not mask[3, 10, 10]
+
+    def test_T1w_brain_is_T1w_times_mask(self):
+        T1w_data = np.full((20, 20, 20), 110, dtype=np.uint8)
+        with ciftify.utils.TempDir() as tmpdir:
+            wmparc = os.path.join(tmpdir, 'wmparc.nii.gz')
+            T1w = os.path.join(tmpdir, 'T1w.nii.gz')
+            brain_mask = os.path.join(tmpdir, 'brainmask_fs.nii.gz')
+            T1w_brain = os.path.join(tmpdir, 'T1w_brain.nii.gz')
+            nib.Nifti1Image(self.wmparc_data, np.eye(4)).to_filename(wmparc)
+            nib.Nifti1Image(T1w_data, np.eye(4)).to_filename(T1w)
+            ciftify_recon_all.make_brain_mask_and_T1w_brain(wmparc, T1w,
+                    brain_mask, T1w_brain)
+            mask = np.asanyarray(nib.load(brain_mask).dataobj)
+            brain = nib.load(T1w_brain)
+            brain_data = np.asanyarray(brain.dataobj)
+
+        assert set(np.unique(mask)) == {0, 1}
+        assert brain.get_data_dtype() == np.uint8
+        assert np.array_equal(brain_data, T1w_data * mask)
+
+class ResampleFreesurferMgz(unittest.TestCase):
+    def test_labels_resampled_to_T1w_grid(self):
+        labels = np.zeros((10, 10, 10), dtype=np.int32)
+        labels[:, :, 5:] = 2035
+        with ciftify.utils.TempDir() as tmpdir:
+            freesurfer_mgz = os.path.join(tmpdir, 'wmparc.mgz')
+            T1w_nii = os.path.join(tmpdir, 'T1w.nii.gz')
+            image_nii = os.path.join(tmpdir, 'wmparc.nii.gz')
+            nib.MGHImage(labels, np.eye(4)).to_filename(freesurfer_mgz)
+            nib.Nifti1Image(np.zeros((5, 5, 5), dtype=np.uint8),
+                    np.diag([2, 2, 2, 1])).to_filename(T1w_nii)
+            ciftify_recon_all.resample_freesurfer_mgz(T1w_nii, freesurfer_mgz,
+                    image_nii)
+            resampled = nib.load(image_nii)
+            data = np.asanyarray(resampled.dataobj)
+
+        assert resampled.shape == (5, 5, 5)
+        assert np.issubdtype(data.dtype, np.integer)
+        assert set(np.unique(data)) == {0, 2035}
+
+    def test_T1w_header_kept(self):
+        labels = np.full((10, 10, 10), 2, dtype=np.int32)
+        with ciftify.utils.TempDir() as tmpdir:
+            freesurfer_mgz = os.path.join(tmpdir, 'aparc+aseg.mgz')
+            T1w_nii = os.path.join(tmpdir, 'T1w.nii.gz')
+            image_nii = os.path.join(tmpdir, 'aparc+aseg.nii.gz')
+            nib.MGHImage(labels, np.eye(4)).to_filename(freesurfer_mgz)
+            T1w = nib.Nifti1Image(np.zeros((5, 5, 5), dtype=np.float32),
+                    np.diag([2, 2, 2, 1]))
+            T1w.set_sform(T1w.affine, code='aligned')
+            T1w.set_qform(T1w.affine, code='scanner')
+            T1w.header.set_xyzt_units('mm', 'sec')
+            T1w.to_filename(T1w_nii)
+            ciftify_recon_all.resample_freesurfer_mgz(T1w_nii, freesurfer_mgz,
+                    image_nii)
+            resampled = nib.load(image_nii)
+            T1w = nib.load(T1w_nii)
+
+        assert resampled.header['sform_code'] == T1w.header['sform_code']
+        assert resampled.header['qform_code'] == T1w.header['qform_code']
+        assert resampled.header.get_xyzt_units() == ('mm', 'sec')
+        assert np.allclose(resampled.header.get_zooms(), T1w.header.get_zooms())
+        assert np.issubdtype(resampled.get_data_dtype(), np.integer)
+
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_mri_convert_used_for_legacy_resample(self, mock_run):
+        with patch('ciftify.bin.ciftify_recon_all.LEGACY_RESAMPLE', True):
+            ciftify_recon_all.resample_freesurfer_mgz('/somewhere/T1w.nii.gz',
+                    '/somewhere/mri/wmparc.mgz', '/somewhere/wmparc.nii.gz')
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][0][0] == 'mri_convert'
+
+class DefineExpectedLabels(unittest.TestCase):
+    def test_v6_labels_do_not_include_BA(self):
+        labels = ciftify_recon_all.define_expected_labels('v6.0.0')
+        assert 'BA' not in labels
+        assert 'BA_exvivo' in labels
+
+    def test_v5_labels_do_not_include_DKTatlas(self):
+        labels = ciftify_recon_all.define_expected_labels('v5.3.0')
+        assert labels == ['aparc', 'aparc.a2009s', 'BA']
+
+    def test_all_labels_expected_for_unknown_version(self):
+        labels = ciftify_recon_all.define_expected_labels('unknown')
+        assert len(labels) == 5
+
+class CheckMSMConfig(unittest.TestCase):
+    msm_options = ('--inmesh  input mesh\n--refmesh  reference mesh\n'
+            '--lambda  regularisation\n--it  iterations\n')
+
+    def setUp(self):
+        ciftify_recon_all.msm_printoptions.cache_clear()
+
+    def check_config(self, config_text):
+        settings = ciftify_recon_all.Settings.__new__(ciftify_recon_all.Settings)
+        with ciftify.utils.TempDir() as tmpdir:
+            settings.msm_config = os.path.join(tmpdir, 'msm_conf')
+            with open(settings.msm_config, 'w') as conf:
+                conf.write(config_text)
+            with patch('subprocess.run') as mock_run:
+                mock_run.return_value.stderr = self.msm_options
+                return settings.check_msm_config()
+
+    def test_true_when_all_options_known(self):
+        assert self.check_config('--lambda=0.1,0.2\n--it=5,5\n--dopt=HOCR\n\n')
+
+    def test_false_when_option_unknown(self):
+        assert not self.check_config('--lambda=0.1\n--itsomething=5\n')
+
+    @patch('subprocess.run')
+    def test_msm_only_run_once(self, mock_run):
+        mock_run.return_value.stderr = self.msm_options
+        ciftify_recon_all.msm_printoptions()
+        ciftify_recon_all.msm_printoptions()
+        assert mock_run.call_count == 1
 
 class CreateRegSphere(unittest.TestCase):
     @patch('ciftify.bin.ciftify_recon_all.run_MSMSulc_registration')
@@ -156,6 +595,118 @@ class CreateRegSphere(unittest.TestCase):
         reg_sphere = ciftify_recon_all.create_reg_sphere(settings, subject_id, meshes)
         assert reg_sphere is not None
 
+class LinkToTemplateFile(unittest.TestCase):
+    class Settings(object):
+        def __init__(self, work_dir, no_symlinks):
+            self.work_dir = work_dir
+            self.no_symlinks = no_symlinks
+
+    def test_template_copied_once_and_linked(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            global_file = os.path.join(tmpdir, 'L.atlasroi.32k_fs_LR.shape.gii')
+            with open(global_file, 'w') as template:
+                template.write('template')
+            subject_dir = os.path.join(tmpdir, 'subject_1')
+            os.makedirs(subject_dir)
+            settings = self.Settings(tmpdir, no_symlinks=False)
+            for subject_file in ['roi1.shape.gii', 'roi2.shape.gii']:
+                ciftify_recon_all.link_to_template_file(settings,
+                        os.path.join(subject_dir, subject_file), global_file,
+                        'L.atlasroi.32k_fs_LR.shape.gii')
+
+            via_path = os.path.join(tmpdir, 'zz_templates',
+                    'L.atlasroi.32k_fs_LR.shape.gii')
+            assert os.path.isfile(via_path)
+            for subject_file in ['roi1.shape.gii', 'roi2.shape.gii']:
+                link = os.path.join(subject_dir, subject_file)
+                assert os.path.islink(link)
+                assert os.path.realpath(link) == os.path.realpath(via_path)
+
+    def test_template_copied_when_no_symlinks(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            global_file = os.path.join(tmpdir, 'template.shape.gii')
+            with open(global_file, 'w') as template:
+                template.write('template')
+            subject_file = os.path.join(tmpdir, 'roi.shape.gii')
+            settings = self.Settings(tmpdir, no_symlinks=True)
+            ciftify_recon_all.link_to_template_file(settings, subject_file,
+                    global_file, 'template.shape.gii')
+
+            assert os.path.isfile(subject_file)
+            assert not os.path.islink(subject_file)
+
+class ResampleBarycentric(unittest.TestCase):
+
+    @patch('ciftify.niio.resample_largest_barycentric')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_wb_command_used_by_default(self, mock_run, mock_resample):
+        ciftify_recon_all.resample_barycentric(
+                ciftify.niio.resample_largest_barycentric,
+                '/somewhere/sub.L.aparc.native.label.gii',
+                '/somewhere/sub.L.sphere.MSMSulc.native.surf.gii',
+                '/somewhere/sub.L.sphere.164k_fs_LR.surf.gii',
+                '/somewhere/sub.L.aparc.164k_fs_LR.label.gii')
+
+        assert mock_resample.call_count == 0
+        cmd = mock_run.call_args[0][0]
+        assert cmd[:2] == ['wb_command', '-label-resample']
+        assert cmd[-3:] == ['BARYCENTRIC',
+                '/somewhere/sub.L.aparc.164k_fs_LR.label.gii', '-largest']
+
+    @patch('ciftify.bin.ciftify_recon_all.IN_PROCESS_RESAMPLE', True)
+    @patch('ciftify.niio.resample_surface_barycentric', autospec=True)
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_in_process_when_asked_for(self, mock_run, mock_resample):
+        ciftify_recon_all.resample_barycentric(
+                ciftify.niio.resample_surface_barycentric,
+                '/somewhere/sub.L.white.native.surf.gii',
+                '/somewhere/sub.L.sphere.MSMSulc.native.surf.gii',
+                '/somewhere/sub.L.sphere.164k_fs_LR.surf.gii',
+                '/somewhere/sub.L.white.164k_fs_LR.surf.gii')
+
+        assert mock_run.call_count == 0
+        assert mock_resample.call_count == 1
+
+class LogSection(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.section_header')
+    def test_header_not_built_when_info_not_logged(self, mock_header):
+        with patch.object(ciftify_recon_all.logger, 'level', logging.WARNING):
+            ciftify_recon_all.log_section('Running MSMSulc surface registration')
+        assert mock_header.call_count == 0
+
+class CopyFile(unittest.TestCase):
+    def test_hard_link_from_an_earlier_run_is_not_written_through(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            old_config = os.path.join(tmpdir, 'old_conf')
+            new_config = os.path.join(tmpdir, 'new_conf')
+            conf_log = os.path.join(tmpdir, 'conf')
+            with open(old_config, 'w') as config:
+                config.write('--simval=3')
+            with open(new_config, 'w') as config:
+                config.write('--simval=2')
+            # an earlier run archived the old config as a hard link
+            os.link(old_config, conf_log)
+            ciftify_recon_all.archive_msm_config(new_config, conf_log,
+                    ciftify_recon_all.file_sha1(new_config))
+
+            with open(old_config) as config:
+                assert config.read() == '--simval=3'
+            with open(conf_log) as config:
+                assert config.read() == '--simval=2'
+            assert not os.path.samefile(old_config, conf_log)
+
+    def test_copy_is_a_separate_file(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            src = os.path.join(tmpdir, 'L.sphere.reg.surf.gii')
+            dest = os.path.join(tmpdir, 'sub.L.sphere.MSMSulc.native.surf.gii')
+            with open(src, 'w') as sphere:
+                sphere.write('sphere')
+            ciftify_recon_all.copy_file(src, dest)
+
+            assert not os.path.samefile(src, dest)
+            with open(dest) as sphere:
+                assert sphere.read() == 'sphere'
+
 class CopyAtlasRoiFromTemplate(unittest.TestCase):
 
     @patch('ciftify.bin.ciftify_recon_all.link_to_template_file')
@@ -177,6 +728,190 @@ class CopyAtlasRoiFromTemplate(unittest.TestCase):
 
         assert mock_link.call_count == 0
 
+    @patch('ciftify.bin.ciftify_recon_all.link_to_template_file')
+    def test_links_the_rois_found_in_the_templates(self, mock_link):
+        settings = MagicMock()
+        settings.subject.id = 'subject_1'
+        mesh_settings = {'meshname': 'some_mesh', 'ROI': 'roi',
+                'Folder': '/somepath/hcp'}
+        with ciftify.utils.TempDir() as tmpdir:
+            settings.ciftify_data_dir = tmpdir
+            os.makedirs(os.path.join(tmpdir, 'standard_mesh_atlases'))
+            open(os.path.join(tmpdir, 'standard_mesh_atlases',
+                    'L.atlasroi.some_mesh.shape.gii'), 'w').close()
+            ciftify_recon_all.copy_atlas_roi_from_template(settings,
+                    mesh_settings)
+
+        assert mock_link.call_count == 1
+        assert mock_link.call_args[0][3] == 'L.atlasroi.some_mesh.shape.gii'
+
+class CreateDscalar(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_map_named_at_creation_and_palette_chained(self, mock_run):
+        dscalar_entry = {'mapname': 'sulc', 'map_postfix': '_Sulc',
+                'mask_medialwall': False,
+                'palette_mode': 'MODE_AUTO_SCALE_PERCENTAGE',
+                'palette_options': '-disp-pos true'}
+        with ciftify.utils.TempDir() as tmpdir:
+            mesh_settings = {'Folder': tmpdir, 'tmpdir': tmpdir,
+                    'meshname': 'native', 'ROI': 'roi'}
+            ciftify_recon_all.create_dscalar('subject_1', mesh_settings,
+                    dscalar_entry)
+            with open(os.path.join(tmpdir,
+                    'subject_1.sulc.native.names.txt')) as names:
+                map_names = names.read()
+
+        assert map_names == 'subject_1_Sulc\n'
+        assert mock_run.call_count == 1
+        cmd = mock_run.call_args[0][0]
+        assert '-name-file' in cmd
+        assert '-set-map-names' not in cmd
+        assert cmd.count(' && ') == 1
+
+class ResampleSurfsAndAddToSpec(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    @patch('ciftify.bin.ciftify_recon_all.add_to_spec_file')
+    @patch('ciftify.bin.ciftify_recon_all.resample_barycentric')
+    def test_spec_file_added_to_in_surface_then_hemisphere_order(self,
+            mock_resample, mock_add):
+        ciftify_recon_all.resample_surfs_and_add_to_spec('subject_1',
+                self.meshes['AtlasSpaceNative'], self.meshes['HighResMesh'])
+
+        assert mock_resample.call_count == 6
+        assert mock_resample.call_args[0][0] == \
+                ciftify.niio.resample_surface_barycentric
+        spec_adds = [item[0] for item in mock_add.call_args_list]
+        assert [spec_add[-1].split('.')[1:3] for spec_add in spec_adds] == [
+                ['L', 'white'], ['R', 'white'],
+                ['L', 'midthickness'], ['R', 'midthickness'],
+                ['L', 'pial'], ['R', 'pial']]
+
+class ResampleMetricAndLabel(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    @patch('os.path.exists', return_value=True)
+    @patch('ciftify.bin.ciftify_recon_all.resample_barycentric')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_every_map_resampled_and_masked_after(self, mock_run,
+            mock_resample, mock_exists):
+        dscalars = {'sulc': {'mapname': 'sulc', 'mask_medialwall': False},
+                'thickness': {'mapname': 'thickness', 'mask_medialwall': True}}
+        ciftify_recon_all.resample_metric_and_label('subject_1', dscalars,
+                ['aparc'], self.meshes['AtlasSpaceNative'],
+                self.meshes['HighResMesh'], 'sphere.MSMSulc')
+
+        cmds = [item[0][0] for item in mock_run.call_args_list]
+        assert len([cmd for cmd in cmds if '-metric-resample' in cmd]) == 4
+        # labels are resampled in process
+        assert mock_resample.call_count == 2
+        assert mock_resample.call_args[0][0] == \
+                ciftify.niio.resample_largest_barycentric
+        for cmd in cmds:
+            if '-metric-mask' in cmd:
+                resampled = [i for i, other in enumerate(cmds)
+                        if '-metric-resample' in other and cmd[-1] in other]
+                assert resampled and resampled[0] < cmds.index(cmd)
+
+    @patch('ciftify.bin.ciftify_recon_all.run_many')
+    def test_roi_paths_shared_within_each_hemisphere(self, mock_run_many):
+        dscalars = {'sulc': {'mapname': 'sulc', 'mask_medialwall': False},
+                'thickness': {'mapname': 'thickness', 'mask_medialwall': True},
+                'curvature': {'mapname': 'curvature', 'mask_medialwall': True}}
+        ciftify_recon_all.resample_metric_and_label('subject_1', dscalars,
+                [], self.meshes['AtlasSpaceNative'],
+                self.meshes['HighResMesh'], 'sphere.MSMSulc')
+
+        jobs = mock_run_many.call_args[0][0]
+        assert [(job[3], job[2]['mapname']) for job in jobs] == [
+                ('L', 'sulc'), ('L', 'thickness'), ('L', 'curvature'),
+                ('R', 'sulc'), ('R', 'thickness'), ('R', 'curvature')]
+        assert jobs[0][-1] is jobs[1][-1] is jobs[2][-1]
+        assert jobs[0][-1][0].endswith('subject_1.L.roi.native.shape.gii')
+
+class CalcArealDistortionGii(unittest.TestCase):
+
+    @patch('ciftify.bin.ciftify_recon_all.metric_math')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_distortion_calculated_in_process(self, mock_run,
+            mock_metric_math):
+        ciftify_recon_all.calc_areal_distortion_gii(
+                '/somewhere/subject_1.L.sphere.native.surf.gii',
+                '/somewhere/subject_1.L.sphere.MSMSulc.native.surf.gii',
+                '/tmp/ArealDistortion_MSMSulc.shape.gii', 'subject_1_L',
+                'MSMSulc')
+
+        assert mock_metric_math.call_count == 1
+        assert mock_metric_math.call_args[0][0] == \
+                ciftify.niio.areal_distortion_metric
+        assert mock_metric_math.call_args[0][4] == \
+                'subject_1_L_Areal_Distortion_MSMSulc'
+        # only the palette is set with wb_command
+        assert mock_run.call_count == 1
+        assert '-metric-palette' in mock_run.call_args[0][0]
+
+class RunMSMSulcRegistration(unittest.TestCase):
+    meshes = ciftify_recon_all.define_meshes('/somewhere/hcp/subject_1',
+            '/tmp/temp_dir', "164", ["32"], False)
+
+    @patch('ciftify.bin.ciftify_recon_all.set_structure')
+    @patch('ciftify.bin.ciftify_recon_all.file_sha1', return_value='abc')
+    @patch('os.chdir')
+    @patch('ciftify.bin.ciftify_recon_all.calc_areal_distortion_gii')
+    @patch('ciftify.bin.ciftify_recon_all.copy_file')
+    @patch('ciftify.utils.make_dir')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_msm_run_for_each_hemisphere_without_changing_directory(self,
+            mock_run, mock_make_dir, mock_copy, mock_distortion, mock_chdir,
+            mock_sha, mock_set_structure):
+        ciftify_recon_all.run_MSMSulc_registration('subject_1',
+                '/somewhere/ciftify/data', self.meshes, 'sphere.MSMSulc',
+                'sphere.reg.reg_LR', '/somewhere/MSMSulcStrainFinalconf')
+
+        msm_outs = sorted(arg for item in mock_run.call_args_list
+                if item[0][0][0] == 'msm' for arg in item[0][0]
+                if arg.startswith('--out='))
+        assert [os.path.basename(out) for out in msm_outs] == ['L.', 'R.']
+        assert all(os.path.isabs(out[len('--out='):]) for out in msm_outs)
+        assert mock_chdir.call_count == 0
+        assert mock_distortion.call_count == 2
+        assert sorted(item[0][1] for item in mock_set_structure.call_args_list) \
+                == ['CORTEX_LEFT', 'CORTEX_RIGHT']
+        assert not any('-set-structure' in item[0][0]
+                for item in mock_run.call_args_list)
+        # the affine registration is one shell per hemisphere
+        affine_chains = [item[0][0] for item in mock_run.call_args_list
+                if '-surface-affine-regression' in item[0][0]]
+        assert len(affine_chains) == 2
+        assert all(chain.count('wb_command') == 3 for chain in affine_chains)
+
+    @patch('ciftify.bin.ciftify_recon_all.set_structure')
+    @patch('os.path.exists')
+    @patch('ciftify.bin.ciftify_recon_all.file_sha1', return_value='abc')
+    @patch('ciftify.bin.ciftify_recon_all.calc_areal_distortion_gii')
+    @patch('ciftify.bin.ciftify_recon_all.copy_file')
+    @patch('ciftify.utils.make_dir')
+    @patch('ciftify.bin.ciftify_recon_all.run')
+    def test_config_only_archived_where_the_log_differs(self, mock_run,
+            mock_make_dir, mock_copy, mock_distortion, mock_sha, mock_exists,
+            mock_set_structure):
+        msm_config = '/somewhere/MSMSulcStrainFinalconf'
+        # only the left hemisphere already has the config in its log
+        mock_exists.side_effect = lambda path: path.endswith('L.logdir/conf')
+        ciftify_recon_all.run_MSMSulc_registration('subject_1',
+                '/somewhere/ciftify/data', self.meshes, 'sphere.MSMSulc',
+                'sphere.reg.reg_LR', msm_config)
+
+        conf_copies = [item[0] for item in mock_copy.call_args_list
+                if item[0][0] == msm_config]
+        assert [os.path.basename(os.path.dirname(copy[1]))
+                for copy in conf_copies] == ['R.logdir']
+        # the config itself is only read once
+        assert [item[0][0] for item in mock_sha.call_args_list].count(
+                msm_config) == 1
+
 class DilateAndMaskMetric(unittest.TestCase):
     @patch('ciftify.bin.ciftify_recon_all.run')
     def test_does_nothing_when_dscalars_map_doesnt_mask_medial_wall(self,
@@ -189,6 +924,110 @@ class DilateAndMaskMetric(unittest.TestCase):
 
         assert mock_run.call_count == 0
 
+class RunChain(unittest.TestCase):
+    @patch('ciftify.utils.run')
+    def test_commands_run_in_one_shell(self, mock_run):
+        mock_run.return_value = 0
+        ciftify_recon_all.run_chain([['wb_command', '-metric-math', 'a'],
+                ['wb_command', '-set-map-names', 'b']])
+
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][0] == \
+                'wb_command -logging SEVERE -metric-math a && ' \
+                'wb_command -logging SEVERE -set-map-names b'
+
+    @patch('ciftify.utils.run')
+    def test_exits_when_chain_fails(self, mock_run):
+        mock_run.return_value = 1
+        with pytest.raises(SystemExit):
+            ciftify_recon_all.run_chain([['wb_command', '-metric-math', 'a']])
+
+class WithWbLogging(unittest.TestCase):
+    def test_severe_logging_added_to_wb_command(self):
+        cmd = ciftify_recon_all.with_wb_logging(['wb_command', '-set-structure',
+                'L.surf.gii', 'CORTEX_LEFT'])
+        assert cmd == ['wb_command', '-logging', 'SEVERE', '-set-structure',
+                'L.surf.gii', 'CORTEX_LEFT']
+
+    def test_own_logging_level_and_other_programs_left_alone(self):
+        cmd = ['wb_command', '-volume-label-import', '-logging', 'WARNING']
+        assert ciftify_recon_all.with_wb_logging(cmd) == cmd
+        assert ciftify_recon_all.with_wb_logging(['mris_convert', 'a', 'b']) == \
+                ['mris_convert', 'a', 'b']
+
+class SetRunEnv(unittest.TestCase):
+    def tearDown(self):
+        ciftify_recon_all.set_run_env(1, None)
+
+    @patch('ciftify.utils.run')
+    def test_env_built_once_is_passed_to_every_run(self, mock_run):
+        mock_run.return_value = 0
+        ciftify_recon_all.set_run_env(4, '/somewhere/license.txt')
+        ciftify_recon_all.run(['wb_command', '-version'])
+        ciftify_recon_all.run(['wb_command', '-list-commands'])
+
+        expected_env = {'OMP_NUM_THREADS': '4',
+                'FS_LICENSE': '/somewhere/license.txt'}
+        for call in mock_run.call_args_list:
+            assert call[1]['env'] == expected_env
+
+    def test_fs_license_left_out_when_not_set(self):
+        ciftify_recon_all.set_run_env(2, None)
+        assert ciftify_recon_all.RUN_ENV == {'OMP_NUM_THREADS': '2'}
+
+    @patch('ciftify.bin.ciftify_recon_all.OMP_NTHREADS', 2)
+    @patch('ciftify.bin.ciftify_recon_all.N_CPUS', 4)
+    @patch('ciftify.utils.run')
+    def test_steps_run_alone_get_all_cpus(self, mock_run):
+        mock_run.return_value = 0
+        ciftify_recon_all.set_run_env(2, None, 4)
+        ciftify_recon_all.run(['wb_command', '-version'])
+        assert mock_run.call_args[1]['env'] == {'OMP_NUM_THREADS': '4'}
+
+        ciftify_recon_all.run_many([(ciftify_recon_all.run, ['a']),
+                (ciftify_recon_all.run, ['b'])])
+        for call in mock_run.call_args_list[1:]:
+            assert call[1]['env'] == {'OMP_NUM_THREADS': '2'}
+
+class MultipleSubjects(unittest.TestCase):
+    @patch('ciftify.bin.ciftify_recon_all.run_subject')
+    def test_each_subject_run_and_failures_do_not_stop_the_batch(self,
+            mock_run_subject):
+        mock_run_subject.side_effect = lambda arguments, formatter: \
+                sys.exit(1) if arguments['<Subject>'] == 'subject_2' else None
+        with ciftify.utils.TempDir() as tmpdir:
+            subjects_file = os.path.join(tmpdir, 'subjects.txt')
+            with open(subjects_file, 'w') as subjects_fp:
+                subjects_fp.write('subject_1\nsubject_2\n\nsubject_3\n')
+            with patch.object(sys, 'argv',
+                    ['ciftify_recon_all', '--subjects', subjects_file]):
+                with pytest.raises(SystemExit) as err:
+                    ciftify_recon_all.main()
+
+        assert err.value.code == 1
+        run_subjects = [call[0][0]['<Subject>']
+                for call in mock_run_subject.call_args_list]
+        assert run_subjects == ['subject_1', 'subject_2', 'subject_3']
+
+    @patch('ciftify.bin.ciftify_recon_all.run_subject')
+    def test_errors_raised_by_a_subject_do_not_stop_the_batch(self,
+            mock_run_subject):
+        def run_subject(arguments, formatter):
+            if arguments['<Subject>'] == 'subject_1':
+                raise RuntimeError('bad surface')
+        mock_run_subject.side_effect = run_subject
+        with ciftify.utils.TempDir() as tmpdir:
+            subjects_file = os.path.join(tmpdir, 'subjects.txt')
+            with open(subjects_file, 'w') as subjects_fp:
+                subjects_fp.write('subject_1\nsubject_2\n')
+            with patch.object(sys, 'argv',
+                    ['ciftify_recon_all', '--subjects', subjects_file]):
+                with pytest.raises(SystemExit) as err:
+                    ciftify_recon_all.main()
+
+        assert err.value.code == 1
+        assert mock_run_subject.call_count == 2
+
 @patch('os.makedirs')
 @patch('ciftify.config.find_fsl')
 class TestSettings(unittest.TestCase):
@@ -367,3 +1206,97 @@ class TestSettings(unittest.TestCase):
         # Test should never reach this line
         assert settings.registration['User_AtlasTransform_Linear'] == '/some/file1'
         assert settings.registration['User_AtlasTransform_NonLinear'] == '/some/file2'
+
+    @patch('ciftify.utils.check_input_readable')
+    @patch('os.path.exists')
+    def test_only_premat_needed_when_linear_only(self, mock_exists,
+            mock_inputreadble, mock_fsl, mock_makedirs):
+        mock_fsl.return_value = '/somepath/FSL'
+        mock_exists.side_effect = lambda path: False if path == self.subworkdir else True
+        args = copy.deepcopy(self.arguments)
+        args['--read-lin-premat'] = '/some/file1'
+        args['--linear-only'] = True
+        settings = ciftify_recon_all.Settings(args)
+        assert settings.registration['skip_nonlinear']
+        assert settings.registration['User_AtlasTransform_Linear'] == '/some/file1'
+        assert not settings.registration['User_AtlasTransform_NonLinear']
+
+    @patch('ciftify.config.find_ciftify_global')
+    @patch('ciftify.bin.ciftify_recon_all.WorkFlowSettings._WorkFlowSettings__read_settings')
+    @patch('os.path.exists')
+    def test_omp_nthreads_defaults_to_half_of_n_cpus(self, mock_exists,
+            mock_yaml_settings, mock_ciftify, mock_fsl, mock_makedirs):
+        self.set_mock_env(mock_ciftify, mock_fsl, mock_makedirs)
+        mock_exists.side_effect = lambda path: False if path == self.subworkdir else True
+        mock_yaml_settings.return_value = self.yaml_config
+        args = copy.deepcopy(self.arguments)
+        args['--n_cpus'] = '8'
+        settings = ciftify_recon_all.Settings(args)
+
+        assert settings.omp_nthreads == 4
+
+    @patch('ciftify.config.find_ciftify_global')
+    @patch('ciftify.bin.ciftify_recon_all.WorkFlowSettings._WorkFlowSettings__read_settings')
+    @patch('os.path.exists')
+    def test_msm_hemispheres_run_side_by_side_by_default(self, mock_exists,
+            mock_yaml_settings, mock_ciftify, mock_fsl, mock_makedirs):
+        self.set_mock_env(mock_ciftify, mock_fsl, mock_makedirs)
+        mock_exists.side_effect = lambda path: False if path == self.subworkdir else True
+        mock_yaml_settings.return_value = self.yaml_config
+        args = copy.deepcopy(self.arguments)
+        args['--n_cpus'] = '4'
+        settings = ciftify_recon_all.Settings(args)
+        assert settings.omp_nthreads == 2
+
+        with patch('ciftify.bin.ciftify_recon_all.N_CPUS', 4), \
+                patch('ciftify.bin.ciftify_recon_all.OMP_NTHREADS',
+                        settings.omp_nthreads), \
+                patch('ciftify.bin.ciftify_recon_all.ThreadPoolExecutor',
+                        wraps=ciftify_recon_all.ThreadPoolExecutor) as mock_pool, \
+                patch('ciftify.bin.ciftify_recon_all.set_structure'), \
+                patch('ciftify.bin.ciftify_recon_all.file_sha1',
+                        return_value='abc'), \
+                patch('ciftify.bin.ciftify_recon_all.calc_areal_distortion_gii'), \
+                patch('ciftify.bin.ciftify_recon_all.copy_file'), \
+                patch('ciftify.utils.make_dir'), \
+                patch('ciftify.bin.ciftify_recon_all.run'):
+            ciftify_recon_all.run_MSMSulc_registration('subject_1',
+                    '/somewhere/ciftify/data', RunMSMSulcRegistration.meshes,
+                    'sphere.MSMSulc', 'sphere.reg.reg_LR',
+                    '/somewhere/MSMSulcStrainFinalconf')
+
+        assert mock_pool.call_count == 1
+        assert mock_pool.call_args[1]['max_workers'] == 2
+
+    @patch('ciftify.config.find_ciftify_global')
+    @patch('ciftify.bin.ciftify_recon_all.WorkFlowSettings._WorkFlowSettings__read_settings')
+    @patch('os.path.exists')
+    def test_omp_nthreads_set_to_user_value_when_given(self, mock_exists,
+            mock_yaml_settings, mock_ciftify, mock_fsl, mock_makedirs):
+        self.set_mock_env(mock_ciftify, mock_fsl, mock_makedirs)
+        mock_exists.side_effect = lambda path: False if path == self.subworkdir else True
+        mock_yaml_settings.return_value = self.yaml_config
+        args = copy.deepcopy(self.arguments)
+        args['--n_cpus'] = '8'
+        args['--omp-nthreads'] = '2'
+        settings = ciftify_recon_all.Settings(args)
+
+        assert settings.omp_nthreads == 2
+
+    @patch('ciftify.bin.ciftify_recon_all.has_ciftify_recon_all_run')
+    @patch('ciftify.config.find_ciftify_global')
+    @patch('ciftify.bin.ciftify_recon_all.WorkFlowSettings._WorkFlowSettings__read_settings')
+    @patch('os.path.exists')
+    def test_done_file_checked_before_log_when_resampling(self, mock_exists,
+            mock_yaml_settings, mock_ciftify, mock_has_run, mock_fsl,
+            mock_makedirs):
+        self.set_mock_env(mock_ciftify, mock_fsl, mock_makedirs)
+        # The subject folder and its .ciftify_recon_all.done file both exist
+        mock_exists.return_value = True
+        mock_yaml_settings.return_value = self.yaml_config
+        args = copy.deepcopy(self.arguments)
+        args['--resample-to-T1w32k'] = True
+        settings = ciftify_recon_all.Settings(args)
+
+        assert settings.skip_main_wf
+        assert mock_has_run.call_count == 0
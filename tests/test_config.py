@@ -9,6 +9,7 @@ from unittest.mock import patch
 import pytest
 
 import ciftify.config
+import ciftify.utils
 
 logging.disable(logging.CRITICAL)
 
@@ -253,3 +254,47 @@ class TestGetGitLog(unittest.TestCase):
         assert mock_proc.call_count == 1
         git_cmd = mock_proc.call_args_list[0][0][0]
         assert '--follow {}'.format(fname) in git_cmd
+
+class TestFSLog(unittest.TestCase):
+
+    def write_scripts(self, fs_folder, recon_done_lines):
+        scripts = os.path.join(fs_folder, 'scripts')
+        os.makedirs(scripts)
+        with open(os.path.join(scripts, 'build-stamp.txt'), 'w') as stamp:
+            stamp.write('freesurfer-Linux-centos6_x86_64-stable-pub-v6.0.0-2beb96c\n'
+                    'a second line\n')
+        with open(os.path.join(scripts, 'recon-all.done'), 'w') as done:
+            done.write('------------------------------\n')
+            done.write('\n'.join(recon_done_lines) + '\n')
+
+    def test_parses_build_and_recon_done_fields(self):
+        with ciftify.utils.TempDir() as fs_folder:
+            self.write_scripts(fs_folder, [
+                    'SUBJECT subject_1',
+                    'START_TIME Mon Jan 1 10:00:00 EST 2018',
+                    'END_TIME Mon Jan 1 18:00:00 EST 2018',
+                    'UNAME Linux host 2.6.32 #1 SMP',
+                    'CMDARGS -all -i /data/T1.nii.gz -subjid subject_1'])
+            fslog = ciftify.config.FSLog(fs_folder)
+
+        assert fslog.build == \
+                'freesurfer-Linux-centos6_x86_64-stable-pub-v6.0.0-2beb96c'
+        assert fslog.version == 'v6.0.0'
+        assert fslog.subject == 'subject_1'
+        assert fslog.kernel == '2.6.32'
+        assert fslog.nii_inputs == '/data/T1.nii.gz'
+
+    def test_stops_reading_once_all_fields_are_found(self):
+        with ciftify.utils.TempDir() as fs_folder:
+            self.write_scripts(fs_folder, [
+                    'SUBJECT subject_1',
+                    'START_TIME Mon Jan 1 10:00:00 EST 2018',
+                    'END_TIME Mon Jan 1 18:00:00 EST 2018',
+                    'UNAME Linux host 2.6.32 #1 SMP',
+                    'CMDARGS -all -subjid subject_1',
+                    'a malformed line that would fail to parse'])
+            recon_done = os.path.join(fs_folder, 'scripts', 'recon-all.done')
+            contents = ciftify.config.FSLog(fs_folder).parse_recon_done(
+                    recon_done)
+
+        assert contents['CMDARGS'] == '-all -subjid subject_1'
@@ -4,11 +4,18 @@ import unittest
 import logging
 import shutil
 import random
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import nibabel as nib
 import pytest
 from unittest.mock import patch
 
 import ciftify.niio as niio
+import ciftify.utils
+import ciftify.config
 
 logging.disable(logging.CRITICAL)
 
@@ -110,3 +117,251 @@ class TestLoadGiiData(unittest.TestCase):
         path = '/some/path/subject.data.shape.gii'
         with pytest.raises(SystemExit):
             niio.load_gii_data(path)
+
+class TestFreesurferToGifti(unittest.TestCase):
+    coords = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]],
+            dtype=np.float32)
+    faces = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+
+    def test_surface_coordinates_and_triangles_kept(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            fs_surf = os.path.join(tmpdir, 'lh.white')
+            surf_gii = os.path.join(tmpdir, 'L.white.native.surf.gii')
+            nib.freesurfer.write_geometry(fs_surf, self.coords, self.faces)
+            niio.freesurfer_surface_to_gifti(fs_surf, surf_gii)
+            surf = nib.load(surf_gii)
+            coords, faces = [darray.data for darray in surf.darrays]
+
+        assert np.allclose(coords, self.coords)
+        assert np.array_equal(faces, self.faces)
+
+    def test_morph_data_written_as_metric(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            fs_morph = os.path.join(tmpdir, 'lh.thickness')
+            metric_gii = os.path.join(tmpdir, 'L.thickness.native.shape.gii')
+            nib.freesurfer.write_morph_data(fs_morph,
+                    np.array([2.5, 3.0, -1.0, 0.0], dtype=np.float32))
+            niio.freesurfer_morph_to_gifti(fs_morph, metric_gii)
+            data = nib.load(metric_gii).darrays[0].data
+
+        assert np.allclose(data, [2.5, 3.0, -1.0, 0.0])
+
+    def test_annot_written_as_label_with_unknown_vertices(self):
+        ctab = np.array([[25, 5, 25, 0, 0], [100, 25, 0, 0, 0]])
+        names = [b'unknown', b'precentral']
+        with ciftify.utils.TempDir() as tmpdir:
+            fs_annot = os.path.join(tmpdir, 'lh.aparc.annot')
+            label_gii = os.path.join(tmpdir, 'L.aparc.native.label.gii')
+            nib.freesurfer.write_annot(fs_annot, np.array([1, 1, 0, -1]),
+                    ctab, names, fill_ctab=True)
+            niio.freesurfer_annot_to_gifti(fs_annot, label_gii)
+            label_img = nib.load(label_gii)
+            data = label_img.darrays[0].data
+            labels = label_img.labeltable.get_labels_as_dict()
+
+        assert labels == {0: 'unknown', 1: 'precentral', 2: '???'}
+        assert np.array_equal(data, [1, 1, 0, 2])
+
+def write_metric(data, filename, structure='CortexLeft'):
+    metric = nib.gifti.GiftiImage(
+            meta=niio._gifti_meta(
+                    {'AnatomicalStructurePrimary': structure}),
+            darrays=[nib.gifti.GiftiDataArray(np.array(data, dtype=np.float32))])
+    nib.save(metric, filename)
+
+class TestMetricMath(unittest.TestCase):
+
+    def test_areal_distortion_from_sphere_vertex_areas(self):
+        coords = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]],
+                dtype=np.float32)
+        faces = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]],
+                dtype=np.int32)
+        with ciftify.utils.TempDir() as tmpdir:
+            spheres = []
+            for name, scale in [('sphere', 1), ('sphere.reg', 2)]:
+                sphere = os.path.join(tmpdir, '{}.surf.gii'.format(name))
+                nib.save(nib.gifti.GiftiImage(darrays=[
+                        nib.gifti.GiftiDataArray(coords * scale,
+                            intent='NIFTI_INTENT_POINTSET',
+                            meta=niio._gifti_meta(
+                            {'AnatomicalStructurePrimary': 'CortexLeft'})),
+                        nib.gifti.GiftiDataArray(faces,
+                            intent='NIFTI_INTENT_TRIANGLE')]), sphere)
+                spheres.append(sphere)
+            out = os.path.join(tmpdir, 'ArealDistortion_FS.shape.gii')
+            niio.areal_distortion_metric(spheres[0], spheres[1], out,
+                    'sub_L_Areal_Distortion_FS')
+            result = nib.load(out)
+
+        # doubling the coordinates makes every area four times larger
+        assert np.allclose(result.darrays[0].data, 2.0)
+        assert niio._meta_dict(result.darrays[0].meta)['Name'] == \
+                'sub_L_Areal_Distortion_FS'
+        assert niio._meta_dict(result.meta)['AnatomicalStructurePrimary'] == \
+                'CortexLeft'
+
+    def test_positive_sum_merges_rois_in_place(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            atlas_roi = os.path.join(tmpdir, 'atlasroi.shape.gii')
+            native_roi = os.path.join(tmpdir, 'roi.shape.gii')
+            write_metric([1, 0, 0, 1], atlas_roi)
+            write_metric([1, 1, 0, 0], native_roi, 'CortexRight')
+            niio.metric_math_positive_sum(atlas_roi, native_roi, native_roi)
+            result = nib.load(native_roi)
+
+        assert np.array_equal(result.darrays[0].data, [1, 1, 0, 1])
+        assert niio._meta_dict(result.meta)['AnatomicalStructurePrimary'] == \
+                'CortexRight'
+
+    def test_mask_zeroes_vertices_outside_roi(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            metric = os.path.join(tmpdir, 'thickness.shape.gii')
+            roi = os.path.join(tmpdir, 'roi.shape.gii')
+            write_metric([2.5, 3.0, 1.5, 4.0], metric)
+            write_metric([1, 0, 1, 0], roi)
+            niio.metric_math_mask(metric, roi, metric)
+            result = nib.load(metric)
+
+        assert np.allclose(result.darrays[0].data, [2.5, 0, 1.5, 0])
+        assert niio._meta_dict(result.meta)['AnatomicalStructurePrimary'] == \
+                'CortexLeft'
+
+def write_sphere(coords, faces, filename):
+    nib.save(nib.gifti.GiftiImage(darrays=[
+            nib.gifti.GiftiDataArray(np.array(coords, dtype=np.float32),
+                intent='NIFTI_INTENT_POINTSET'),
+            nib.gifti.GiftiDataArray(np.array(faces, dtype=np.int32),
+                intent='NIFTI_INTENT_TRIANGLE')]), filename)
+
+class TestSetGiftiStructure(unittest.TestCase):
+
+    def test_surface_structure_set_on_the_coordinates(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'sphere.surf.gii')
+            write_sphere([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [[0, 1, 2]], surf)
+            niio.set_gifti_structure(surf, 'CORTEX_RIGHT')
+            result = nib.load(surf)
+
+        coords = result.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0]
+        assert niio._meta_dict(coords.meta)['AnatomicalStructurePrimary'] == \
+                'CortexRight'
+
+    def test_metric_structure_set_on_the_file(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            metric = os.path.join(tmpdir, 'sulc.shape.gii')
+            write_metric([1.0, 2.0], metric, 'CortexLeft')
+            niio.set_gifti_structure(metric, 'CORTEX_RIGHT')
+            result = nib.load(metric)
+
+        assert niio._meta_dict(result.meta)['AnatomicalStructurePrimary'] == \
+                'CortexRight'
+        assert np.allclose(result.darrays[0].data, [1.0, 2.0])
+
+class TestResampleBarycentric(unittest.TestCase):
+    # an octahedron, resampled onto a sphere of its vertices and two
+    # face centres
+    coords = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0],
+            [0, 0, 1], [0, 0, -1]])
+    faces = np.array([[0, 2, 4], [2, 1, 4], [1, 3, 4], [3, 0, 4],
+            [2, 0, 5], [1, 2, 5], [3, 1, 5], [0, 3, 5]])
+    new_coords = np.vstack([coords, [[1, 1, 1], [-1, -1, -1]]])
+    new_faces = np.array([[0, 2, 6], [1, 3, 7]])
+
+    def write_spheres(self, tmpdir):
+        current = os.path.join(tmpdir, 'sphere.surf.gii')
+        new = os.path.join(tmpdir, 'sphere.new.surf.gii')
+        write_sphere(self.coords, self.faces, current)
+        write_sphere(self.new_coords, self.new_faces, new)
+        return current, new
+
+    def test_surface_takes_new_triangles_and_interpolated_coords(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            current, new = self.write_spheres(tmpdir)
+            surf_out = os.path.join(tmpdir, 'white.new.surf.gii')
+            niio.resample_surface_barycentric(current, current, new, surf_out)
+            result = nib.load(surf_out)
+
+        coords = result.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].data
+        faces = result.get_arrays_from_intent('NIFTI_INTENT_TRIANGLE')[0].data
+        assert coords.shape == (8, 3)
+        assert np.allclose(coords[:6], self.coords)
+        assert np.allclose(coords[6], [1 / 3.0] * 3, atol=1e-6)
+        assert np.array_equal(faces, self.new_faces)
+
+    def test_weights_found_once_for_threads_sharing_spheres(self):
+        found = []
+        def slow_weights(*args):
+            found.append(args)
+            time.sleep(0.1)
+            return barycentric_weights(*args)
+        barycentric_weights = niio.barycentric_weights
+        with ciftify.utils.TempDir() as tmpdir:
+            current, new = self.write_spheres(tmpdir)
+            with patch('ciftify.niio.barycentric_weights', slow_weights):
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    results = list(executor.map(
+                            lambda _: niio.sphere_resampling(current, new),
+                            range(4)))
+                niio.clear_sphere_resampling()
+                niio.sphere_resampling(current, new)
+            niio.clear_sphere_resampling()
+
+        # once for the four threads, then again after the cache is cleared
+        assert len(found) == 2
+        assert all(result is results[0] for result in results)
+
+    def test_labels_take_the_largest_weight(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            current, new = self.write_spheres(tmpdir)
+            roi = os.path.join(tmpdir, 'roi.shape.gii')
+            roi_out = os.path.join(tmpdir, 'roi.new.shape.gii')
+            write_metric([1, 0, 0, 0, 0, 0], roi, 'CortexRight')
+            niio.resample_largest_barycentric(roi, current, new, roi_out)
+            result = nib.load(roi_out)
+
+        assert result.darrays[0].data.shape == (8,)
+        assert np.array_equal(result.darrays[0].data[:6], [1, 0, 0, 0, 0, 0])
+        assert niio._meta_dict(result.meta)['AnatomicalStructurePrimary'] == \
+                'CortexRight'
+
+@pytest.mark.skipif(shutil.which('wb_command') is None,
+        reason='needs wb_command to compare with')
+class TestResampleBarycentricMatchesWorkbench(unittest.TestCase):
+    atlases = os.path.join(ciftify.config.find_ciftify_global(),
+            'standard_mesh_atlases')
+    sphere_fs_L = os.path.join(atlases, 'fs_L',
+            'fs_L-to-fs_LR_fsaverage.L_LR.spherical_std.164k_fs_L.surf.gii')
+    sphere_164k = os.path.join(atlases,
+            'fsaverage.L_LR.spherical_std.164k_fs_LR.surf.gii')
+    sphere_32k = os.path.join(atlases, 'L.sphere.32k_fs_LR.surf.gii')
+    atlasroi_164k = os.path.join(atlases, 'L.atlasroi.164k_fs_LR.shape.gii')
+
+    def test_surface_matches_wb_command(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            wb_out = os.path.join(tmpdir, 'wb.surf.gii')
+            out = os.path.join(tmpdir, 'in_process.surf.gii')
+            # a registered freesurfer sphere onto the regular fs_LR mesh
+            subprocess.run(['wb_command', '-surface-resample',
+                    self.sphere_fs_L, self.sphere_fs_L, self.sphere_164k,
+                    'BARYCENTRIC', wb_out], check=True)
+            niio.resample_surface_barycentric(self.sphere_fs_L,
+                    self.sphere_fs_L, self.sphere_164k, out)
+            wb_coords = nib.load(wb_out).darrays[0].data
+            coords = nib.load(out).darrays[0].data
+
+        assert np.allclose(coords, wb_coords, atol=1e-3)
+
+    def test_largest_roi_matches_wb_command(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            wb_out = os.path.join(tmpdir, 'wb.shape.gii')
+            out = os.path.join(tmpdir, 'in_process.shape.gii')
+            subprocess.run(['wb_command', '-metric-resample',
+                    self.atlasroi_164k, self.sphere_164k, self.sphere_32k,
+                    'BARYCENTRIC', wb_out, '-largest'], check=True)
+            niio.resample_largest_barycentric(self.atlasroi_164k,
+                    self.sphere_164k, self.sphere_32k, out)
+            wb_roi = nib.load(wb_out).darrays[0].data
+            roi = nib.load(out).darrays[0].data
+
+        # vertices on a triangle edge may be given either triangle
+        assert np.mean(roi == wb_roi) > 0.999
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+import xml.etree.ElementTree as ET
+
+from unittest.mock import patch
+import pytest
+
+import ciftify.spec
+import ciftify.utils
+
+logging.disable(logging.CRITICAL)
+
+def read_data_files(spec):
+    root = ET.parse(spec).getroot()
+    return [(item.get('Structure'), item.get('DataFileType'),
+            (item.text or '').strip()) for item in root.iter('DataFile')]
+
+class TestDataFileType(unittest.TestCase):
+
+    def test_type_read_from_extension(self):
+        assert ciftify.spec.data_file_type('sub.L.white.native.surf.gii') == 'SURFACE'
+        assert ciftify.spec.data_file_type('sub.thickness.native.dscalar.nii') == \
+                'CONNECTIVITY_DENSE_SCALAR'
+        assert ciftify.spec.data_file_type('T1w.nii.gz') == 'VOLUME'
+
+    def test_raises_for_unknown_file_type(self):
+        with pytest.raises(ValueError):
+            ciftify.spec.data_file_type('notes.txt')
+
+class TestAddToSpecFile(unittest.TestCase):
+
+    def test_new_spec_lists_files_relative_to_the_spec(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            spec = os.path.join(tmpdir, 'Native', 'sub.native.wb.spec')
+            os.makedirs(os.path.dirname(spec))
+            ciftify.spec.add_to_spec_file(spec, [
+                    ('CORTEX_LEFT', os.path.join(tmpdir, 'Native',
+                            'sub.L.white.native.surf.gii')),
+                    ('INVALID', os.path.join(tmpdir, 'T1w.nii.gz'))])
+            data_files = read_data_files(spec)
+
+        assert data_files == [
+                ('CortexLeft', 'SURFACE', 'sub.L.white.native.surf.gii'),
+                ('Invalid', 'VOLUME', os.path.join('..', 'T1w.nii.gz'))]
+
+    def test_files_already_in_spec_are_not_added_again(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            spec = os.path.join(tmpdir, 'sub.native.wb.spec')
+            surf = os.path.join(tmpdir, 'sub.L.white.native.surf.gii')
+            mid = os.path.join(tmpdir, 'sub.L.midthickness.native.surf.gii')
+            ciftify.spec.add_to_spec_file(spec, [('CORTEX_LEFT', surf)])
+            ciftify.spec.add_to_spec_file(spec, [('CORTEX_LEFT', surf),
+                    ('CORTEX_LEFT', mid)])
+            data_files = read_data_files(spec)
+
+        assert [item[2] for item in data_files] == [
+                'sub.L.white.native.surf.gii',
+                'sub.L.midthickness.native.surf.gii']
+
+    def test_empty_data_file_in_spec_is_kept(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            spec = os.path.join(tmpdir, 'sub.native.wb.spec')
+            surf = os.path.join(tmpdir, 'sub.L.white.native.surf.gii')
+            with open(spec, 'w') as spec_file:
+                spec_file.write('<CaretSpecFile Version="1.0">'
+                        '<DataFile Structure="CortexLeft" DataFileType="SURFACE"'
+                        ' Selected="true"/></CaretSpecFile>')
+            ciftify.spec.add_to_spec_file(spec, [('CORTEX_LEFT', surf)])
+            data_files = read_data_files(spec)
+
+        assert data_files == [('CortexLeft', 'SURFACE', ''),
+                ('CortexLeft', 'SURFACE', 'sub.L.white.native.surf.gii')]
+
+    def test_spec_left_unchanged_when_the_write_fails(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            spec = os.path.join(tmpdir, 'sub.native.wb.spec')
+            surf = os.path.join(tmpdir, 'sub.L.white.native.surf.gii')
+            mid = os.path.join(tmpdir, 'sub.L.midthickness.native.surf.gii')
+            ciftify.spec.add_to_spec_file(spec, [('CORTEX_LEFT', surf)])
+            with patch.object(ET.ElementTree, 'write',
+                    side_effect=IOError('disk full')):
+                with pytest.raises(IOError):
+                    ciftify.spec.add_to_spec_file(spec, [('CORTEX_LEFT', mid)])
+            data_files = read_data_files(spec)
+            leftover = os.listdir(tmpdir)
+
+        assert [item[2] for item in data_files] == ['sub.L.white.native.surf.gii']
+        assert leftover == ['sub.native.wb.spec']
+
+class TestSpecFileBatcher(unittest.TestCase):
+
+    @patch('ciftify.spec.add_to_spec_file')
+    def test_each_spec_file_written_once(self, mock_add):
+        with ciftify.spec.SpecFileBatcher() as batcher:
+            batcher.add('/somewhere/a.wb.spec', 'CORTEX_LEFT', '/somewhere/L.surf.gii')
+            batcher.add('/somewhere/b.wb.spec', 'INVALID', '/somewhere/T1w.nii.gz')
+            batcher.add('/somewhere/a.wb.spec', 'CORTEX_RIGHT', '/somewhere/R.surf.gii')
+            assert mock_add.call_count == 0
+
+        assert mock_add.call_count == 2
+        assert mock_add.call_args_list[0][0] == ('/somewhere/a.wb.spec',
+                [('CORTEX_LEFT', '/somewhere/L.surf.gii'),
+                 ('CORTEX_RIGHT', '/somewhere/R.surf.gii')])
+
+    @patch('ciftify.spec.add_to_spec_file')
+    def test_nothing_written_on_dry_run(self, mock_add):
+        with ciftify.spec.SpecFileBatcher(dry_run=True) as batcher:
+            batcher.add('/somewhere/a.wb.spec', 'CORTEX_LEFT', '/somewhere/L.surf.gii')
+
+        assert mock_add.call_count == 0
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import unittest
+import logging
+from unittest.mock import patch
+
+import numpy as np
+
+import ciftify.surface
+
+logging.disable(logging.CRITICAL)
+
+class TestVertexAreas(unittest.TestCase):
+    # a unit square made of two triangles
+    coords = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]],
+            dtype=np.float32)
+    faces = np.array([[0, 1, 2], [0, 2, 3]], dtype=np.int32)
+
+    def test_triangle_areas(self):
+        areas = ciftify.surface.triangle_areas(self.coords, self.faces)
+        assert np.allclose(areas, [0.5, 0.5])
+
+    @patch('ciftify.surface.TRIANGLE_BLOCK', 1)
+    def test_triangle_areas_the_same_in_blocks(self):
+        areas = ciftify.surface.triangle_areas(self.coords, self.faces)
+        assert np.allclose(areas, [0.5, 0.5])
+
+    def test_each_vertex_gets_a_third_of_its_triangles(self):
+        areas = ciftify.surface.vertex_areas(self.coords, self.faces)
+        assert np.allclose(areas, [1 / 3.0, 1 / 6.0, 1 / 3.0, 1 / 6.0])
+        assert np.isclose(areas.sum(), 1.0)
+
+    def test_unused_vertices_have_no_area(self):
+        coords = np.vstack([self.coords, [[5, 5, 5]]])
+        areas = ciftify.surface.vertex_areas(coords, self.faces)
+        assert areas[-1] == 0
+
+class TestLog2Ratio(unittest.TestCase):
+
+    def test_zero_where_either_area_is_not_positive(self):
+        ratio = ciftify.surface.log2_ratio([2.0, 1.0, 0.5, 0.0],
+                [1.0, 1.0, 2.0, 1.0])
+        assert np.allclose(ratio, [1.0, 0.0, -2.0, 0.0])
+
+def octahedron(scale=1.0):
+    coords = scale * np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0],
+            [0, -1, 0], [0, 0, 1], [0, 0, -1]], dtype=np.float64)
+    faces = np.array([[0, 2, 4], [2, 1, 4], [1, 3, 4], [3, 0, 4],
+            [2, 0, 5], [1, 2, 5], [3, 1, 5], [0, 3, 5]], dtype=np.int32)
+    return coords, faces
+
+class TestBarycentricWeights(unittest.TestCase):
+
+    def test_vertex_faces_lists_the_triangles_around_each_vertex(self):
+        _, faces = octahedron()
+        indptr, face_ids = ciftify.surface.vertex_faces(faces, 6)
+        assert np.array_equal(np.diff(indptr), [4] * 6)
+        for vertex in range(6):
+            around = face_ids[indptr[vertex]:indptr[vertex + 1]]
+            assert sorted(around) == sorted(np.where(faces == vertex)[0])
+
+    def test_same_sphere_maps_each_vertex_to_itself(self):
+        coords, faces = octahedron()
+        vertices, weights = ciftify.surface.barycentric_weights(coords, faces,
+                coords * 100)
+        resampled = ciftify.surface.apply_barycentric(np.arange(6.0),
+                vertices, weights)
+        assert np.allclose(resampled, np.arange(6.0))
+
+    def test_weights_sum_to_one_and_land_on_the_sphere_direction(self):
+        coords, faces = octahedron()
+        points = np.random.RandomState(0).normal(size=(200, 3))
+        vertices, weights = ciftify.surface.barycentric_weights(coords, faces,
+                points, k=2)
+        assert np.allclose(weights.sum(axis=1), 1.0)
+        assert (weights >= 0).all()
+        resampled = ciftify.surface.apply_barycentric(coords, vertices, weights)
+        directions = resampled / np.linalg.norm(resampled, axis=1)[:, None]
+        expected = points / np.linalg.norm(points, axis=1)[:, None]
+        assert np.allclose(directions, expected)
+
+    def test_vertices_outside_every_triangle_are_logged(self):
+        coords, faces = octahedron()
+        # only the upper half of the octahedron, nothing below it is covered
+        with self.assertLogs('ciftify.surface', level='WARNING') as logs:
+            logging.disable(logging.NOTSET)
+            try:
+                vertices, weights = ciftify.surface.barycentric_weights(coords,
+                        faces[:4], np.array([[0.1, 0.1, 1], [0.1, 0.1, -1]]))
+            finally:
+                logging.disable(logging.CRITICAL)
+
+        assert '1 of 2 vertices' in logs.output[0]
+        assert vertices[1, 0] == 5 and weights[1, 0] == 1
+
+    def test_largest_takes_the_closest_vertex_value(self):
+        coords, faces = octahedron()
+        points = np.array([[0.9, 0.1, 0.2], [0.1, -0.2, -0.9]])
+        vertices, weights = ciftify.surface.barycentric_weights(coords, faces,
+                points)
+        labels = ciftify.surface.apply_barycentric_largest(
+                np.array([1, 2, 3, 4, 5, 6]), vertices, weights)
+        assert np.array_equal(labels, [1, 6])
@@ -235,6 +235,28 @@ class TestWorkFlowSettings(unittest.TestCase):
 
         assert config is not None
 
+    @patch('os.path.exists')
+    @patch('ciftify.config.find_fsl')
+    def test_config_yaml_parsed_once_and_copied_per_instance(self,
+            mock_fsl, mock_exists):
+        mock_fsl.return_value = '/somepath/FSL'
+        mock_exists.return_value = True
+
+        with utils.TempDir() as tmpdir:
+            yaml_file = os.path.join(tmpdir, 'settings.yaml')
+            with open(yaml_file, 'w') as yaml_stream:
+                yaml_stream.write("high_res: '164'\nlow_res: ['32']\n"
+                        "grayord_res: [2]\n")
+            args_copy = copy.deepcopy(self.arguments)
+            args_copy['--ciftify-conf'] = yaml_file
+            with patch('yaml.load', wraps=utils.yaml.load) as mock_load:
+                first = utils.WorkFlowSettings(args_copy)
+                second = utils.WorkFlowSettings(args_copy)
+
+        assert mock_load.call_count == 1
+        assert second.low_res == ['32']
+        assert first.low_res is not second.low_res
+
     @patch('os.path.exists')
     @patch('ciftify.config.find_fsl')
     @patch('ciftify.config.find_ciftify_global')